@@ -14,30 +14,38 @@
 
 import argparse
 import logging
-import queue
+import sys
 import time
 
 import RPi.GPIO as GPIO
-import picamera
-import pigpio
 
-from button_handler import ButtonHandler
-import imprint_engine
-import servo_handler
+import bus_trace
+import clock
 import task
-import ui
 
 
 # Configuration for all the pins. The pin numbering used is BCM.
 BUTTON_PINS = [5, 6]
 LED_PIN = 16
 
+# The time in seconds a button is held before it is considered pushed, and
+# in which the buttons of a chord must be pressed.
+BUTTON_HOLD_TIME = 0.2
+
+# The time in seconds in which a second press of a button is a double press,
+# or None to not detect double presses. Detecting them delays single presses
+# by this time.
+BUTTON_DOUBLE_PRESS_TIME = None
+
 # Servos are controlled by periodically sending a pulse. The length
 # of the pulse sets the position. Typically servos accept a pulse length
 # between 1ms and 2ms, although most can go beyond these limits to provide
 # an increased range of motion.
 # WARNING: changing the pulse lengths below 1ms or above 2ms may cause damage
 # to a servo - please experiment carefully.
+# A servo may also be given a period in seconds between pulses, which
+# defaults to 0.02, and the current it draws during a pulse, which defaults
+# to 1.
 SERVO_CFG = [
         # The left hand servo is configured as a mirror image (start and
         # stop are switched around).
@@ -46,6 +54,23 @@ SERVO_CFG = [
         dict(pin=25, start_pulse=0.00115, end_pulse=0.00185),
 ]
 
+# The time in seconds to keep driving the servos after they stop moving.
+SERVO_DRIVE_TIME = 2
+
+# How the servo pulses are sent, see servo_handler.SERVO_DRIVERS.
+# 'wave' sends all the pulses as pigpio waves, which are interleaved to
+# reduce peak power draw. 'hybrid' can be chosen instead where the supply
+# allows: it only uses waves while servos move, and holds still servos with
+# pigpio's servo pulses, which are not interleaved but use less CPU. Compare
+# the cpu_time of Output.servo_stats for the two.
+SERVO_DRIVER = 'wave'
+
+# The maximum total current of the servo pulses sent at once, in the same
+# units as the servos' currents. Pulses are scheduled to stay within it, so
+# with a budget of 1 they are sent one after another. Raise it to fit more
+# servos into each period, if the power supply allows.
+SERVO_CURRENT_BUDGET = 1
+
 # The minimum confidence to accept when classifying.
 # This value must be between 0 and 1. A smaller value makes the system more
 # likely to match any label, resulting in greater sensitivity.
@@ -58,6 +83,134 @@ CONFIDENCE = 0.8
 # This value must be between 0 and 1.
 RESPONSIVENESS = 0.2
 
+# The cameras to use, as PiCameraSource arguments. By default a camera
+# captures at the model's input resolution. To use only part of the camera's
+# view, set a larger capture_size as (width, height) and a roi as
+# (x, y, width, height) within it. The region is cropped to fill the model's
+# input, or letterboxed if letterbox is True. With more than one camera, each
+# is given a share of the engine in proportion to its weight.
+CAMERAS = [
+    dict(camera_num=0, capture_size=None, roi=None, letterbox=False, weight=1),
+]
+
+# True if all cameras learn and match against the same labels, False to keep
+# each camera's labels apart.
+SHARED_STORE = True
+
+# While learning, frames that are motion blurred or badly exposed can be
+# discarded before inference. min_sharpness is the minimum variance of the
+# Laplacian of the image brightness. max_dark and max_bright are the largest
+# fractions (0-1) of the image that may be almost black or almost white. For
+# example dict(min_sharpness=15, max_dark=0.6, max_bright=0.6). Tune the
+# thresholds for the cameras and lighting with recordings and evaluate.py
+# before enabling them. None keeps every frame.
+FRAME_QUALITY = None
+
+# While classifying, frames can be processed at max_fps when the scene is
+# changing, backing off to min_fps once it has been stable for stable_time
+# seconds, to save power and reduce heat. For example
+# dict(min_fps=2, max_fps=8, stable_time=3). Check the match latency with
+# evaluate.py before enabling it. None classifies at a fixed 8 fps.
+FRAME_RATE = None
+
+# The camera can be closed after being idle for this many seconds, at the
+# cost of reopening it for the next session. None keeps it open.
+CAMERA_IDLE_TIME = None
+
+# The number of Edge TPUs to use, or None for all that are connected. With
+# more than one, frames are shared between them to increase the frame rate.
+ACCELERATORS = 1
+
+# Matching can use a projection of the embeddings to fewer dimensions, which
+# is faster with many stored embeddings. For example
+# dict(projection='pca', dims=128). Use evaluate.py --projection to compare
+# the accuracy with full width matching. None matches with the full width.
+PROJECTION = None
+
+# The learnt embeddings can be limited to a memory budget in bytes. When it
+# is reached, embeddings are evicted with the eviction policy: 'lru' evicts
+# from the least recently used label, 'fair' from the label with the most
+# embeddings, and 'useful' evicts those least often among the nearest
+# neighbors when classifying. For example
+# dict(max_bytes=64 * 1024 * 1024, eviction='lru'). Engine.memory_usage
+# reports the bytes used. None keeps every embedding, up to the maxlen of
+# each label.
+MEMORY_BUDGET = None
+
+# Matching against a large store can be scored by a thread on each core.
+# workers is the number of threads, or None for one per CPU, and queries are
+# scored in parallel once the store has parallel_rows embeddings, for example
+# dict(workers=None, parallel_rows=2000). With full width matching the
+# embeddings are then also kept packed for the threads, which counts towards
+# the memory budget. None scores in a single thread.
+SCORING = None
+
+# Metrics can be served for monitoring in the Prometheus text format, with
+# dict(port=9100) for a local TCP port or dict(path='/tmp/alto.sock') for a
+# Unix socket, see telemetry.py. Nothing is sent unless the page is scraped.
+# None serves no metrics.
+TELEMETRY = None
+
+# Where each task runs, by class name. Each task.PROCESS task has its own
+# subprocess, which costs the memory of a Python interpreter. task.THREAD
+# tasks are hosted as threads in the main process and exchange messages with
+# it in memory, which suits tasks that do little work. task.WORKER tasks are
+# hosted as threads in one subprocess that they share. For example
+# dict(AltoUI=task.THREAD, ButtonHandler=task.THREAD) saves two interpreters
+# on a Pi Zero. Tasks that are not listed, and the TelemetryExporter, run in
+# their own subprocess.
+TASK_PLACEMENT = {}
+
+
+class StartupReport(object):
+    '''Records how long each phase of startup takes.'''
+
+    def __init__(self):
+        '''Constructor.'''
+        self.start_time = time.monotonic()
+        self.mark_time = self.start_time
+        # A List[Tuple[String, float]] of phases and durations.
+        self.phases = []
+
+    def mark(self, phase):
+        '''Records the end of a phase that started at the previous mark.
+
+        Args:
+          phase: String, the phase name.'''
+        now = time.monotonic()
+        self.phases.append((phase, now - self.mark_time))
+        self.mark_time = now
+
+    def log(self, title):
+        '''Logs the phases so far.
+
+        Args:
+          title: String, describes the point startup has reached.'''
+        lines = ['{:<24} {:7.3f}s'.format(phase, duration)
+                 for phase, duration in self.phases]
+        lines.append('{:<24} {:7.3f}s'.format(
+            'total', time.monotonic() - self.start_time))
+        logging.info('%s\n%s', title, '\n'.join(lines))
+
+    def on_engine_ready(self, timings):
+        '''Called when the engine has loaded its model.
+
+        Args:
+          timings: Dict[String, float], the engine's phases.'''
+        for phase, duration in timings.items():
+            self.phases.append(('engine ' + phase, duration))
+        self.mark('engine ready')
+        self.log('Engine ready')
+
+
+def is_camera_error(exc):
+    '''Returns True if the exception was raised by picamera.
+
+    picamera is only imported by the engine task, but will have been imported
+    here if one of its exceptions was passed to this process.'''
+    picamera = sys.modules.get('picamera')
+    return picamera is not None and isinstance(exc, picamera.PiCameraError)
+
 
 def set_up_led(bus, pin):
     '''Sets up the status LED.
@@ -92,10 +245,13 @@ def set_up_buttons(bus, pins):
       pins: A list of GPIO pins to use.
 
     Emits:
-      Input.button_changed(index: int, pressed: bool)
+      Input.button_changed(index: int, pressed: bool, tick: int)
 
-    Uses pigpiod to provide debouncing.
+    Uses pigpiod to provide debouncing. The tick is pigpio's time of the
+    edge in microseconds.
     '''
+    import pigpio
+
     pi = pigpio.pi()
     if not pi.connected:
         raise RuntimeError('Pigpio failed to connect to the daemon')
@@ -108,30 +264,52 @@ def set_up_buttons(bus, pins):
         pi.set_glitch_filter(pin, 500)
 
     # Wait for the pins to settle.
-    time.sleep(0.01)
+    clock.sleep(0.01)
 
     # Set up a callback to handle press/release events.
     def on_change(gpio, level, tick):
         idx = pins.index(gpio)
-        bus.emit('Input.button_changed', idx, level == 0)
+        bus.emit('Input.button_changed', idx, level == 0, tick)
 
     for pin in pins:
         pi.callback(pin, pigpio.EITHER_EDGE, on_change)
 
 
-def main(confidence=CONFIDENCE, responsiveness=RESPONSIVENESS):
+def main(confidence=CONFIDENCE, responsiveness=RESPONSIVENESS,
+         encode=False, trace_path=None, record_dir=None, snapshot_path=None):
     '''Runs all the tasks required for Alto.
 
     Uses a TaskManager to start the tasks, check that they are alive
     and as a messaging bus.
 
+    If encode is True then the bus uses the binary message encoding.
+
+    If trace_path is set then messages are traced, and the trace is written
+    to that path on exit.
+
+    If record_dir is set then the frames of each learning and classifying
+    session are recorded there, for evaluate.py.
+
+    If snapshot_path is set then the learning data is loaded from that file
+    at startup, if it exists, and saved to it after learning or a reset.
+
     Blinks the LED on any errors.
 
+    Tasks are started by name so that modules such as picamera, numpy and
+    edgetpu are only imported by the tasks that use them. The engine loads
+    its model while the other tasks start, and the time taken by each phase
+    of startup is logged. Tasks run in their own subprocesses, or as threads
+    in this process or a shared worker, as set by TASK_PLACEMENT.
+
     Emits:
       System.started()
     '''
-    task_manager = task.TaskManager()
+    report = StartupReport()
+    tracer = bus_trace.TraceBuffer() if trace_path else None
+    task_manager = task.TaskManager(encode, tracer, TASK_PLACEMENT)
     GPIO.setmode(GPIO.BCM)
+    task_manager.bind('Engine.ready', report.on_engine_ready)
+    report.mark('manager')
 
     # Set up the LED first as it is used if there are any errors.
     set_led = set_up_led(task_manager, LED_PIN)
@@ -140,16 +318,30 @@ def main(confidence=CONFIDENCE, responsiveness=RESPONSIVENESS):
         # Start the output tasks first and input tasks last.
         # This should ensure that all the bindings are in place
         # before the inputs are processed.
-        task_manager.start(imprint_engine.ImprintEngineTask,
-                confidence, responsiveness)
-        task_manager.start(servo_handler.ServoHandler, SERVO_CFG)
-        task_manager.start(ui.AltoUI)
-        task_manager.start(ButtonHandler)
+        task_manager.start('imprint_engine.ImprintEngineTask',
+                confidence, responsiveness, CAMERAS, SHARED_STORE,
+                FRAME_QUALITY, FRAME_RATE, CAMERA_IDLE_TIME, ACCELERATORS,
+                record_dir, snapshot_path, PROJECTION, MEMORY_BUDGET, SCORING)
+        report.mark('ImprintEngineTask')
+        task_manager.start('servo_handler.ServoHandler', SERVO_CFG,
+                SERVO_DRIVE_TIME, SERVO_DRIVER, SERVO_CURRENT_BUDGET)
+        report.mark('ServoHandler')
+        task_manager.start('ui.AltoUI')
+        report.mark('AltoUI')
+        task_manager.start('button_handler.ButtonHandler',
+                len(BUTTON_PINS), BUTTON_HOLD_TIME, BUTTON_DOUBLE_PRESS_TIME)
+        report.mark('ButtonHandler')
+        if TELEMETRY:
+            task_manager.start('telemetry.TelemetryExporter',
+                    TELEMETRY.get('port'), TELEMETRY.get('path'))
+            report.mark('TelemetryExporter')
         set_up_buttons(task_manager, BUTTON_PINS)
+        report.mark('buttons')
 
         # Indicate the system is ready by turning on the LED.
         task_manager.emit('System.started')
         set_led(1)
+        report.log('System started')
 
         # Run forever
         task_manager.process_messages()
@@ -159,7 +351,7 @@ def main(confidence=CONFIDENCE, responsiveness=RESPONSIVENESS):
         logging.exception('Error in main')
 
         # Emit a blink error code
-        if isinstance(exc,  picamera.PiCameraError):
+        if is_camera_error(exc):
             # Camera problems are shown as two blinks.
             blinks = 2
         else:
@@ -181,6 +373,8 @@ def main(confidence=CONFIDENCE, responsiveness=RESPONSIVENESS):
     finally:
         # Clean up the tasks and turn the LED off on exit.
         task_manager.terminate()
+        if trace_path:
+            task_manager.write_trace(trace_path)
         set_led(0)
         GPIO.cleanup()
 
@@ -210,8 +404,29 @@ likely to match any label, resulting in greater sensitivity.''')
 Sets how quickly the unit responds to changes while classifying.
 This value must be between 0 and 1.''')
 
+    parser.add_argument("--encode", action="store_true",
+            help='''
+Uses a compact binary encoding for messages sent between tasks.''')
+
+    parser.add_argument("--trace", metavar="PATH",
+            help='''
+Traces messages sent between tasks and writes the trace to PATH on exit, in
+the Chrome trace event format. A summary is logged.''')
+
+    parser.add_argument("--record", metavar="DIR",
+            help='''
+Records the frames of each learning and classifying session in DIR, to tune
+the parameters offline with evaluate.py.''')
+
+    parser.add_argument("--snapshot", metavar="FILE",
+            help='''
+Loads the learning data from FILE at startup, if it exists, and saves it to
+FILE after learning or a reset. A snapshot from one unit can be copied to
+others so that they do not need to be trained.''')
+
     args = parser.parse_args()
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
-    main(args.confidence, args.responsiveness)
+    main(args.confidence, args.responsiveness, args.encode, args.trace,
+         args.record, args.snapshot)
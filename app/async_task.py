@@ -0,0 +1,219 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import multiprocessing
+
+import bus_trace
+import codec
+import task
+
+
+class AsyncTask(task.Task):
+    '''A Task that runs an asyncio event loop.
+
+    The connection from the TaskManager is registered as a reader with the
+    event loop, so messages are handled while coroutines are waiting on
+    sockets, files or other I/O.
+
+    Bound callbacks may be coroutine functions. If a coroutine is called then
+    its result is sent back once it completes, and other messages continue to
+    be handled in the meantime.
+
+    call() is a coroutine and accepts a timeout. Timers scheduled with
+    call_at(), call_later() and call_every() run on the event loop.
+
+    If BATCH_HANDLERS is True, the messages emitted while handling the
+    messages that are ready are sent as one batch, as are those emitted by
+    each timer. Messages emitted by coroutines after they first wait are
+    not batched unless they use batching().
+
+    Subclasses may override main(), which runs alongside message handling.'''
+
+    def __init__(self, task_args):
+        super().__init__(task_args)
+        self.loop = None
+        # Resolved when the task should exit.
+        self.stopped = None
+        # The event loop handle for the next timer.
+        self.timer_handle = None
+
+    def run(self):
+        '''The task's main loop.
+
+        Runs the event loop until the TaskManager shuts the task down.'''
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+
+    async def main(self):
+        '''Runs alongside message handling, to be overloaded.
+
+        The task keeps running after this returns. If it raises then the
+        task stops.'''
+        pass
+
+    async def call(self, message_name, *args, timeout=None):
+        '''Broadcasts a message to the bus and return the results.
+
+        Args:
+          name: String, the message name.
+          args: Any, the arguments to be passed to the listeners.
+          timeout: Union[float, None], the time in seconds to wait.
+
+        Returns:
+          List[Any], a result from every listener bound to the message.
+
+        Raises:
+          asyncio.TimeoutError: The results did not arrive in time.'''
+        # Send any batched messages first, so they arrive first.
+        self.flush()
+        # Create a Pipe for receiving replies.
+        results, sender = multiprocessing.Pipe(False)
+        trace = self._start_trace(message_name)
+        self.sender.put(task.Message(message_name, args, sender, trace))
+
+        async def receive_all():
+            try:
+                # The TaskManager sends the number of bindings first.
+                count = await self._receive(results)
+                # The rest of the items are the replies.
+                return [await self._receive(results) for _ in range(count)]
+            finally:
+                results.close()
+
+        # If the call times out, the replies are still received and
+        # discarded so that the listeners do not write to a closed pipe.
+        replies = asyncio.ensure_future(receive_all())
+        return await asyncio.wait_for(asyncio.shield(replies), timeout)
+
+    async def _run(self):
+        '''Processes messages and runs main() until stopped.'''
+        self.stopped = self.loop.create_future()
+        self.loop.add_reader(self.receiver.fileno(), self._on_readable)
+        self._update_timer()
+
+        main = asyncio.ensure_future(self.main())
+        try:
+            await asyncio.wait(
+                [main, self.stopped], return_when=asyncio.FIRST_COMPLETED)
+            if main.done():
+                # Raise any error from main.
+                main.result()
+            await self.stopped
+        finally:
+            main.cancel()
+            self.loop.remove_reader(self.receiver.fileno())
+            if self.timer_handle:
+                self.timer_handle.cancel()
+
+    async def _receive(self, connection):
+        '''Receives an item from a connection without blocking the loop.'''
+        if not connection.poll():
+            ready = self.loop.create_future()
+
+            def on_readable():
+                if not ready.done():
+                    ready.set_result(None)
+
+            self.loop.add_reader(connection.fileno(), on_readable)
+            try:
+                await ready
+            finally:
+                self.loop.remove_reader(connection.fileno())
+        return connection.recv()
+
+    def _stop(self, exc=None):
+        '''Stops the task, raising exc from run() if it is set.'''
+        if self.stopped.done():
+            return
+        if exc is None:
+            self.stopped.set_result(None)
+        else:
+            self.stopped.set_exception(exc)
+
+    def _on_readable(self):
+        '''Handles all pending messages.'''
+        try:
+            with self._handler_batching():
+                while self.receiver.poll():
+                    msg = self._recv()
+                    # The TaskManager can send a None message to indicate
+                    # shutdown.
+                    if msg is None:
+                        self._stop()
+                        return
+                    for item in msg if isinstance(msg, list) else [msg]:
+                        self._handle(item)
+        except Exception as exc:
+            self._stop(exc)
+
+    def _handle(self, msg):
+        '''Processes a message, sending back results if requested.
+
+        Coroutines are run on the loop and reply when they complete.'''
+        msg_id = codec.message_id(msg.name)
+        if self.tracer and msg.trace:
+            self.tracer.record(bus_trace.RECEIVE, msg_id, *msg.trace,
+                               pid=self.task_id)
+
+        def done(result):
+            if msg.results:
+                msg.results.send(result)
+            if self.tracer and msg.trace:
+                self.tracer.record(bus_trace.DONE, msg_id, *msg.trace,
+                                   pid=self.task_id)
+
+        result = self.bindings[msg.name](*msg.args)
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(self._finish(result, done))
+        else:
+            done(result)
+
+    async def _finish(self, coroutine, done):
+        '''Awaits a coroutine handler and then sends its result.'''
+        try:
+            done(await coroutine)
+        except Exception as exc:
+            self._stop(exc)
+
+    def _schedule(self, timer):
+        '''Adds a timer to the heap and wakes the loop for it.'''
+        super()._schedule(timer)
+        self._update_timer()
+
+    def _update_timer(self):
+        '''Schedules the loop to wake for the next timer.'''
+        if self.loop is None:
+            # Not running yet, _run() will call this.
+            return
+        if self.timer_handle:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        when = self._next_timer()
+        if when is not None:
+            # The loop's clock is time.monotonic(), as used by the timers.
+            self.timer_handle = self.loop.call_at(when, self._on_timer)
+
+    def _on_timer(self):
+        '''Runs the timers that are due.'''
+        self.timer_handle = None
+        try:
+            self._run_timers()
+        except Exception as exc:
+            self._stop(exc)
+        self._update_timer()
@@ -0,0 +1,231 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tracing of messages sent over the task bus.
+
+Every process writes fixed size binary records into a ring buffer held in
+shared memory. A message is identified by the pid of the process that sent
+it and a sequence number from that process, which allows the records made
+by the sender, the TaskManager and each receiving task to be matched up.
+
+Tasks hosted as threads in the TaskManager's process use their negative
+task IDs in place of pids.'''
+
+import collections
+import ctypes
+import json
+import multiprocessing
+import os
+import struct
+
+import clock
+
+
+# Record kinds.
+EMIT = 0
+DISPATCH = 1
+RECEIVE = 2
+DONE = 3
+
+# Record: kind, message ID, pid, sender pid, sequence, queue depth, time.
+RECORD = struct.Struct('<BIiiIId')
+
+Record = collections.namedtuple('Record', [
+    'kind', 'msg_id', 'pid', 'origin', 'seq', 'depth', 'time'])
+
+
+class TraceBuffer(object):
+    '''A ring buffer of trace records shared between processes.
+
+    The buffer must be created before the tasks are started so that they
+    inherit it.'''
+
+    def __init__(self, capacity=65536):
+        '''Constructor.
+
+        Args:
+          capacity: int, the number of records to keep.'''
+        self.capacity = capacity
+        self.data = multiprocessing.RawArray(
+            ctypes.c_char, capacity * RECORD.size)
+        # The total number of records written, the lock guards writes.
+        self.count = multiprocessing.Value(ctypes.c_uint64)
+
+    def record(self, kind, msg_id, origin, seq, depth=0, pid=None):
+        '''Writes a record stamped with the current time.
+
+        Args:
+          kind: int, the record kind.
+          msg_id: int, the ID of the message name.
+          origin: int, the pid of the process that sent the message.
+          seq: int, the sequence number assigned by the sender.
+          depth: int, the queue depth, if known.
+          pid: Union[int, None], the recording process, or None.'''
+        now = clock.monotonic()
+        if pid is None:
+            pid = os.getpid()
+        with self.count.get_lock():
+            idx = self.count.value
+            self.count.value = idx + 1
+            RECORD.pack_into(
+                self.data, (idx % self.capacity) * RECORD.size,
+                kind, msg_id, pid, origin, seq & 0xffffffff, depth, now)
+
+    def records(self):
+        '''Returns the records in the buffer, oldest first.
+
+        Returns:
+          List[Record]'''
+        with self.count.get_lock():
+            count = self.count.value
+            data = bytes(self.data)
+        start = max(0, count - self.capacity)
+        return [
+            Record._make(RECORD.unpack_from(
+                data, (idx % self.capacity) * RECORD.size))
+            for idx in range(start, count)]
+
+
+def _group(records):
+    '''Groups records by message.
+
+    Returns:
+      Dict[Tuple[int, int], List[Record]], records keyed by (origin, seq).'''
+    messages = collections.defaultdict(list)
+    for record in records:
+        messages[(record.origin, record.seq)].append(record)
+    return messages
+
+
+def summarize(records, names):
+    '''Summarizes queue depths and latencies for each message name.
+
+    Args:
+      records: List[Record], as returned by TraceBuffer.records().
+      names: Dict[int, String], message IDs and their names.
+
+    Returns:
+      Dict[String, Dict[String, float]], statistics per message name. Times
+      are in milliseconds.'''
+    stats = collections.defaultdict(lambda: collections.defaultdict(list))
+    for events in _group(records).values():
+        emitted = dispatched = None
+        for record in events:
+            name = names.get(record.msg_id, hex(record.msg_id))
+            if record.kind == EMIT:
+                emitted = record.time
+            elif record.kind == DISPATCH:
+                dispatched = record.time
+                stats[name]['queue_depth'].append(record.depth)
+                if emitted is not None:
+                    stats[name]['dispatch_latency'].append(
+                        (dispatched - emitted) * 1000)
+        # Receive and done records from each task are paired up by pid.
+        received = {}
+        for record in events:
+            name = names.get(record.msg_id, hex(record.msg_id))
+            if record.kind == RECEIVE:
+                received[record.pid] = record.time
+                if emitted is not None:
+                    stats[name]['receive_latency'].append(
+                        (record.time - emitted) * 1000)
+            elif record.kind == DONE and record.pid in received:
+                stats[name]['handler_duration'].append(
+                    (record.time - received.pop(record.pid)) * 1000)
+
+    summary = {}
+    for name, values in stats.items():
+        result = summary[name] = {}
+        result['count'] = len(values['queue_depth'])
+        for key, items in values.items():
+            if items:
+                result[key + '_mean'] = sum(items) / len(items)
+                result[key + '_max'] = max(items)
+    return summary
+
+
+def format_summary(summary):
+    '''Formats a summary as a table.
+
+    Args:
+      summary: the result of summarize().
+
+    Returns:
+      String'''
+    columns = [
+        ('count', 'count'),
+        ('queue_depth_mean', 'depth'),
+        ('queue_depth_max', 'depth max'),
+        ('dispatch_latency_mean', 'dispatch ms'),
+        ('receive_latency_mean', 'receive ms'),
+        ('receive_latency_max', 'receive max'),
+        ('handler_duration_mean', 'handler ms'),
+        ('handler_duration_max', 'handler max'),
+    ]
+    lines = ['{:<40}'.format('message') + ''.join(
+        '{:>12}'.format(title) for _, title in columns)]
+    for name in sorted(summary):
+        lines.append('{:<40}{:>12d}'.format(name, summary[name]['count']) +
+                     ''.join('{:>12.2f}'.format(summary[name].get(key, 0))
+                             for key, _ in columns[1:]))
+    return '\n'.join(lines)
+
+
+def export_chrome(records, names, process_names, path):
+    '''Writes records in the Chrome trace event JSON format.
+
+    The file can be loaded into chrome://tracing or Perfetto.
+
+    Args:
+      records: List[Record], as returned by TraceBuffer.records().
+      names: Dict[int, String], message IDs and their names.
+      process_names: Dict[int, String], pids and the names of their tasks.
+      path: String, the file to write.'''
+    events = []
+    for pid, name in process_names.items():
+        events.append(dict(ph='M', name='process_name', pid=pid, tid=pid,
+                           args=dict(name=name)))
+
+    for (origin, seq), items in _group(records).items():
+        flow_id = '{}:{}'.format(origin, seq)
+        received = {}
+        for record in items:
+            name = names.get(record.msg_id, hex(record.msg_id))
+            ts = record.time * 1000000
+            args = dict(origin=origin, seq=seq)
+            if record.kind == EMIT:
+                events.append(dict(ph='i', s='t', name=name, cat='emit',
+                                   ts=ts, pid=record.pid, tid=record.pid,
+                                   args=args))
+                events.append(dict(ph='s', name=name, cat='flow', id=flow_id,
+                                   ts=ts, pid=record.pid, tid=record.pid))
+            elif record.kind == DISPATCH:
+                args['queue_depth'] = record.depth
+                events.append(dict(ph='i', s='t', name=name, cat='dispatch',
+                                   ts=ts, pid=record.pid, tid=record.pid,
+                                   args=args))
+            elif record.kind == RECEIVE:
+                received[record.pid] = ts
+                events.append(dict(ph='f', bp='e', name=name, cat='flow',
+                                   id=flow_id, ts=ts, pid=record.pid,
+                                   tid=record.pid))
+            elif record.kind == DONE and record.pid in received:
+                start = received.pop(record.pid)
+                events.append(dict(ph='X', name=name, cat='handler',
+                                   ts=start, dur=ts - start, pid=record.pid,
+                                   tid=record.pid, args=args))
+
+    events.sort(key=lambda event: event.get('ts', 0))
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
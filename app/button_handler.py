@@ -12,99 +12,262 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
+import logging
 
+import clock
 import task
 
 
+log = logging.getLogger('button_handler')
+
+
 class ButtonHandler(task.Task):
-    '''Processes low level input events from two buttons.
+    '''Processes low level input events from any number of buttons.
 
     Binds to:
-      Input.button_changed(index: int, pressed: bool)
+      Input.button_changed(index: int, pressed: bool, tick: int)
+      ButtonHandler.button_stats() -> Dict[String, Any]
 
     Emits:
       ButtonHandler.single_button_pressed(index: int)
+      ButtonHandler.double_pressed(index: int)
+      ButtonHandler.chord_pressed(buttons: int, pressed: bool)
       ButtonHandler.both_buttons_pressed(pressed: bool)
 
     A single_button_pressed event is emitted when a button is pressed and either
       a: released
-      b: held for longer than HOLD_THRESHOLD
-    without the other button being pressed.
+      b: held for longer than hold_time
+    without another button being pressed.
 
-    A both_buttons_pressed(True) event is emitted when a button is pressed while
-    the other button is also currently pressed.
-    A both_buttons_pressed(False) event is then emitted when one of the
-    buttons is released.
-    '''
+    If double_press_time is set, a button that is pressed again within
+    double_press_time of being released emits a double_pressed event instead.
+    A single_button_pressed event for a release then waits for that time.
+
+    A chord is two or more buttons pressed within hold_time of the first.
+    chord_pressed(buttons, True) is emitted, where buttons is a bit mask of
+    the buttons, once all the buttons are pressed or hold_time has passed.
+    chord_pressed(buttons, False) is then emitted when one of the buttons is
+    released. both_buttons_pressed is emitted with chord_pressed.
 
-    # Time (in seconds) a button is held before being considered pushed.
-    HOLD_THRESHOLD = 0.2
+    The tick of each change is pigpio's time of the edge in microseconds, so
+    times are measured between edges rather than between messages. The
+    latency from the edge that caused an event, or the time it was due, to
+    the event is reported by button_stats(). The time of each edge is
+    estimated from the earliest any edge has been received, so the latency
+    excludes the fastest delivery of a change.
+    '''
 
     # States
     IDLE = 0
     SINGLE_PUSH = 1
-    DOUBLE_PUSH = 2
-    WAITING_FOR_RELEASE = 3
+    CHORD_PUSH = 2
+    CHORD = 3
+    RELEASED = 4
+    WAITING_FOR_RELEASE = 5
+
+    # The rate at which pigpio's ticks and the clock are allowed to drift
+    # apart, in seconds per second.
+    DRIFT = 0.0001
 
-    def __init__(self, task_args):
+    def __init__(self, task_args, count=2, hold_time=0.2,
+                 double_press_time=None):
+        '''Constructor.
+
+        Args:
+          count: int, the number of buttons.
+          hold_time: float, the time in seconds a button is held before being
+            considered pushed, and in which a chord must be pressed.
+          double_press_time: Union[float, None], the time in seconds in which
+            a second press is a double press, or None to not detect double
+            presses.'''
         super().__init__(task_args)
+        self.count = count
+        self.hold_time = hold_time
+        self.double_press_time = double_press_time
         self.state = self.IDLE
-        self.buttons = [False, False]
-        self.pushed_time = None
+        # A bit mask of the buttons that are pressed.
+        self.pressed = 0
+        # The bit mask of the buttons in a chord.
+        self.chord = 0
+        # The first button of a push, and the times in seconds of its press
+        # and release, by the tick.
+        self.first = None
+        self.pressed_at = 0
+        self.released_at = 0
+        # Set while waiting for hold_time or double_press_time.
+        self.timer = None
+
+        # The last tick, its time in seconds and the clock time it was
+        # received, and the offset from tick times to clock times.
+        self.last_tick = None
+        self.tick_time = 0
+        self.received_at = 0
+        self.offset = None
+
+        # Statistics for button_stats().
+        self.events = 0
+        self.total_latency = 0
+        self.max_latency = 0
 
         self.bind('Input.button_changed', self.on_change)
+        self.bind('ButtonHandler.button_stats', self.button_stats)
+
+    def on_change(self, idx, state, tick):
+        '''Call when a button changes.
+
+        Args:
+          idx: int, the button index.
+          state: bool, True if the button is pressed.
+          tick: int, pigpio's tick in microseconds at the edge.'''
+        at = self._tick_time(tick)
 
-    def on_change(self, idx, state):
-        '''Call when a button changes.'''
         # Do nothing if the state has not changed.
-        if self.buttons[idx] == state:
+        bit = 1 << idx
+        if bool(self.pressed & bit) == state:
             return
 
         # Record the new button state.
-        self.buttons[idx] = state
+        self.pressed ^= bit
 
         if state:
-            # Handle a button press.
-            if self.state == self.IDLE:
-                self.state = self.SINGLE_PUSH
-                self.pushed_time = time.monotonic()
-            elif self.state == self.SINGLE_PUSH:
-                self.state = self.DOUBLE_PUSH
-                self.emit('ButtonHandler.both_buttons_pressed', True)
+            self._on_press(idx, at)
         else:
-            # Handle a button release..
-            if self.state == self.SINGLE_PUSH:
-                self.emit('ButtonHandler.single_button_pressed', idx)
-                self.state = self.IDLE
-            elif self.state == self.DOUBLE_PUSH:
+            self._on_release(idx, at)
+
+    def button_stats(self):
+        '''Returns statistics for the events emitted.
+
+        Returns:
+          Dict[String, Any], the number of events, and the mean and maximum
+          latency in milliseconds.'''
+        return dict(
+            events=self.events,
+            latency_mean_ms=1000 * self.total_latency / max(1, self.events),
+            latency_max_ms=1000 * self.max_latency)
+
+    def _on_press(self, idx, at):
+        '''Handles a button press at a time by the tick.'''
+        if self.state == self.RELEASED:
+            self._cancel_timer()
+            if idx == self.first and (
+                    at - self.released_at < self.double_press_time):
                 self.state = self.WAITING_FOR_RELEASE
-                self.emit('ButtonHandler.both_buttons_pressed', False)
-            elif self.state == self.WAITING_FOR_RELEASE:
-                if not (self.buttons[0] or self.buttons[1]):
-                    self.state = self.IDLE
-
-    def run(self):
-        '''The task's main loop.
-
-        Processes messages and handles buttons being pushed and held.'''
-        def get_duration():
-            '''Gets the duration to process messages for.
-
-            Duration is None (forever) unless the HOLD_THRESHOLD test needs to
-            be run.'''
-            if self.state == self.SINGLE_PUSH:
-                return self.HOLD_THRESHOLD - elapsed
+                self._emit(at, 'ButtonHandler.double_pressed', idx)
+                return
+            # Another button, or too late, so the first press was single.
+            self._emit(self.released_at + self.double_press_time,
+                       'ButtonHandler.single_button_pressed', self.first)
+            self.state = self.IDLE
+
+        if self.state == self.IDLE:
+            self.state = self.SINGLE_PUSH
+            self.first = idx
+            self.pressed_at = at
+            self._start_timer(at + self.hold_time, self._on_hold)
+        elif self.state in (self.SINGLE_PUSH, self.CHORD_PUSH):
+            if at - self.pressed_at < self.hold_time:
+                self.state = self.CHORD_PUSH
+                self.chord = self.pressed
+                if self.chord == (1 << self.count) - 1:
+                    # No more buttons can join the chord.
+                    self._cancel_timer()
+                    self._press_chord(at)
             else:
-                return None
-
-        while self.process_messages(get_duration(), batch=True):
-            if self.state == self.SINGLE_PUSH:
-                # Perform the check for a single held push.
-                elapsed = time.monotonic() - self.pushed_time
-                if elapsed >= self.HOLD_THRESHOLD:
-                    # A button has been held for long enough to consider it
-                    # pushed.
-                    idx = 0 if self.buttons[0] else 1
-                    self.emit('ButtonHandler.single_button_pressed', idx)
-                    self.state = self.WAITING_FOR_RELEASE
+                # The hold time passed before this press was received.
+                self._cancel_timer()
+                self._on_hold()
+
+    def _on_release(self, idx, at):
+        '''Handles a button release at a time by the tick.'''
+        if self.state == self.SINGLE_PUSH:
+            self._cancel_timer()
+            if self.double_press_time and (
+                    at - self.pressed_at < self.hold_time):
+                self.state = self.RELEASED
+                self.released_at = at
+                self._start_timer(at + self.double_press_time,
+                                  self._on_double_press_timeout)
+            else:
+                self.state = self.IDLE
+                self._emit(at, 'ButtonHandler.single_button_pressed', idx)
+            return
+
+        if self.state == self.CHORD_PUSH:
+            self._cancel_timer()
+            self._press_chord(at)
+        if self.state == self.CHORD:
+            self.state = self.WAITING_FOR_RELEASE
+            self._emit(at, 'ButtonHandler.chord_pressed', self.chord, False)
+            self._emit(at, 'ButtonHandler.both_buttons_pressed', False)
+        if self.state == self.WAITING_FOR_RELEASE and not self.pressed:
+            self.state = self.IDLE
+
+    def _on_hold(self):
+        '''Called when a push has lasted for hold_time.'''
+        due = self.pressed_at + self.hold_time
+        if self.state == self.SINGLE_PUSH:
+            # A button has been held for long enough to consider it pushed.
+            self.state = self.WAITING_FOR_RELEASE
+            self._emit(due, 'ButtonHandler.single_button_pressed',
+                       self.first)
+        elif self.state == self.CHORD_PUSH:
+            self._press_chord(due)
+
+    def _on_double_press_timeout(self):
+        '''Called when a released button was not pressed again in time.'''
+        if self.state == self.RELEASED:
+            self.state = self.IDLE
+            self._emit(self.released_at + self.double_press_time,
+                       'ButtonHandler.single_button_pressed', self.first)
+
+    def _press_chord(self, due):
+        '''Emits that the chord has been pressed.'''
+        self.state = self.CHORD
+        self._emit(due, 'ButtonHandler.chord_pressed', self.chord, True)
+        self._emit(due, 'ButtonHandler.both_buttons_pressed', True)
+
+    def _start_timer(self, due, callback):
+        '''Calls callback at a time by the tick.'''
+        self.timer = self.call_later(
+            max(0, self._clock_time(due) - clock.monotonic()), callback)
+
+    def _cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _emit(self, due, name, *args):
+        '''Emits an event, recording the latency from a time by the tick.'''
+        latency = max(0, clock.monotonic() - self._clock_time(due))
+        self.events += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        log.debug('%s%s after %.1fms', name, args, latency * 1000)
+        self.emit(name, *args)
+
+    def _tick_time(self, tick):
+        '''Converts a tick to a time in seconds, and updates the offset.
+
+        Ticks wrap every 2**32 microseconds, about 72 minutes, so the number
+        of wraps since the last tick is found from the clock.'''
+        now = clock.monotonic()
+        if self.last_tick is None:
+            self.tick_time = tick / 1000000
+            self.offset = now - self.tick_time
+        else:
+            delta = (tick - self.last_tick) & 0xffffffff
+            elapsed = (now - self.received_at) * 1000000
+            delta += round((elapsed - delta) / 2**32) * 2**32
+            self.tick_time += delta / 1000000
+            # The earliest delivery gives the best offset, but allow for
+            # drift.
+            self.offset = min(
+                now - self.tick_time,
+                self.offset + (now - self.received_at) * self.DRIFT)
+        self.last_tick = tick
+        self.received_at = now
+        return self.tick_time
+
+    def _clock_time(self, at):
+        '''Converts a time by the tick to a clock.monotonic() time.'''
+        return at + self.offset
@@ -0,0 +1,141 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''The clock used by the TaskManager and tasks hosted in its process.
+
+Everything that reads the time, sleeps, waits for another thread or starts
+a thread does so through this module. By default it uses the system's
+monotonic clock and real threads. A simulation replaces the clock with a
+virtual one, see simulation.py, so that the tasks run in a repeatable order
+and waiting takes no real time.'''
+
+import multiprocessing
+import threading
+import time
+
+
+class Clock(object):
+    '''The system clock.'''
+
+    def monotonic(self):
+        '''Returns the current time in seconds.
+
+        Returns:
+          float, as time.monotonic().'''
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        '''Waits for a time.
+
+        Args:
+          seconds: float, the time in seconds to wait.'''
+        time.sleep(seconds)
+
+    def wait_for(self, condition, predicate, timeout=None):
+        '''Waits until a predicate is true, as Condition.wait_for().
+
+        Args:
+          condition: threading.Condition, which must be held. It is notified
+            when the predicate may have changed.
+          predicate: Callable[[], Any], evaluated with the condition held.
+          timeout: Union[float, None], the time in seconds to wait, or None
+            to wait forever.
+
+        Returns:
+          Any, the last result of the predicate.'''
+        return condition.wait_for(predicate, timeout)
+
+    def start_thread(self, target, name):
+        '''Starts a daemon thread.
+
+        Args:
+          target: Callable[[], None], the thread function.
+          name: String, the thread name.
+
+        Returns:
+          threading.Thread'''
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def pipe(self):
+        '''Creates a one way connection, used to receive the results of calls.
+
+        Returns:
+          Tuple[Connection, Connection], the receiving and sending ends.'''
+        return multiprocessing.Pipe(False)
+
+    def queue(self):
+        '''Creates a queue for messages from tasks to the TaskManager.
+
+        Returns:
+          multiprocessing.Queue'''
+        return multiprocessing.Queue()
+
+
+# The clock in use.
+_clock = Clock()
+
+
+def get_clock():
+    '''Returns the clock in use.
+
+    Returns:
+      Clock'''
+    return _clock
+
+
+def set_clock(new_clock):
+    '''Replaces the clock in use.
+
+    This must be done before any tasks are started.
+
+    Args:
+      new_clock: Clock
+
+    Returns:
+      Clock, the previous clock.'''
+    global _clock
+    previous, _clock = _clock, new_clock
+    return previous
+
+
+def monotonic():
+    '''Returns the current time in seconds, see Clock.monotonic().'''
+    return _clock.monotonic()
+
+
+def sleep(seconds):
+    '''Waits for a time, see Clock.sleep().'''
+    _clock.sleep(seconds)
+
+
+def wait_for(condition, predicate, timeout=None):
+    '''Waits until a predicate is true, see Clock.wait_for().'''
+    return _clock.wait_for(condition, predicate, timeout)
+
+
+def start_thread(target, name):
+    '''Starts a daemon thread, see Clock.start_thread().'''
+    return _clock.start_thread(target, name)
+
+
+def pipe():
+    '''Creates a one way connection, see Clock.pipe().'''
+    return _clock.pipe()
+
+
+def queue():
+    '''Creates a queue for messages to the TaskManager, see Clock.queue().'''
+    return _clock.queue()
@@ -0,0 +1,260 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''A compact binary encoding for messages sent over the task bus.
+
+Messages are encoded as a small fixed header followed by the arguments.
+The header identifies the message by an integer ID rather than by name,
+which allows the TaskManager to route an encoded message without decoding
+its arguments.
+
+Common argument types (None, bool, int, float, str, lists of floats and
+dicts of int to float) use fixed struct layouts. numpy float scalars are
+encoded as floats. Any other argument is pickled.
+
+Several encoded messages can be sent as one batch, which is a header
+followed by the length prefixed messages.'''
+
+import numbers
+import pickle
+import struct
+import zlib
+
+
+# The first byte of every encoded message. Pickled data always starts with
+# the PROTO opcode (0x80), so these values can be used to tell the two apart.
+MAGIC = 0xa7
+# Used instead of MAGIC when the header is followed by trace details.
+MAGIC_TRACED = 0xa8
+# The first byte of a batch of encoded messages.
+MAGIC_BATCH = 0xa9
+
+# Header: magic, message ID, argument count.
+HEADER = struct.Struct('<BIB')
+# Trace details: sender pid, sequence number.
+TRACE = struct.Struct('<iI')
+# Batch header: magic, message count.
+BATCH_HEADER = struct.Struct('<BI')
+
+# Argument type tags.
+TAG_NONE = b'N'
+TAG_TRUE = b'T'
+TAG_FALSE = b'F'
+TAG_INT = b'i'
+TAG_FLOAT = b'd'
+TAG_STR = b's'
+TAG_FLOAT_LIST = b'l'
+TAG_INT_FLOAT_DICT = b'm'
+TAG_PICKLE = b'p'
+
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+LENGTH = struct.Struct('<I')
+INT_FLOAT = struct.Struct('<qd')
+
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+
+def message_id(name):
+    '''Returns the integer ID used for a message name.
+
+    Args:
+      name: String, the message name.
+
+    IDs are derived from the name so tasks can encode messages without
+    first asking the TaskManager. The TaskManager checks for collisions when
+    names are interned at bind time.'''
+    return zlib.crc32(name.encode('utf-8')) & 0xffffffff
+
+
+def is_encoded(data):
+    '''Returns True if the bytes were produced by encode().'''
+    return len(data) >= HEADER.size and data[0] in (MAGIC, MAGIC_TRACED)
+
+
+def peek_id(data):
+    '''Returns the message ID of encoded bytes without decoding the args.'''
+    return HEADER.unpack_from(data)[1]
+
+
+def peek_trace(data):
+    '''Returns the trace details of encoded bytes, or None.'''
+    if data[0] != MAGIC_TRACED:
+        return None
+    return TRACE.unpack_from(data, HEADER.size)
+
+
+def encode(name, args, trace=None):
+    '''Encodes a message.
+
+    Args:
+      name: String, the message name.
+      args: Tuple[Any], the message arguments.
+      trace: Union[Tuple[int, int], None], the sender pid and sequence
+        number, used when tracing.
+
+    Returns:
+      bytes, the encoded message.'''
+    if len(args) > 0xff:
+        raise ValueError('Too many arguments for {}'.format(name))
+    if trace is None:
+        parts = [HEADER.pack(MAGIC, message_id(name), len(args))]
+    else:
+        parts = [HEADER.pack(MAGIC_TRACED, message_id(name), len(args)),
+                 TRACE.pack(*trace)]
+    for arg in args:
+        _encode_arg(arg, parts)
+    return b''.join(parts)
+
+
+def decode(data, names):
+    '''Decodes a message.
+
+    Args:
+      data: bytes, the encoded message.
+      names: Dict[int, String], message IDs and their names.
+
+    Returns:
+      Tuple[String, Tuple[Any], Union[Tuple[int, int], None]], the message
+      name, arguments and trace details.'''
+    magic, msg_id, count = HEADER.unpack_from(data)
+    offset = HEADER.size
+    trace = None
+    if magic == MAGIC_TRACED:
+        trace = TRACE.unpack_from(data, offset)
+        offset += TRACE.size
+    args = []
+    for _ in range(count):
+        arg, offset = _decode_arg(data, offset)
+        args.append(arg)
+    return names[msg_id], tuple(args), trace
+
+
+def is_batch(data):
+    '''Returns True if the bytes were produced by encode_batch().'''
+    return len(data) >= BATCH_HEADER.size and data[0] == MAGIC_BATCH
+
+
+def encode_batch(messages):
+    '''Encodes a batch of messages.
+
+    Args:
+      messages: Sequence[bytes], the messages from encode().
+
+    Returns:
+      bytes, the encoded batch.'''
+    parts = [BATCH_HEADER.pack(MAGIC_BATCH, len(messages))]
+    for data in messages:
+        parts += [LENGTH.pack(len(data)), data]
+    return b''.join(parts)
+
+
+def decode_batch(data):
+    '''Splits a batch into its messages.
+
+    Args:
+      data: bytes, the encoded batch.
+
+    Returns:
+      List[bytes], the messages, in the order they were batched.'''
+    _, count = BATCH_HEADER.unpack_from(data)
+    offset = BATCH_HEADER.size
+    messages = []
+    for _ in range(count):
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        messages.append(bytes(data[offset:offset + length]))
+        offset += length
+    return messages
+
+
+def _encode_arg(arg, parts):
+    '''Appends the encoding of a single argument to parts.'''
+    if arg is None:
+        parts.append(TAG_NONE)
+    elif arg is True:
+        parts.append(TAG_TRUE)
+    elif arg is False:
+        parts.append(TAG_FALSE)
+    elif type(arg) is int and INT_MIN <= arg <= INT_MAX:
+        parts += [TAG_INT, INT.pack(arg)]
+    elif _is_float(arg):
+        parts += [TAG_FLOAT, FLOAT.pack(float(arg))]
+    elif type(arg) is str:
+        data = arg.encode('utf-8')
+        parts += [TAG_STR, LENGTH.pack(len(data)), data]
+    elif type(arg) is list and all(_is_float(v) for v in arg):
+        parts += [TAG_FLOAT_LIST, LENGTH.pack(len(arg)),
+                  struct.pack('<{}d'.format(len(arg)),
+                              *[float(v) for v in arg])]
+    elif type(arg) is dict and all(
+            type(k) is int and INT_MIN <= k <= INT_MAX
+            and _is_float(v) for k, v in arg.items()):
+        # Dicts of label to confidence, as emitted by the engine.
+        parts += [TAG_INT_FLOAT_DICT, LENGTH.pack(len(arg))]
+        parts += [INT_FLOAT.pack(k, float(v)) for k, v in arg.items()]
+    else:
+        data = pickle.dumps(arg, pickle.HIGHEST_PROTOCOL)
+        parts += [TAG_PICKLE, LENGTH.pack(len(data)), data]
+
+
+def _is_float(value):
+    '''Returns True for a float, including numpy's float scalars.
+
+    numpy.float64 subclasses float but numpy.float32 does not, so floats are
+    found as real numbers that are not integers. They are decoded as
+    floats.'''
+    return (isinstance(value, numbers.Real) and
+            not isinstance(value, numbers.Integral))
+
+
+def _decode_arg(data, offset):
+    '''Decodes a single argument.
+
+    Returns:
+      Tuple[Any, int], the argument and the offset of the next one.'''
+    tag = data[offset:offset+1]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_TRUE:
+        return True, offset
+    elif tag == TAG_FALSE:
+        return False, offset
+    elif tag == TAG_INT:
+        return INT.unpack_from(data, offset)[0], offset + INT.size
+    elif tag == TAG_FLOAT:
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+
+    # The remaining types are all length prefixed.
+    length, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    if tag == TAG_STR:
+        end = offset + length
+        return bytes(data[offset:end]).decode('utf-8'), end
+    elif tag == TAG_FLOAT_LIST:
+        values = struct.unpack_from('<{}d'.format(length), data, offset)
+        return list(values), offset + length * FLOAT.size
+    elif tag == TAG_INT_FLOAT_DICT:
+        result = {}
+        for _ in range(length):
+            k, v = INT_FLOAT.unpack_from(data, offset)
+            result[k] = v
+            offset += INT_FLOAT.size
+        return result, offset
+    elif tag == TAG_PICKLE:
+        end = offset + length
+        return pickle.loads(data[offset:end]), end
+    raise ValueError('Unknown argument tag {!r}'.format(tag))
@@ -0,0 +1,182 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+
+log = logging.getLogger('embedding_cache')
+
+# An index record: the frame digest, chunk number and row in the chunk.
+INDEX_RECORD = struct.Struct('<16sII')
+
+INDEX_FILE = 'index'
+META_FILE = 'meta.json'
+CHUNK_FILE = 'chunk-{:05d}.f32'
+
+
+def model_hash(path):
+    '''Returns a hash of a model file's contents.
+
+    Args:
+      path: String
+
+    Returns:
+      String, the hex digest.'''
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def frame_hash(frame):
+    '''Returns a hash of a frame's shape and pixels.
+
+    Args:
+      frame: numpy.array
+
+    Returns:
+      bytes, the 16 byte digest.'''
+    digest = hashlib.md5(str(frame.shape).encode())
+    digest.update(np.ascontiguousarray(frame).data)
+    return digest.digest()
+
+
+class EmbeddingCache(object):
+    '''A persistent cache of the embeddings for frames.
+
+    The cache for each model is a directory named by the model's hash. The
+    embeddings are stored as float32 rows in fixed size chunk files, which
+    are memory mapped, so cached embeddings are read without copying. An
+    append-only index maps frame hashes to rows.
+
+    A row is written before its index record, and the index is flushed after
+    each record, so a run that stops part way leaves a valid cache that the
+    next run continues to fill. Only one process should write to a cache at
+    a time.'''
+
+    def __init__(self, directory, model_key, chunk_size=4096):
+        '''Constructor.
+
+        Args:
+          directory: String, the directory of the caches for all models.
+          model_key: String, identifies the model, such as model_hash().
+          chunk_size: int, the number of rows in each chunk file, used when
+            the cache is created.'''
+        self.path = os.path.join(directory, model_key)
+        os.makedirs(self.path, exist_ok=True)
+        self.output_size = None
+        self.chunk_size = chunk_size
+        meta_path = os.path.join(self.path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.output_size = meta['output_size']
+            self.chunk_size = meta['chunk_size']
+
+        # A Map[bytes, Tuple[int, int]] of frame digests to chunk and row.
+        self.index = {}
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            # Ignore a partly written last record.
+            end = len(data) - len(data) % INDEX_RECORD.size
+            for digest, chunk, row in INDEX_RECORD.iter_unpack(data[:end]):
+                self.index[digest] = (chunk, row)
+            if end != len(data):
+                with open(index_path, 'r+b') as f:
+                    f.truncate(end)
+        self.count = len(self.index)
+        self.index_file = open(index_path, 'ab')
+        self.chunks = {}
+        self.hits = 0
+        self.misses = 0
+        log.info('%d cached embeddings in %s', self.count, self.path)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, digest):
+        '''Returns a cached embedding.
+
+        Args:
+          digest: bytes, from frame_hash().
+
+        Returns:
+          Union[numpy.array, None], a read only view of the embedding, or
+          None if it is not cached.'''
+        location = self.index.get(digest)
+        if location is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        chunk, row = location
+        return self._get_chunk(chunk)[row]
+
+    def put(self, digest, emb):
+        '''Adds an embedding, if it is not already cached.
+
+        Args:
+          digest: bytes, from frame_hash().
+          emb: numpy.array, the embedding.
+
+        Raises:
+          ValueError: The embedding does not have the cache's size.'''
+        if digest in self.index:
+            return
+        if self.output_size is None:
+            self.output_size = len(emb)
+            with open(os.path.join(self.path, META_FILE), 'w') as f:
+                json.dump(dict(output_size=self.output_size,
+                               chunk_size=self.chunk_size), f)
+        elif len(emb) != self.output_size:
+            raise ValueError('Embedding size {} is not {}'.format(
+                len(emb), self.output_size))
+
+        chunk, row = divmod(self.count, self.chunk_size)
+        self._get_chunk(chunk, writable=True)[row] = emb
+        self.index_file.write(INDEX_RECORD.pack(digest, chunk, row))
+        self.index_file.flush()
+        self.index[digest] = (chunk, row)
+        self.count += 1
+
+    def close(self):
+        '''Flushes and closes the cache files.'''
+        for chunk in self.chunks.values():
+            if chunk.mode != 'r':
+                chunk.flush()
+        self.chunks = {}
+        self.index_file.close()
+
+    def _get_chunk(self, number, writable=False):
+        '''Returns a chunk, memory mapping it if needed.'''
+        chunk = self.chunks.get(number)
+        if chunk is not None and (chunk.mode != 'r' or not writable):
+            return chunk
+        path = os.path.join(self.path, CHUNK_FILE.format(number))
+        if writable:
+            mode = 'r+' if os.path.exists(path) else 'w+'
+        else:
+            mode = 'r'
+        chunk = np.memmap(path, dtype=np.float32, mode=mode,
+                          shape=(self.chunk_size, self.output_size))
+        self.chunks[number] = chunk
+        return chunk
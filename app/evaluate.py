@@ -0,0 +1,414 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Evaluates the engine parameters offline, with recorded sessions.
+
+Sessions are recorded on a unit with alto.py --record DIR. The sessions are
+replayed in the order they were recorded: learning sessions add to the store,
+resets clear it, and the frames of classifying sessions are matched with the
+store as it was at that time.
+
+The embeddings for all frames are computed once, and kept in an
+EmbeddingCache so that later runs on the same recordings skip inference.
+Then each combination of k_nearest_neighbors, maxlen and projection is
+replayed in a process pool, and every combination of confidence and
+responsiveness is scored with the results. The time taken to match each
+frame is reported, so that projections can be compared with full width
+matching for both accuracy and speed.
+
+The true label of a classifying session is None, meaning nothing should
+match, unless it is given in a JSON truth file. The file maps session names
+to either a label, or a list of [frame, label] pairs for the frames where the
+true label changes.'''
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, frame_hash
+import inference_pool
+from knn_store import KNNStore
+from match_filter import MatchFilter
+import recording
+
+
+# A session prepared for replay. truth is a List[Any] with the true label
+# of each frame of a classifying session.
+Replay = collections.namedtuple('Replay', [
+    'kind', 'label', 'embeddings', 'sources', 'truth'])
+
+# The metrics reported for each setting.
+METRICS = ('accuracy', 'false_match_rate', 'latency', 'missed', 'flips')
+
+
+def compute_embeddings(sessions, backends, cache=None):
+    '''Runs inference once on every recorded frame.
+
+    Inference is only started if there are frames that are not cached, and
+    new embeddings are added to the cache as they are computed.
+
+    Args:
+      sessions: List[recording.Session]
+      backends: List[Union[inference_pool.EdgeTpuBackend,
+        inference_pool.CpuBackend]], shared with an InferencePool if there
+        is more than one.
+      cache: Union[EmbeddingCache, None], the cache for the backends' key().
+
+    Returns:
+      Dict[String, numpy.array], the session names and their embeddings.
+
+    Raises:
+      ValueError: The frames do not fit the model's input.'''
+    inference = None
+
+    def take(embeddings, digests, timeout=None):
+        while inference.pending():
+            result = inference.get(timeout)
+            if result is None:
+                return
+            index, emb = result
+            embeddings[index] = emb
+            if cache is not None:
+                cache.put(digests[index], emb)
+
+    try:
+        results = {}
+        for session in sessions:
+            frames = session.frames
+            if not len(frames):
+                # Resets, and learning sessions whose frames were all
+                # rejected, have nothing to infer.
+                results[session.name] = np.empty((0, 0), dtype=np.float32)
+                continue
+            digests = [frame_hash(frame) for frame in frames]
+            embeddings = [None] * len(frames)
+            if cache is not None:
+                embeddings = [cache.get(digest) for digest in digests]
+            missing = [index for index, emb in enumerate(embeddings)
+                       if emb is None]
+
+            if missing and inference is None:
+                if len(backends) > 1:
+                    inference = inference_pool.InferencePool(backends)
+                else:
+                    inference = inference_pool.LocalInference(backends[0])
+            if missing:
+                width, height = inference.input_size
+                if frames.shape[1:] != (height, width, 3):
+                    raise ValueError('Session {} has frames of {}'.format(
+                        session.name, frames.shape[1:]))
+            for index in missing:
+                inference.submit(
+                    np.ascontiguousarray(frames[index]).ravel(), index)
+                take(embeddings, digests, 0)
+            if missing:
+                take(embeddings, digests)
+
+            results[session.name] = np.array(
+                embeddings, dtype=np.float32).reshape(len(frames), -1)
+            logging.info('%s: %d frames, %d inferred', session.name,
+                         len(frames), len(missing))
+        return results
+    finally:
+        if inference is not None:
+            inference.close()
+
+
+def get_truth(session, truth):
+    '''Returns the true label of each frame of a session.
+
+    Args:
+      session: recording.Session
+      truth: Dict[String, Any], the contents of the truth file.
+
+    Returns:
+      List[Any]'''
+    value = truth.get(session.name, session.label)
+    if not isinstance(value, list):
+        return [value] * len(session.frames)
+    labels = [None] * len(session.frames)
+    for (start, label), (end, _) in zip(
+            value, value[1:] + [[len(labels), None]]):
+        labels[start:end] = [label] * (end - start)
+    return labels
+
+
+def parse_projection(spec):
+    '''Parses a projection given as METHOD:DIMS, or 'none'.
+
+    Returns:
+      Dict[String, Any], the KNNStore projection arguments.'''
+    if spec == 'none':
+        return {}
+    method, _, dims = spec.partition(':')
+    return dict(projection=method, dims=int(dims or 128))
+
+
+def replay_confidences(replays, k_nearest_neighbors, maxlen, projection=''):
+    '''Replays the sessions through a store.
+
+    Refits of the projection run when the store changes rather than in the
+    background, so that replays are repeatable.
+
+    Args:
+      replays: List[Replay]
+      k_nearest_neighbors: int
+      maxlen: int
+      projection: String, see parse_projection().
+
+    Returns:
+      Tuple[List[List[Dict[Any, float]]], float], the confidences for every
+      frame of each classifying session, and the mean time in seconds to
+      get the confidences for a frame.'''
+    store = KNNStore(k_nearest_neighbors, maxlen, background=False,
+                     **parse_projection(projection or 'none'))
+    results = []
+    query_time = 0
+    queries = 0
+    for replay in replays:
+        if replay.kind == recording.RESET:
+            store.clear()
+        elif replay.kind == recording.LEARNING:
+            for emb in replay.embeddings:
+                store.add_embedding(replay.label, emb)
+        elif replay.kind == recording.CLASSIFYING:
+            start_time = time.perf_counter()
+            results.append([store.get_confidences(emb)
+                            for emb in replay.embeddings])
+            query_time += time.perf_counter() - start_time
+            queries += len(replay.embeddings)
+    return results, query_time / max(1, queries)
+
+
+def score(replays, confidences, confidence, responsiveness):
+    '''Scores the matches for one setting.
+
+    Each source has its own MatchFilter, as when classifying on a unit. The
+    latency is the number of frames after the true label changes until the
+    match is correct, averaged over the changes where it became correct.
+
+    Args:
+      replays: List[Replay]
+      confidences: List[List[Dict[Any, float]]], from replay_confidences().
+      confidence: float, the MatchFilter confidence threshold.
+      responsiveness: float, the MatchFilter weight.
+
+    Returns:
+      Dict[String, float], the METRICS.'''
+    counts = collections.Counter()
+    classifying = [replay for replay in replays
+                   if replay.kind == recording.CLASSIFYING]
+    for replay, session_confidences in zip(classifying, confidences):
+        filters = {}
+        # The frame the true label changed at, for each source, while the
+        # match is not yet correct.
+        changed_at = {}
+        last_truth = {}
+        for index, (source, true_label, frame_confidences) in enumerate(
+                zip(replay.sources, replay.truth, session_confidences)):
+            if source not in filters:
+                filters[source] = MatchFilter(responsiveness, confidence)
+            match_filter = filters[source]
+            if match_filter.update(frame_confidences):
+                counts['flips'] += 1
+
+            if source not in last_truth or last_truth[source] != true_label:
+                if source in changed_at:
+                    counts['missed'] += 1
+                last_truth[source] = true_label
+                changed_at[source] = index
+                counts['changes'] += 1
+            if match_filter.label == true_label:
+                counts['correct'] += 1
+                if source in changed_at:
+                    # Count latency in this source's frames.
+                    counts['latency'] += int(np.count_nonzero(
+                        replay.sources[changed_at.pop(source):index] ==
+                        source))
+            elif match_filter.label is not None:
+                counts['false_matches'] += 1
+            counts['frames'] += 1
+        counts['missed'] += len(changed_at)
+
+    frames = max(1, counts['frames'])
+    found = counts['changes'] - counts['missed']
+    return dict(
+        accuracy=counts['correct'] / frames,
+        false_match_rate=counts['false_matches'] / frames,
+        latency=counts['latency'] / found if found else float('nan'),
+        missed=counts['missed'],
+        flips=counts['flips'])
+
+
+# The replays and grid, set in each worker process by _init_worker().
+_replays = None
+_grid = None
+
+
+def _init_worker(replays, grid):
+    global _replays, _grid
+    _replays = replays
+    _grid = grid
+
+
+def _evaluate_store(store_args):
+    '''Scores every confidence and responsiveness for one store setting.'''
+    k_nearest_neighbors, maxlen, projection = store_args
+    confidences, query_time = replay_confidences(
+        _replays, k_nearest_neighbors, maxlen, projection)
+    results = []
+    for confidence, responsiveness in _grid:
+        setting = dict(confidence=confidence, responsiveness=responsiveness,
+                       k_nearest_neighbors=k_nearest_neighbors, maxlen=maxlen,
+                       projection=projection, query_ms=1000 * query_time)
+        setting.update(score(_replays, confidences, confidence,
+                             responsiveness))
+        results.append(setting)
+    return results
+
+
+def sweep(replays, confidences, responsivenesses, knns, maxlens,
+          projections=('none',), processes=None):
+    '''Evaluates every combination of the parameters.
+
+    Args:
+      replays: List[Replay]
+      confidences: List[float]
+      responsivenesses: List[float]
+      knns: List[int], the k_nearest_neighbors values.
+      maxlens: List[int]
+      projections: List[String], see parse_projection().
+      processes: Union[int, None], the size of the process pool, or None for
+        the number of CPUs.
+
+    Returns:
+      List[Dict[String, Any]], the parameters, METRICS and query_ms for
+      each combination.'''
+    grid = list(itertools.product(confidences, responsivenesses))
+    store_args = list(itertools.product(knns, maxlens, projections))
+    with multiprocessing.Pool(processes, _init_worker,
+                              (replays, grid)) as pool:
+        return [result
+                for results in pool.imap_unordered(_evaluate_store, store_args)
+                for result in results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='''
+Sweeps the engine parameters over recorded sessions and reports accuracy,
+false-match rate, match latency in frames and flip count.''')
+    parser.add_argument("directory",
+            help='''
+The directory the sessions were recorded in.''')
+    parser.add_argument("--truth", metavar="FILE",
+            help='''
+A JSON file of the true labels of classifying sessions.''')
+    parser.add_argument("--confidence", type=float, nargs='+',
+            default=[0.7, 0.75, 0.8, 0.85, 0.9])
+    parser.add_argument("--responsiveness", type=float, nargs='+',
+            default=[0.1, 0.2, 0.3, 0.5])
+    parser.add_argument("--knn", type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument("--maxlen", type=int, nargs='+',
+            default=[100, 1000])
+    parser.add_argument("--projection", nargs='+', default=['none'],
+            help='''
+The projections to match with, as METHOD:DIMS where METHOD is pca or random,
+or none for full width matching.''')
+    parser.add_argument("--processes", type=int,
+            help='''
+The number of processes to sweep with, defaults to the number of CPUs.''')
+    parser.add_argument("--accelerators", type=int,
+            help='''
+The number of Edge TPUs to compute embeddings with, defaults to all.''')
+    parser.add_argument("--cpu", type=int, metavar="WORKERS",
+            help='''
+Computes embeddings with CPU stand-ins rather than Edge TPUs, to try the
+harness without an accelerator.''')
+    parser.add_argument("--model",
+            default='mobilenet_quant_v1_224_headless_edgetpu.tflite')
+    parser.add_argument("--cache", metavar="DIR",
+            help='''
+The embedding cache directory, defaults to embedding_cache in the recording
+directory. Use --no-cache to always run inference.''')
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--top", type=int, default=20,
+            help='''
+The number of settings to print, best first.''')
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    sessions = recording.list_sessions(args.directory)
+    truth = {}
+    if args.truth:
+        with open(args.truth) as f:
+            truth = json.load(f)
+
+    if args.cpu:
+        width, height = next(
+            (session.frames.shape[2], session.frames.shape[1])
+            for session in sessions if len(session.frames))
+        backends = inference_pool.create_backends(
+            cpu_workers=args.cpu, input_size=(width, height))
+    else:
+        backends = inference_pool.create_backends(args.model)
+        backends = backends[:args.accelerators]
+    cache = None
+    if not args.no_cache:
+        cache = EmbeddingCache(
+            args.cache or os.path.join(args.directory, 'embedding_cache'),
+            backends[0].key())
+    try:
+        embeddings = compute_embeddings(sessions, backends, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    replays = [Replay(session.kind, session.label, embeddings[session.name],
+                      session.sources, get_truth(session, truth))
+               for session in sessions]
+    results = sweep(replays, args.confidence, args.responsiveness, args.knn,
+                    args.maxlen, args.projection, args.processes)
+    results.sort(key=lambda result: (
+        -result['accuracy'], result['false_match_rate'], result['flips']))
+
+    columns = ('projection', 'confidence', 'responsiveness',
+               'k_nearest_neighbors', 'maxlen') + METRICS + ('query_ms',)
+    headings = ('projection', 'confidence', 'responsive', 'knn', 'maxlen',
+                'accuracy', 'false', 'latency', 'missed', 'flips', 'query_ms')
+    print(' '.join('{:>10}'.format(heading) for heading in headings))
+    for result in results[:args.top]:
+        print(' '.join(
+            '{:>10}'.format(result[column]) if column == 'projection' else
+            '{:>10.4g}'.format(result[column]) for column in columns))
+
+    if len(args.projection) > 1:
+        # Compare the best setting for each projection.
+        print()
+        for projection in args.projection:
+            best = next(result for result in results
+                        if result['projection'] == projection)
+            print('{}: best accuracy {:.4g}, false-match rate {:.4g}, '
+                  '{:.4g}ms per match'.format(
+                      projection, best['accuracy'],
+                      best['false_match_rate'], best['query_ms']))
@@ -0,0 +1,124 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import numpy as np
+
+
+class FrameInput(object):
+    '''Prepares captured frames as the input tensor for inference.
+
+    Frames are captured into a buffer that is allocated once. If the capture
+    has the same size as the input tensor and there is no region of interest
+    then the input tensor is a view of that buffer, and no pixels are copied.
+
+    Otherwise the region of interest is sampled with a strided view of the
+    capture and copied into an input buffer that is also allocated once. The
+    region is either cropped to fill the input tensor, or letterboxed to fit
+    inside it. Sampling uses a whole number step, so only downscaling is
+    supported.'''
+
+    # picamera pads unencoded captures to these multiples.
+    PAD_WIDTH = 32
+    PAD_HEIGHT = 16
+
+    def __init__(self, input_size, capture_size=None, roi=None,
+                 letterbox=False):
+        '''Constructor.
+
+        Args:
+          input_size: Tuple[int, int], the input tensor (width, height).
+          capture_size: Union[Tuple[int, int], None], the capture (width,
+            height), defaults to the input_size.
+          roi: Union[Tuple[int, int, int, int], None], the region of interest
+            as (x, y, width, height) in capture pixels, defaults to the whole
+            capture.
+          letterbox: bool, True to fit the whole region inside the input
+            tensor, False to crop the region to fill it.
+
+        Raises:
+          ValueError: The region is outside the capture, or smaller than the
+            input tensor.'''
+        self.input_size = tuple(input_size)
+        self.capture_size = tuple(capture_size or input_size)
+        width, height = self.capture_size
+
+        # The buffer the camera writes into, and the view of its pixels.
+        self.buffer = np.zeros((
+            int(math.ceil(height / self.PAD_HEIGHT)) * self.PAD_HEIGHT,
+            int(math.ceil(width / self.PAD_WIDTH)) * self.PAD_WIDTH,
+            3), dtype=np.uint8)
+        self.capture = self.buffer[:height, :width]
+
+        if roi is None:
+            roi = (0, 0, width, height)
+        x, y, roi_width, roi_height = roi
+        if x < 0 or y < 0 or x + roi_width > width or y + roi_height > height:
+            raise ValueError('ROI {} is outside the capture {}'.format(
+                roi, self.capture_size))
+
+        in_width, in_height = self.input_size
+        if (roi_width, roi_height) == self.input_size and (
+                self.buffer.shape[:2] == (in_height, in_width)):
+            # Use the capture buffer directly.
+            self.view = None
+            self.input = self.buffer
+        else:
+            self.view, offset = self._get_view(
+                x, y, roi_width, roi_height, letterbox)
+            self.input = np.zeros((in_height, in_width, 3), dtype=np.uint8)
+            top, left = offset
+            view_height, view_width = self.view.shape[:2]
+            self.target = self.input[
+                top:top+view_height, left:left+view_width]
+
+        # The input is contiguous, so this is a view rather than a copy.
+        self.flat = self.input.ravel()
+
+    def tensor(self):
+        '''Returns the current frame as a flat input tensor.
+
+        Returns:
+          numpy.array, a view that is overwritten by the next frame.'''
+        if self.view is not None:
+            np.copyto(self.target, self.view)
+        return self.flat
+
+    def _get_view(self, x, y, roi_width, roi_height, letterbox):
+        '''Returns a strided view of the region and its offset in the input.
+
+        Returns:
+          Tuple[numpy.array, Tuple[int, int]], the view and (top, left).'''
+        in_width, in_height = self.input_size
+        if letterbox:
+            # The smallest step that fits the whole region.
+            step = max(int(math.ceil(roi_width / in_width)),
+                       int(math.ceil(roi_height / in_height)))
+        else:
+            # The largest step that fills the input.
+            step = min(roi_width // in_width, roi_height // in_height)
+        if step < 1:
+            raise ValueError('ROI is smaller than the input {}'.format(
+                self.input_size))
+
+        # Centre the sampled area within the region.
+        width = min(in_width, roi_width // step)
+        height = min(in_height, roi_height // step)
+        x += (roi_width - width * step) // 2
+        y += (roi_height - height * step) // 2
+        view = self.capture[y:y+height*step:step, x:x+width*step:step]
+
+        # Centre the view within the input.
+        return view, ((in_height - height) // 2, (in_width - width) // 2)
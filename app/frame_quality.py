@@ -0,0 +1,107 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+import numpy as np
+
+
+class FrameQualityGate(object):
+    '''Rejects frames that are motion blurred or badly exposed.
+
+    The checks use a luminance image sampled from every step'th pixel of the
+    frame, so they cost far less than an inference. The buffers they use are
+    allocated on the first frame and then reused.
+
+    Sharpness is the variance of the Laplacian of the luminance, which is low
+    when there are no sharp edges. Exposure is checked with the fraction of
+    pixels at the dark and bright ends of the histogram.'''
+
+    def __init__(self, min_sharpness=None, max_dark=None, max_bright=None,
+                 step=4, dark_level=16, bright_level=240):
+        '''Constructor.
+
+        Args:
+          min_sharpness: Union[float, None], the minimum Laplacian variance,
+            or None to skip the check.
+          max_dark: Union[float, None], the maximum fraction (0-1) of pixels
+            below dark_level, or None to skip the check.
+          max_bright: Union[float, None], the maximum fraction (0-1) of pixels
+            above bright_level, or None to skip the check.
+          step: int, the sampling step in pixels.
+          dark_level: int, the luminance (0-255) counted as dark.
+          bright_level: int, the luminance (0-255) counted as bright.'''
+        self.min_sharpness = min_sharpness
+        self.max_dark = max_dark
+        self.max_bright = max_bright
+        self.step = step
+        self.dark_level = dark_level
+        self.bright_level = bright_level
+        # A Counter of 'accepted' and each reason for rejecting frames.
+        self.counts = collections.Counter()
+        self.luma = None
+        self.laplacian = None
+
+    def reset(self):
+        '''Resets the counts, to start a new session.'''
+        self.counts = collections.Counter()
+
+    def check(self, frame):
+        '''Checks the quality of a frame.
+
+        Args:
+          frame: numpy.array, a uint8 RGB image.
+
+        Returns:
+          Union[String, None], the reason for rejecting the frame, or None if
+          it is acceptable.'''
+        reason = self._get_reason(frame)
+        self.counts[reason or 'accepted'] += 1
+        return reason
+
+    def _get_reason(self, frame):
+        '''Returns the reason for rejecting a frame, or None.'''
+        view = frame[::self.step, ::self.step]
+        if self.luma is None or self.luma.shape != view.shape[:2]:
+            self.luma = np.empty(view.shape[:2], dtype=np.float32)
+            self.laplacian = np.empty(
+                (view.shape[0] - 2, view.shape[1] - 2), dtype=np.float32)
+        luma = self.luma
+
+        # ITU-R BT.601 luminance.
+        np.multiply(view[..., 0], 0.299, out=luma, casting='unsafe')
+        luma += view[..., 1] * np.float32(0.587)
+        luma += view[..., 2] * np.float32(0.114)
+
+        if self.max_dark is not None:
+            dark = np.count_nonzero(luma < self.dark_level) / luma.size
+            if dark > self.max_dark:
+                return 'dark'
+        if self.max_bright is not None:
+            bright = np.count_nonzero(luma > self.bright_level) / luma.size
+            if bright > self.max_bright:
+                return 'bright'
+
+        if self.min_sharpness is not None:
+            # A 4-neighbour Laplacian over the interior pixels.
+            laplacian = self.laplacian
+            np.multiply(luma[1:-1, 1:-1], 4, out=laplacian)
+            laplacian -= luma[:-2, 1:-1]
+            laplacian -= luma[2:, 1:-1]
+            laplacian -= luma[1:-1, :-2]
+            laplacian -= luma[1:-1, 2:]
+            if laplacian.var() < self.min_sharpness:
+                return 'blurred'
+
+        return None
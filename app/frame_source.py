@@ -0,0 +1,91 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from frame_input import FrameInput
+
+
+log = logging.getLogger('frame_source')
+
+
+class PiCameraSource(object):
+    '''A source of frames from an RPi camera.
+
+    Frames are streamed from the camera's video port into the FrameInput's
+    buffer. The camera is opened and closed on demand.'''
+
+    def __init__(self, input_size, camera_num=0, capture_size=None, roi=None,
+                 letterbox=False, framerate=8, rotation=180):
+        '''Constructor.
+
+        Args:
+          input_size: Tuple[int, int], the input tensor (width, height).
+          camera_num: int, the camera to use, on boards with more than one.
+          capture_size: Union[Tuple[int, int], None], the camera resolution,
+            defaults to the input tensor size.
+          roi: Union[Tuple[int, int, int, int], None], the region of interest
+            within the capture, see FrameInput.
+          letterbox: bool, True to letterbox rather than crop the region.
+          framerate: float, the camera frame rate.
+          rotation: int, the camera rotation in degrees.'''
+        self.input = FrameInput(input_size, capture_size, roi, letterbox)
+        self.camera_num = camera_num
+        self.framerate = framerate
+        self.rotation = rotation
+        self.camera = None
+        self.frames = None
+
+    def open(self):
+        '''Opens the camera if it is not open.'''
+        if self.camera is None:
+            # picamera is only needed by the engine task.
+            import picamera
+
+            cam = self.camera = picamera.PiCamera(camera_num=self.camera_num)
+            cam.resolution = self.input.capture_size
+            cam.framerate = self.framerate
+            cam.rotation = self.rotation
+            # This setting helps reduce motion blur.
+            cam.exposure_mode = 'sports'
+            log.info('camera %d opened', self.camera_num)
+
+    def capture(self):
+        '''Waits for the next frame.
+
+        Returns:
+          numpy.array, the flat input tensor, which is overwritten by the next
+          frame.'''
+        if self.frames is None:
+            # Use capture_continuous and the video port to stream camera data
+            # into a numpy array.
+            self.open()
+            self.frames = self.camera.capture_continuous(
+                self.input.buffer, format='rgb', use_video_port=True)
+        next(self.frames)
+        return self.input.tensor()
+
+    def stop(self):
+        '''Stops streaming frames.'''
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
+    def close(self):
+        '''Closes the camera if it is open.'''
+        self.stop()
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+            log.info('camera %d closed', self.camera_num)
@@ -0,0 +1,103 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import time
+
+
+class FrameRateGovernor(object):
+    '''Chooses the classifying frame rate from the activity in the scene.
+
+    The rate jumps to max_fps whenever the match changes, or a filtered
+    confidence is within margin of the confidence threshold, as a decision
+    may be about to be made. Once the scene has been stable for stable_time
+    the rate backs off by a factor of decay per frame, down to min_fps.
+
+    The time spent in each mode and the rates chosen are recorded.'''
+
+    # Modes
+    ACTIVE = 'active'
+    BACKING_OFF = 'backing_off'
+    STABLE = 'stable'
+
+    def __init__(self, min_fps=8, max_fps=8, margin=0.1, stable_time=3,
+                 decay=0.8):
+        '''Constructor.
+
+        Args:
+          min_fps: float, the frame rate once the scene is stable.
+          max_fps: float, the frame rate while the scene is active.
+          margin: float, how close a filtered confidence must be to the
+            threshold for the scene to be considered active.
+          stable_time: float, the time in seconds without activity before
+            the rate starts to back off.
+          decay: float, the factor (0-1) applied to the rate each frame while
+            backing off.'''
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        self.margin = margin
+        self.stable_time = stable_time
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        '''Starts a new session at max_fps.'''
+        now = time.monotonic()
+        self.fps = self.max_fps
+        self.mode = self.ACTIVE
+        self.active_at = now
+        self.updated_at = now
+        # Seconds spent in each mode.
+        self.mode_time = collections.Counter()
+        # Frames processed at each rate, rounded to 0.1fps.
+        self.rates = collections.Counter()
+
+    def update(self, outputs, confidence, changed):
+        '''Updates the rate after a frame has been processed.
+
+        Args:
+          outputs: Iterable[float], the filtered confidences.
+          confidence: float, the confidence threshold.
+          changed: bool, True if the match changed on this frame.
+
+        Returns:
+          float, the time in seconds from the start of this frame to the
+          start of the next.'''
+        now = time.monotonic()
+        self.mode_time[self.mode] += now - self.updated_at
+        self.updated_at = now
+
+        if changed or any(abs(output - confidence) < self.margin
+                          for output in outputs):
+            self.active_at = now
+        if now - self.active_at < self.stable_time:
+            self.fps = self.max_fps
+        else:
+            self.fps = max(self.min_fps, self.fps * self.decay)
+
+        if self.fps >= self.max_fps:
+            self.mode = self.ACTIVE
+        elif self.fps <= self.min_fps:
+            self.mode = self.STABLE
+        else:
+            self.mode = self.BACKING_OFF
+        self.rates[round(self.fps, 1)] += 1
+        return 1 / self.fps
+
+    def report(self):
+        '''Returns the time in each mode and the rates chosen.
+
+        Returns:
+          Dict[String, Dict[Any, float]]'''
+        return dict(mode_time=dict(self.mode_time), rates=dict(self.rates))
@@ -14,11 +14,20 @@
 
 import collections
 import logging
+import os
+import threading
+import time
 
 from edgetpu.basic import basic_engine
-import numpy as np
-import picamera
 
+from frame_quality import FrameQualityGate
+from frame_source import PiCameraSource
+from governor import FrameRateGovernor
+import inference_pool
+from knn_store import KNNStore
+from match_filter import MatchFilter, InfiniteImpulseResponseFilter  # noqa
+import recording
+import snapshot
 import task
 
 
@@ -28,18 +37,51 @@ log = logging.getLogger('imprint_engine')
 class ImprintEngineTask(task.Task):
     '''Handles learning and classifying using machine learning.
 
-    While learning or classifying the RPi camera is used to capture frames.
-    These are then processed with the engine.
+    While learning or classifying, frames are captured from one or more
+    sources, which are RPi cameras. These are then processed with the engine,
+    which is shared by all the sources. Sources are served in a weighted
+    round robin.
+
+    With more than one accelerator, inference runs in an InferencePool and
+    frames are captured while earlier frames are being processed. Results are
+    handled in the order the frames were captured.
+
+    While classifying, each source has its own MatchFilter and
+    FrameRateGovernor, and results are tagged with the index of the source.
+    The frame rate and the time each source waits to be served are logged
+    when classifying stops. The cameras are closed after being idle for
+    camera_idle_time.
 
     Binds to:
       Engine.idle()
-      Engine.start_learning(label: Any)
+      Engine.start_learning(label: Any, source: Union[int, None])
       Engine.start_classifying()
       Engine.reset()
+      Engine.export(path: Union[String, None], dtype: String) -> int
+      Engine.import(path: Union[String, None], merge: bool, dedup: float)
+        -> Dict[Any, int]
+      Engine.memory_usage() -> Dict[String, Any]
+      Engine.stats() -> Dict[String, Any]
 
     Emits:
-      Engine.confidences(donfidences: Dict[Any, float])
-      Engine.matched(label: Union[Any, None])'''
+      Engine.confidences(donfidences: Dict[Any, float], source: int)
+      Engine.matched(label: Union[Any, None], source: int)
+      Engine.ready(timings: Dict[String, float])
+
+    The model is loaded when the task runs rather than in the constructor,
+    so that it loads while the other tasks are starting. Messages are
+    handled once it has loaded and a first inference has been run, except
+    for idle, start_learning, start_classifying and reset.
+
+    Those change the state, and are handled on a listener thread as soon as
+    they arrive, even while a frame is being captured or processed. They
+    request the change, which the main loop makes once the current frame is
+    done. The time taken to make each change is logged.
+
+    The store can be exported to and imported from snapshot files, to copy
+    learning between units. If snapshot_path is set then the snapshot is
+    imported at startup, and exported after every learning session or reset,
+    so that learning survives a restart.'''
 
     # States
     IDLE = 0
@@ -60,8 +102,54 @@ class ImprintEngineTask(task.Task):
     # likely to match any label, resulting in greater sensitivity.
     confidence = 0.8
 
-    def __init__(self, task_args, confidence=None, responsiveness=None):
+    def __init__(self, task_args, confidence=None, responsiveness=None,
+                 sources=None, shared_store=True, quality=None,
+                 frame_rate=None, camera_idle_time=None, accelerators=1,
+                 record_dir=None, snapshot_path=None, projection=None,
+                 memory_budget=None, scoring=None):
+        '''Constructor.
+
+        Args:
+          confidence: Union[float, None], overrides the confidence.
+          responsiveness: Union[float, None], overrides the iir_weight.
+          sources: Union[List[Dict[String, Any]], None], the PiCameraSource
+            arguments for each source, plus an optional 'weight' for the round
+            robin. Defaults to a single camera.
+          shared_store: bool, True if all sources learn and match against
+            the same labels, False to keep the labels of each source apart.
+          quality: Union[Dict[String, Any], None], the FrameQualityGate
+            arguments used to reject frames while learning, or None to store
+            every frame.
+          frame_rate: Union[Dict[String, Any], None], the FrameRateGovernor
+            arguments, or None for a fixed rate.
+          camera_idle_time: Union[float, None], the time in seconds to wait
+            while idle before closing the cameras, or None to keep them
+            open.
+          accelerators: Union[int, None], the number of Edge TPUs to use, or
+            None for all that are connected.
+          record_dir: Union[String, None], a directory to record the frames
+            of each session in, for evaluate.py, or None.
+          snapshot_path: Union[String, None], the snapshot file to keep the
+            store in, or None.
+          projection: Union[Dict[String, Any], None], the KNNStore projection
+            arguments, or None to match with full width embeddings.
+          memory_budget: Union[Dict[String, Any], None], the KNNStore
+            max_bytes and eviction arguments, or None for no budget.
+          scoring: Union[Dict[String, Any], None], the KNNStore workers and
+            parallel_rows arguments, or None to score in a single thread.'''
         super().__init__(task_args)
+        self.source_config = sources or [{}]
+        self.shared_store = shared_store
+        self.quality = FrameQualityGate(**quality) if quality else None
+        self.frame_rate = frame_rate or {}
+        self.camera_idle_time = camera_idle_time
+        self.accelerators = accelerators
+        self.recorder = (recording.SessionRecorder(record_dir)
+                         if record_dir else None)
+        self.snapshot_path = snapshot_path
+        self.projection = projection or {}
+        self.memory_budget = memory_budget or {}
+        self.scoring = scoring or {}
 
         # Use confidence and responsiveness if specified.
         if confidence is not None:
@@ -70,207 +158,559 @@ class ImprintEngineTask(task.Task):
             self.iir_weight = responsiveness
 
         self.state = self.IDLE
+        # The requests are made on the listener thread, the lock guards them.
+        self.state_lock = threading.Lock()
         self.requested_state_change = None
+        self.requested_at = None
+        self.reset_requested = False
         self.label = None # Used when start_learning is called.
-
-        self.engine = KNNEmbeddingEngine(self.model_path)
-        self.shape = self._get_shape()
+        self.learning_source = None
+        # The count, total and maximum times in seconds to change state.
+        self.transitions = 0
+        self.total_transition_time = 0
+        self.max_transition_time = 0
+
+        # A Map[int, Set[Any]] of source indexes and their labels in the
+        # store, used when the store is not shared.
+        self.source_labels = collections.defaultdict(set)
+
+        # Set in run().
+        self.inference = None
+        self.model_key = None
+        self.store = None
+        self.streams = []
+        self.sources_open = False
+        self.sources_timer = None
 
         self.bind('Engine.idle', self.idle)
         self.bind('Engine.start_learning', self.start_learning)
         self.bind('Engine.start_classifying', self.start_classifying)
         self.bind('Engine.reset', self.reset)
+        self.bind('Engine.export', self.export_snapshot)
+        self.bind('Engine.import', self.import_snapshot)
+        self.bind('Engine.memory_usage', self.memory_usage)
+        self.bind('Engine.stats', self.stats)
 
     def run(self):
         '''The task's main loop.
 
         Processes messages and handles state changes.'''
-        with picamera.PiCamera() as cam:
-            # Directly capture at the input tensor resolution.
-            cam.resolution = self.shape
-            # This frame rate works well on an RPi zero.
-            cam.framerate = 8
-            # The camera is installed upside down.
-            cam.rotation = 180
-            # This setting helps reduce motion blur.
-            cam.exposure_mode = 'sports'
-
+        # Acknowledge state changes while the model loads.
+        self.start_listener(['Engine.idle', 'Engine.start_learning',
+                             'Engine.start_classifying', 'Engine.reset'])
+        timings = {}
+        start_time = time.monotonic()
+
+        backends = inference_pool.create_backends(self.model_path)
+        backends = backends[:self.accelerators]
+        if len(backends) > 1:
+            self.inference = inference_pool.InferencePool(backends)
+        else:
+            self.inference = inference_pool.LocalInference(backends[0])
+        self.model_key = backends[0].key()
+        self.store = KNNStore(**dict(self.projection, **self.memory_budget,
+                                     **self.scoring))
+        for idx, config in enumerate(self.source_config):
+            config = dict(config)
+            weight = config.pop('weight', 1)
+            governor = FrameRateGovernor(**self.frame_rate)
+            # Frames are captured at the highest rate and the governor
+            # chooses how many of them to process.
+            config.setdefault('framerate', governor.max_fps)
+            self.streams.append(Stream(
+                idx, PiCameraSource(self.inference.input_size, **config),
+                weight, governor))
+        timings['model_load'] = time.monotonic() - start_time
+
+        # The first inference is slower as the model is transferred to the
+        # TPU, so run it now rather than on the first frame. The pool sends
+        # one frame to each accelerator.
+        start_time = time.monotonic()
+        for _ in backends:
+            self.inference.submit(self.streams[0].source.input.tensor())
+        for _ in self._take_results():
+            pass
+        timings['first_inference'] = time.monotonic() - start_time
+
+        # Open the cameras at startup so that any problems are found early.
+        start_time = time.monotonic()
+        self._open_sources()
+        timings['camera_open'] = time.monotonic() - start_time
+
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            start_time = time.monotonic()
+            # The store is empty, so keep every embedding.
+            self.import_snapshot(dedup=None)
+            timings['snapshot_import'] = time.monotonic() - start_time
+        for phase, duration in timings.items():
+            log.info('%s took %.3fs', phase, duration)
+        self.emit('Engine.ready', timings)
+
+        try:
             # Use a top level dispatch to avoid unbound nesting of calls.
             while True:
                 if self.requested_state_change is not None:
                     # Jump to the most recent requested state.
-                    self.state = self.requested_state_change
-                    self.requested_state_change = None
+                    self._change_state()
 
                 if self.state == self.LEARNING:
-                    self._run_learning(cam, self.label)
+                    self._open_sources()
+                    self._run_learning(self.label, self.learning_source)
                 elif self.state == self.CLASSIFYING:
-                    self._run_classifying(cam)
-                elif not self.process_messages(batch=True):
-                    break
+                    self._open_sources()
+                    self._run_classifying()
+                else:
+                    if (self.sources_open and not self.sources_timer and
+                            self.camera_idle_time is not None):
+                        self.sources_timer = self.call_later(
+                            self.camera_idle_time, self._close_sources)
+                    if not self.process_messages(batch=True):
+                        break
+        finally:
+            self._close_sources()
+            self.inference.close()
 
     def idle(self):
         '''Stops learning / classifying.'''
-        self.requested_state_change = self.IDLE
+        with self.state_lock:
+            self._request_state(self.IDLE)
 
-    def start_learning(self, label):
+    def start_learning(self, label, source=None):
         '''Starts learning for the given label.
 
         Args:
           label: Any
+          source: Union[int, None], the index of the source to learn from, or
+            None for all of them.
 
         If there is already learning data for the given label then it is
         augmented with the new data.'''
-        self.requested_state_change = self.LEARNING
-        self.label = label
+        with self.state_lock:
+            self._request_state(self.LEARNING)
+            self.label = label
+            self.learning_source = source
 
     def start_classifying(self):
         '''Starts classifying images from the camera.'''
-        self.requested_state_change = self.CLASSIFYING
+        with self.state_lock:
+            self._request_state(self.CLASSIFYING)
 
     def reset(self):
-        '''Stops learning / classifying and resets all learning data.'''
-        self.state = self.IDLE
-        self.label = None
-        self.engine.clear()
+        '''Stops learning / classifying and resets all learning data.
 
-    def _get_shape(self):
-        '''Returns the input tensor shape as (width, height).'''
-        input_tensor_shape = self.engine.get_input_tensor_shape()
-        return (input_tensor_shape[2], input_tensor_shape[1])
+        The data is reset by the main loop before it starts any session that
+        is requested after this.'''
+        with self.state_lock:
+            self._request_state(self.IDLE)
+            self.label = None
+            self.reset_requested = True
 
-    def _get_emb(self, image):
-        '''Returns the embedding vector for the given image.
+    def memory_usage(self):
+        '''Returns the memory used by the store, see KNNStore.memory_usage().
+
+        Returns:
+          Dict[String, Any]'''
+        return self.store.memory_usage()
+
+    def stats(self):
+        '''Returns statistics for classifying and the store.
+
+        Returns:
+          Dict[String, Any], the state, and for each source the frame rate
+          and filtered confidence of each label while classifying, and the
+          memory used by the store, see KNNStore.memory_usage().'''
+        sources = []
+        for stream in self.streams:
+            if self.state == self.CLASSIFYING:
+                sources.append(dict(index=stream.index, fps=stream.fps(),
+                                    confidences=stream.matcher.confidences()))
+            else:
+                sources.append(dict(index=stream.index, fps=0, confidences={}))
+        return dict(state=self.state, sources=sources,
+                    store=self.store.memory_usage())
+
+    def export_snapshot(self, path=None, dtype=snapshot.FLOAT16):
+        '''Exports the store to a snapshot file.
 
         Args:
-          image: numpy.array, a uint8 RGB image with the correct shape.'''
-        return self.engine.RunInference(image.flatten())[1].copy()
+          path: Union[String, None], the file, defaults to snapshot_path.
+          dtype: String, snapshot.FLOAT16 or snapshot.INT8.
 
-    def _run_learning(self, cam, label):
-        '''Performs a learning loop until the state changes.
+        Returns:
+          Union[int, None], the number of embeddings exported, or None on
+          failure.'''
+        path = path or self.snapshot_path
+        try:
+            count = snapshot.export_store(
+                path, self.store, self.model_key, self.inference.output_size,
+                dtype)
+        except (OSError, ValueError):
+            log.exception('failed to export %s', path)
+            return None
+        log.info('exported %d embeddings to %s', count, path)
+        return count
+
+    def import_snapshot(self, path=None, merge=True, dedup=0.999):
+        '''Imports a snapshot file into the store.
 
         Args:
-          cam: The RPi camera.
-          label: Any, the label to use for the new data.'''
-        log.info('learning started')
-        # Use capture_continuous and the video port to stream camera data
-        # into a numpy array.
-        output = np.empty((self.shape[0], self.shape[1], 3), dtype=np.uint8)
-        gen = cam.capture_continuous(output, format='rgb', use_video_port=True)
-        for idx, _ in enumerate(gen):
-            # Store this new embedding.
-            self.engine.add_embedding(label, self._get_emb(output))
-            # Process messages for a state change.
-            if not self.process_messages(block=False):
-                return
-            if self.requested_state_change is not None:
-                break
-        log.info('learning stopped')
+          path: Union[String, None], the file, defaults to snapshot_path.
+          merge: bool, True to merge with the stored embeddings, False to
+            replace them.
+          dedup: Union[float, None], see KNNStore.merge().
 
-    def _run_classifying(self, cam):
-        '''Performs a classifying loop until the state changes.
+        Returns:
+          Union[Dict[Any, int], None], the number of embeddings added for
+          each label, or None on failure.'''
+        path = path or self.snapshot_path
+        try:
+            added = snapshot.import_store(
+                path, self.store, self.model_key, merge, dedup)
+        except (OSError, ValueError):
+            log.exception('failed to import %s', path)
+            return None
+        if not merge:
+            self.source_labels.clear()
+        for label in self.store.embedding_map:
+            # The labels of a store that is not shared are (source, label).
+            if not self.shared_store and isinstance(label, tuple):
+                self.source_labels[label[0]].add(label)
+        log.info('imported %s from %s', added, path)
+        return added
+
+    def _request_state(self, state):
+        '''Requests a state change, called with the state_lock held.'''
+        if self.requested_state_change is None:
+            self.requested_at = time.monotonic()
+        self.requested_state_change = state
+
+    def _change_state(self):
+        '''Makes the requested state change, on the main thread.'''
+        with self.state_lock:
+            self.state = self.requested_state_change
+            self.requested_state_change = None
+            reset, self.reset_requested = self.reset_requested, False
+            requested_at = self.requested_at
+        if reset:
+            self.source_labels.clear()
+            self.store.clear()
+            if self.recorder:
+                self.recorder.start(recording.RESET)
+                self.recorder.stop()
+            if self.snapshot_path:
+                self.export_snapshot()
+
+        duration = time.monotonic() - requested_at
+        self.transitions += 1
+        self.total_transition_time += duration
+        self.max_transition_time = max(self.max_transition_time, duration)
+        log.info('state %d after %.1fms (mean %.1fms, max %.1fms)',
+                 self.state, 1000 * duration,
+                 1000 * self.total_transition_time / self.transitions,
+                 1000 * self.max_transition_time)
+
+    def _open_sources(self):
+        '''Opens all the sources.'''
+        if self.sources_timer:
+            self.sources_timer.cancel()
+            self.sources_timer = None
+        for stream in self.streams:
+            stream.source.open()
+        self.sources_open = True
+
+    def _close_sources(self):
+        '''Closes all the sources.'''
+        self.sources_timer = None
+        for stream in self.streams:
+            stream.source.close()
+        self.sources_open = False
+
+    def _get_store_label(self, stream, label):
+        '''Returns the label used in the store for a source's label.'''
+        if self.shared_store:
+            return label
+        self.source_labels[stream.index].add((stream.index, label))
+        return (stream.index, label)
+
+    def _get_confidences(self, stream, emb):
+        '''Returns the confidences for a source's embedding.'''
+        if self.shared_store:
+            return self.store.get_confidences(emb)
+        confidences = self.store.get_confidences(
+            emb, self.source_labels[stream.index])
+        return {label: confidence
+                for (_, label), confidence in confidences.items()}
+
+    def _next_stream(self, streams):
+        '''Chooses the next stream to serve using a weighted round robin.
 
         Args:
-          cam: The RPi camera.'''
-        log.info('classifying started')
+          streams: List[Stream], the streams to choose from.
 
-        # Maintain a map of labels to IIR filtered confidences.
-        self.results = collections.defaultdict(
-            lambda: InfiniteImpulseResponseFilter(self.iir_weight))
-
-        # Track the label emitted with Engine.matched.
-        current_label = None
-
-        # Use capture_continuous and the video port to stream camera data
-        # into a numpy array.
-        output = np.empty((self.shape[0], self.shape[1], 3), dtype=np.uint8)
-        gen = cam.capture_continuous(output, format='rgb', use_video_port=True)
-        for _ in gen:
-            # Use the engine to assess confidences.
-            confidences = self.engine.get_confidences(self._get_emb(output))
-            self.emit('Engine.confidences', confidences)
-            log.debug('confidences = %s', confidences)
-
-            # Update the filters.
-            for label, confidence in confidences.items():
-                self.results[label].update(confidence)
-
-            # Find the label with the greatest confidence.
-            match_label, iir = max(
-                self.results.items(),
-                key=lambda item: item[1].output)
-
-            # If the confidence is not great enough then the match is None.
-            if iir.output < self.confidence:
-                match_label = None
-
-            # If the match is different then emit the change.
-            if match_label != current_label:
-                current_label = match_label
-                self.emit('Engine.matched', current_label)
-
-                # Apply some hysteresis after every change, by resetting
-                # the IIR filters either high (for the current label) or low.
-                for label, iir in self.results.items():
-                    iir.reset(1 if label == current_label else 0)
-
-            # Process messages for a state change.
-            if not self.process_messages(block=False):
+        Returns:
+          Union[Stream, None], a stream that is due, or None if none are.'''
+        now = time.monotonic()
+        due = [stream for stream in streams if stream.due_at <= now]
+        if not due:
+            return None
+
+        # A smooth weighted round robin. Every due stream earns credit in
+        # proportion to its weight, the stream with the most is chosen and
+        # pays for its turn.
+        for stream in due:
+            stream.credit += stream.weight
+        chosen = max(due, key=lambda stream: stream.credit)
+        chosen.credit -= sum(stream.weight for stream in due)
+        return chosen
+
+    def _take_results(self, timeout=None):
+        '''Yields the pending inference results in order.
+
+        Args:
+          timeout: Union[float, None], the maximum time in seconds to wait for
+            each result, or None to wait for all of them.
+
+        Returns:
+          Iterator[Tuple[Any, numpy.array]], the tags and embeddings.'''
+        while self.inference.pending():
+            result = self.inference.get(timeout)
+            if result is None:
                 return
-            if self.requested_state_change is not None:
-                break
+            yield result
 
-        # If there is a current_label then emit the change to None.
-        if current_label is not None:
-            self.emit('Engine.matched', None)
+    def _run_learning(self, label, source=None):
+        '''Performs a learning loop until the state changes.
 
+        Args:
+          label: Any, the label to use for the new data.
+          source: Union[int, None], the source to learn from, or None for
+            all of them.'''
+        log.info('learning started')
+        if self.quality:
+            self.quality.reset()
+
+        streams = [stream for stream in self.streams
+                   if source is None or stream.index == source]
+        if not streams:
+            log.warning('no source %s to learn from', source)
+            self.state = self.IDLE
+            return
+        for stream in streams:
+            # Learning is not paced, so every stream is always due.
+            stream.start(self.iir_weight, self.confidence)
+        if self.recorder:
+            self.recorder.start(recording.LEARNING, label)
+
+        try:
+            while True:
+                stream = self._next_stream(streams)
+                tensor = stream.source.capture()
+                # Drop a frame captured after a state change was requested,
+                # as it may no longer show the label.
+                if self.requested_state_change is not None:
+                    break
+                # Skip inference for frames that are blurred or badly exposed.
+                if not (self.quality and
+                        self.quality.check(stream.source.input.input)):
+                    self.inference.submit(tensor, stream)
+                    if self.recorder:
+                        self.recorder.add(stream.source.input.input,
+                                          stream.index)
+                # Store the new embeddings.
+                for tag, emb in self._take_results(0):
+                    self.store.add_embedding(
+                        self._get_store_label(tag, label), emb)
+                # Process any other messages.
+                if not self.process_messages(block=False):
+                    return
+                if self.requested_state_change is not None:
+                    break
+        finally:
+            for stream in streams:
+                stream.source.stop()
+            if self.recorder:
+                self.recorder.stop()
+
+        # Store the embeddings for frames captured before the change.
+        for tag, emb in self._take_results():
+            self.store.add_embedding(self._get_store_label(tag, label), emb)
+        if self.quality:
+            log.info('learning frame quality %s', dict(self.quality.counts))
+        if self.snapshot_path:
+            self.export_snapshot()
+        log.info('learning stopped')
+
+    def _run_classifying(self):
+        '''Performs a classifying loop until the state changes.'''
+        log.info('classifying started')
+        for stream in self.streams:
+            stream.start(self.iir_weight, self.confidence)
+        if self.recorder:
+            self.recorder.start(recording.CLASSIFYING)
+
+        try:
+            while self.requested_state_change is None:
+                stream = None
+                if self.inference.ready():
+                    stream = self._next_stream(self.streams)
+
+                if stream is not None:
+                    frame_time = time.monotonic()
+                    tensor = stream.source.capture()
+                    # Drop a frame captured after a state change was
+                    # requested.
+                    if self.requested_state_change is not None:
+                        break
+                    stream.served(frame_time)
+                    self.inference.submit(tensor, (stream, frame_time))
+                    if self.recorder:
+                        self.recorder.add(stream.source.input.input,
+                                          stream.index)
+                    # Until the result arrives, assume the rate is unchanged.
+                    stream.due_at = frame_time + 1 / stream.governor.fps
+                    for tag, emb in self._take_results(0):
+                        self._classify(tag, emb)
+                elif self.inference.pending():
+                    tag, emb = self.inference.get()
+                    self._classify(tag, emb)
+                else:
+                    # Process messages until the next frame is due, stopping
+                    # early for a state change.
+                    wake_at = min(other.due_at for other in self.streams)
+                    if not self.process_messages(
+                            max(0, wake_at - time.monotonic()), batch=True):
+                        return
+                    continue
+
+                # Process any other messages.
+                if not self.process_messages(block=False):
+                    return
+        finally:
+            for stream in self.streams:
+                stream.source.stop()
+            if self.recorder:
+                self.recorder.stop()
+            # Discard the results for frames captured before the change.
+            for _ in self._take_results():
+                pass
+
+        for stream in self.streams:
+            # If there is a current label then emit the change to None.
+            if stream.matcher.label is not None:
+                self.emit('Engine.matched', None, stream.index)
+            log.info('classifying source %d %s', stream.index,
+                     stream.report())
         log.info('classifying stopped')
 
+    def _classify(self, tag, emb):
+        '''Handles the embedding for a frame while classifying.
+
+        Args:
+          tag: Tuple[Stream, float], the stream and the time it was served.
+          emb: numpy.array, the embedding.'''
+        stream, frame_time = tag
 
-class InfiniteImpulseResponseFilter(object):
-    '''Filters an input over time.
+        # Use the store to assess confidences.
+        confidences = self._get_confidences(stream, emb)
+        self.emit('Engine.confidences', confidences, stream.index)
+        log.debug('confidences %d = %s', stream.index, confidences)
 
-    With every update the output is set to a portion (weight) of the current
-    input value, combined with a portion (1-weight) of the previous output.'''
+        # If the match is different then emit the change.
+        changed = stream.matcher.update(confidences)
+        if changed:
+            self.emit('Engine.matched', stream.matcher.label, stream.index)
 
-    def __init__(self, weight, value=0):
+        stream.due_at = frame_time + stream.governor.update(
+            stream.matcher.outputs(), self.confidence, changed)
+
+
+class Stream(object):
+    '''The state of a frame source while learning or classifying.'''
+
+    def __init__(self, index, source, weight, governor):
         '''Constructor.
 
         Args:
-          weight: float, the weight (0-1) to give new inputs.
-          value: float, the initial value.'''
+          index: int, the source index, used to tag results.
+          source: PiCameraSource, the source of frames.
+          weight: float, the source's share of the round robin.
+          governor: FrameRateGovernor, sets the source's frame rate.'''
+        self.index = index
+        self.source = source
         self.weight = weight
-        self.output = value
+        self.governor = governor
+        self.matcher = None
+        # Used by the round robin.
+        self.credit = 0
+        # The time the next frame is due.
+        self.due_at = 0
+        self.started_at = 0
+        self.frames = 0
+        self.total_delay = 0
+        self.max_delay = 0
+
+    def start(self, iir_weight, confidence):
+        '''Resets the stream's state, for a new session.
 
-    def update(self, input):
-        '''Updates the output.
+        Args:
+          iir_weight: float, the MatchFilter weight.
+          confidence: float, the MatchFilter confidence threshold.'''
+        self.matcher = MatchFilter(iir_weight, confidence)
+        self.governor.reset()
+        self.credit = 0
+        self.started_at = self.due_at = time.monotonic()
+        self.frames = 0
+        self.total_delay = 0
+        self.max_delay = 0
+
+    def served(self, now):
+        '''Records that the stream is being served.
 
         Args:
-          input: float, the current input.'''
-        self.output *= (1 - self.weight)
-        self.output += input * self.weight
+          now: float, the time.monotonic() time.'''
+        delay = max(0, now - self.due_at)
+        self.frames += 1
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
 
-    def reset(self, value=0):
-        '''Resets the output.
+    def fps(self):
+        '''Returns the frame rate since the session started.
 
-        Args:
-          value: float, the new output.'''
-        self.output = value
+        Returns:
+          float'''
+        elapsed = time.monotonic() - self.started_at
+        return self.frames / elapsed if elapsed else 0
+
+    def report(self):
+        '''Returns the frame rate and delays in serving the stream.
+
+        Returns:
+          Dict[String, Any]'''
+        return dict(
+            fps=self.fps(),
+            delay_mean_ms=1000 * self.total_delay / max(1, self.frames),
+            delay_max_ms=1000 * self.max_delay,
+            governor=self.governor.report())
 
 
 class EmbeddingEngine(basic_engine.BasicEngine):
     '''Engine used to obtain embeddings from headless mobilenets.'''
 
-    def __init__(self, model_path):
+    def __init__(self, model_path, device_path=None):
         '''Creates a EmbeddingEngine with given model.
 
         Args:
           model_path: str, path to a TF-Lite Flatbuffer file.
+          device_path: Union[str, None], the Edge TPU to use, or None for the
+            first available.
 
         Raises:
           ValueError: The model output is invalid.
         '''
-        super().__init__(model_path)
+        if device_path is None:
+            super().__init__(model_path)
+        else:
+            super().__init__(model_path, device_path)
         output_tensors_sizes = self.get_all_output_tensors_sizes()
         if output_tensors_sizes.size != 1:
             raise ValueError((
@@ -278,7 +718,7 @@ class EmbeddingEngine(basic_engine.BasicEngine):
                 'This model has {}.'.format(output_tensors_sizes.size)))
 
 
-class KNNEmbeddingEngine(EmbeddingEngine):
+class KNNEmbeddingEngine(EmbeddingEngine, KNNStore):
     '''Extends embedding engine to provide kNearest Neighbor detection.
 
     This class maintains an in-memory store of embeddings and provides a
@@ -298,59 +738,5 @@ class KNNEmbeddingEngine(EmbeddingEngine):
         Raises:
             ValueError: The model output is invalid.
         '''
-        super().__init__(model_path)
-        self.embedding_map = collections.defaultdict(list)
-        self.knn = k_nearest_neighbors
-        self.maxlen = maxlen
-
-    def clear(self):
-        '''Clear the store: forgets all stored embeddings.'''
-        self.embedding_map = collections.defaultdict(list)
-
-    def add_embedding(self, label, emb):
-        '''Add an embedding vector to the store.'''
-        # Normalize the vector.
-        normal = emb / np.sqrt((emb**2).sum())
-
-        # Add to store, under label.
-        embeddings = self.embedding_map[label]
-        embeddings.append(normal)
-
-        # Discard if maxlen is exceeded.
-        if len(embeddings) > self.maxlen:
-            self.embedding_map[label] = embeddings[-self.maxlen:]
-
-    def get_confidences(self, query_emb):
-        '''Returns the match confidences for a query embedding.
-
-        Args:
-          query_emb: The embedding vector to match against.
-
-        Returns:
-          Dict[Any, float], a mapping of labels to match confidences.'''
-        # Normalize the query embedding.
-        query_emb = query_emb/np.sqrt((query_emb**2).sum())
-
-        # Build up a dictionary of results, one for each label.
-        results = {}
-
-        for label, embeds in self.embedding_map.items():
-            # Perform a matrix multiplication to get the cosine distance
-            # from the stored embeddings. This distance is the confidence.
-            dists = np.matmul(embeds, query_emb)
-
-            if len(dists) <= self.knn:
-                # Use all the confidences as the nearest neighbors.
-                k_largest = dists
-            else:
-                # Use just the knn biggest confidences.
-
-                # Partition performs a partial sort, making sure the index
-                # (-self.knn) is correct and everything after is bigger.
-                # This is cheaper than a full sort.
-                k_largest = np.partition(dists, -self.knn)[-self.knn:]
-
-            # The confidence for this label is the average of k_largest.
-            results[label] = np.average(k_largest)
-
-        return results
+        EmbeddingEngine.__init__(self, model_path)
+        KNNStore.__init__(self, k_nearest_neighbors, maxlen)
@@ -0,0 +1,448 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import itertools
+import logging
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+from embedding_cache import model_hash
+
+
+log = logging.getLogger('inference_pool')
+
+
+class EdgeTpuBackend(object):
+    '''Runs inference on an Edge TPU.'''
+
+    def __init__(self, model_path, device_path=None):
+        '''Constructor.
+
+        Args:
+          model_path: String, path to a TF-Lite Flatbuffer file.
+          device_path: Union[String, None], the Edge TPU to use, or None for
+            the first available.'''
+        self.model_path = model_path
+        self.device_path = device_path
+        self.engine = None
+        self.input_size = None
+        self.output_size = None
+        self.output = None
+
+    def open(self):
+        '''Loads the model onto the Edge TPU.
+
+        Raises:
+          ValueError: The model output is invalid.'''
+        # The engine is only needed where inference runs.
+        import imprint_engine
+
+        if self.device_path is None:
+            self.engine = imprint_engine.EmbeddingEngine(self.model_path)
+        else:
+            self.engine = imprint_engine.EmbeddingEngine(
+                self.model_path, self.device_path)
+        shape = self.engine.get_input_tensor_shape()
+        self.input_size = (int(shape[2]), int(shape[1]))
+        self.output_size = int(self.engine.get_all_output_tensors_sizes()[0])
+        # Outputs are copied into this buffer rather than a new array.
+        self.output = np.empty(self.output_size, dtype=np.float32)
+
+    def infer(self, tensor):
+        '''Returns the output for a flat uint8 input tensor.
+
+        The output is a buffer that is overwritten by the next call.'''
+        np.copyto(self.output, self.engine.RunInference(tensor)[1])
+        return self.output
+
+    def key(self):
+        '''Returns a key that identifies the outputs, for EmbeddingCache.'''
+        return 'edgetpu-' + model_hash(self.model_path)
+
+
+class CpuBackend(object):
+    '''A deterministic stand-in for an accelerator, using the CPU.
+
+    The output is a fixed random projection of a sample of the input, so equal
+    inputs give equal outputs. The projection is real CPU work, and latency
+    adds a wait that uses no CPU, like waiting for an accelerator.'''
+
+    def __init__(self, input_size=(224, 224), output_size=1024, step=16,
+                 latency=0, seed=0):
+        '''Constructor.
+
+        Args:
+          input_size: Tuple[int, int], the input tensor (width, height).
+          output_size: int, the size of the output.
+          step: int, every step'th input value is projected.
+          latency: float, the extra time in seconds each inference waits.
+          seed: int, the seed for the projection.'''
+        self.input_size = tuple(input_size)
+        self.output_size = output_size
+        self.step = step
+        self.latency = latency
+        self.seed = seed
+        self.weights = None
+
+    def open(self):
+        '''Creates the projection.'''
+        width, height = self.input_size
+        count = len(range(0, width * height * 3, self.step))
+        rng = np.random.RandomState(self.seed)
+        self.weights = rng.standard_normal(
+            (count, self.output_size)).astype(np.float32)
+
+    def infer(self, tensor):
+        '''Returns the output for a flat uint8 input tensor.'''
+        output = np.dot(tensor[::self.step].astype(np.float32), self.weights)
+        if self.latency:
+            time.sleep(self.latency)
+        return np.maximum(output, 0, out=output)
+
+    def key(self):
+        '''Returns a key that identifies the outputs, for EmbeddingCache.'''
+        return 'cpu-{}x{}-{}-{}-{}'.format(
+            self.input_size[0], self.input_size[1], self.output_size,
+            self.step, self.seed)
+
+
+def list_edgetpus():
+    '''Returns the paths of the connected Edge TPUs.
+
+    Returns:
+      List[Union[String, None]], the device paths, or [None] if they can not
+      be listed.'''
+    from edgetpu.basic import edgetpu_utils
+
+    # Listing devices needs a newer edgetpu library.
+    if not hasattr(edgetpu_utils, 'ListEdgeTpuPaths'):
+        return [None]
+    return list(edgetpu_utils.ListEdgeTpuPaths(
+        edgetpu_utils.EDGE_TPU_STATE_NONE)) or [None]
+
+
+def create_backends(model_path=None, cpu_workers=0, **cpu_args):
+    '''Creates backends for the accelerators, or for CPU stand-ins.
+
+    Args:
+      model_path: Union[String, None], the model to load on every Edge TPU.
+      cpu_workers: int, the number of CPU stand-ins, used instead of the Edge
+        TPUs if greater than 0.
+      cpu_args: The CpuBackend arguments.
+
+    Returns:
+      List[Union[EdgeTpuBackend, CpuBackend]]'''
+    if cpu_workers:
+        return [CpuBackend(**cpu_args) for _ in range(cpu_workers)]
+    return [EdgeTpuBackend(model_path, path) for path in list_edgetpus()]
+
+
+class LocalInference(object):
+    '''Runs inference on one backend in this process.
+
+    This has the same interface as InferencePool, but inference runs when a
+    tensor is submitted, so at most one result is pending.'''
+
+    def __init__(self, backend):
+        '''Constructor.
+
+        Args:
+          backend: Union[EdgeTpuBackend, CpuBackend], opened here.'''
+        self.backend = backend
+        backend.open()
+        self.input_size = backend.input_size
+        self.output_size = backend.output_size
+        self.result = None
+
+    def ready(self):
+        '''Returns True if another tensor can be submitted.'''
+        return self.result is None
+
+    def pending(self):
+        '''Returns the number of results that have not been taken.'''
+        return 0 if self.result is None else 1
+
+    def submit(self, tensor, tag=None):
+        '''Runs inference on a tensor.
+
+        Args:
+          tensor: numpy.array, a flat uint8 input tensor.
+          tag: Any, returned with the result.'''
+        self.result = (tag, self.backend.infer(tensor))
+
+    def get(self, timeout=None):
+        '''Returns the pending result.
+
+        Returns:
+          Tuple[Any, numpy.array], the tag and output.'''
+        result, self.result = self.result, None
+        return result
+
+    def close(self):
+        '''Does nothing, the backend is closed with this process.'''
+        pass
+
+
+class InferencePool(object):
+    '''Runs inference on several backends, each in a worker process.
+
+    Tensors are sent to the worker with the fewest tensors in flight. Results
+    are returned in the order the tensors were submitted, so that results for
+    a stream of frames can be filtered in order.'''
+
+    def __init__(self, backends, depth=2):
+        '''Constructor.
+
+        Opens the backends and waits for them to be ready.
+
+        Args:
+          backends: List[Union[EdgeTpuBackend, CpuBackend]], opened in the
+            workers.
+          depth: int, the maximum number of tensors in flight per worker.
+
+        Raises:
+          Exception: A backend failed to open.'''
+        self.depth = depth
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for index, backend in enumerate(backends):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_run_worker, name='InferenceWorker{}'.format(index),
+                args=(index, backend, worker_connection, self.results),
+                daemon=True)
+            process.start()
+            self.workers.append(_Worker(process, connection))
+
+        # Each worker reports the sizes once its backend is open.
+        sizes = set()
+        for _ in self.workers:
+            _, _, result = self.results.get()
+            if isinstance(result, Exception):
+                self.close()
+                raise result
+            sizes.add(result)
+        if len(sizes) != 1:
+            self.close()
+            raise ValueError('Backends have different sizes {}'.format(sizes))
+        self.input_size, self.output_size = sizes.pop()
+
+        self.seq = itertools.count()
+        self.next_seq = 0
+        # A Map[int, Tuple[Any, numpy.array]] of results that have arrived
+        # before the results submitted ahead of them.
+        self.reorder = {}
+        self.tags = {}
+        log.info('%d inference workers started', len(self.workers))
+
+    def ready(self):
+        '''Returns True if a worker can take another tensor.'''
+        return any(worker.in_flight < self.depth for worker in self.workers)
+
+    def pending(self):
+        '''Returns the number of results that have not been taken.'''
+        return len(self.tags)
+
+    def submit(self, tensor, tag=None):
+        '''Sends a tensor to the least busy worker.
+
+        Waits for a result if all workers are busy.
+
+        Args:
+          tensor: numpy.array, a flat uint8 input tensor, which is copied.
+          tag: Any, returned with the result.'''
+        while not self.ready():
+            self._collect()
+        worker = min(self.workers,
+                     key=lambda worker: (worker.in_flight, worker.sent))
+        seq = next(self.seq)
+        self.tags[seq] = tag
+        worker.connection.send((seq, tensor))
+        worker.in_flight += 1
+        worker.sent += 1
+
+    def get(self, timeout=None):
+        '''Returns the oldest pending result.
+
+        Args:
+          timeout: Union[float, None], the maximum time in seconds to wait,
+            or None to wait forever.
+
+        Returns:
+          Union[Tuple[Any, numpy.array], None], the tag and output, or None
+          if the timeout expired or nothing is pending.
+
+        Raises:
+          Exception: Inference failed in a worker.'''
+        if not self.tags:
+            return None
+        while self.next_seq not in self.reorder:
+            if not self._collect(timeout):
+                return None
+        output = self.reorder.pop(self.next_seq)
+        tag = self.tags.pop(self.next_seq)
+        self.next_seq += 1
+        if isinstance(output, Exception):
+            raise output
+        return tag, output
+
+    def close(self):
+        '''Stops the workers.'''
+        for worker in self.workers:
+            try:
+                worker.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.workers = []
+
+    def _collect(self, timeout=None):
+        '''Waits for a result from any worker.
+
+        Returns:
+          bool, False if the timeout expired.'''
+        try:
+            index, seq, output = self.results.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        self.workers[index].in_flight -= 1
+        self.reorder[seq] = output
+        return True
+
+
+class _Worker(object):
+    '''The state of a worker process.'''
+
+    def __init__(self, process, connection):
+        self.process = process
+        self.connection = connection
+        self.in_flight = 0
+        self.sent = 0
+
+
+def _run_worker(index, backend, connection, results):
+    '''Runs inference for an InferencePool until sent None.'''
+    try:
+        backend.open()
+    except Exception as exc:
+        logging.exception(exc)
+        results.put((index, None, exc))
+        return
+    results.put((index, None, (backend.input_size, backend.output_size)))
+
+    while True:
+        try:
+            item = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if item is None:
+            break
+        seq, tensor = item
+        try:
+            # The output is sent from another thread, so it must be copied.
+            output = np.array(backend.infer(tensor))
+        except Exception as exc:
+            logging.exception(exc)
+            output = exc
+        results.put((index, seq, output))
+
+
+def benchmark(backends, frames, depth=2):
+    '''Measures the throughput of a pool.
+
+    Args:
+      backends: List[Union[EdgeTpuBackend, CpuBackend]]
+      frames: int, the number of frames to infer.
+      depth: int, the maximum number of tensors in flight per worker.
+
+    Returns:
+      float, the frames per second.'''
+    pool = InferencePool(backends, depth)
+    try:
+        width, height = pool.input_size
+        rng = np.random.RandomState(0)
+        tensors = [rng.randint(0, 256, width * height * 3).astype(np.uint8)
+                   for _ in range(8)]
+        # Warm up every worker before timing.
+        for i in range(len(backends) * depth):
+            pool.submit(tensors[i % len(tensors)], i)
+        while pool.pending():
+            pool.get()
+
+        start_time = time.monotonic()
+        expected = 0
+        for i in range(frames):
+            pool.submit(tensors[i % len(tensors)], i)
+            while not pool.ready() or (i == frames - 1 and pool.pending()):
+                tag, _ = pool.get()
+                if tag != expected:
+                    raise RuntimeError(
+                        'Result {} returned before {}'.format(tag, expected))
+                expected += 1
+        return frames / (time.monotonic() - start_time)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='''
+Measures how inference throughput scales with the number of workers.''')
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4],
+            help='''
+The numbers of workers to measure. Edge TPUs are used in the order they are
+listed.''')
+    parser.add_argument("--cpu", action="store_true",
+            help='''
+Uses CPU stand-ins rather than Edge TPUs.''')
+    parser.add_argument("--latency", type=float, default=0,
+            help='''
+The extra time in seconds each CPU stand-in inference waits.''')
+    parser.add_argument("--frames", type=int, default=200,
+            help='''
+The number of frames to infer for each measurement.''')
+    parser.add_argument("--depth", type=int, default=2,
+            help='''
+The maximum number of frames in flight per worker.''')
+    parser.add_argument("--model",
+            default='mobilenet_quant_v1_224_headless_edgetpu.tflite',
+            help='''
+The model to load on each Edge TPU.''')
+    args = parser.parse_args()
+
+    if args.cpu:
+        available = None
+    else:
+        available = create_backends(args.model)
+        print('{} Edge TPUs found'.format(len(available)))
+
+    base_fps = None
+    for count in args.workers:
+        if args.cpu:
+            backends = create_backends(cpu_workers=count,
+                                       latency=args.latency)
+        elif count <= len(available):
+            backends = available[:count]
+        else:
+            break
+        fps = benchmark(backends, args.frames, args.depth)
+        base_fps = base_fps or fps
+        print('{} workers: {:.1f} fps ({:.2f}x)'.format(
+            count, fps, fps / base_fps))
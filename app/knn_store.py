@@ -0,0 +1,717 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+
+log = logging.getLogger('knn_store')
+
+# Projection methods.
+PCA = 'pca'
+RANDOM = 'random'
+
+# The number of stored embeddings from which queries are scored in parallel,
+# below which the threads cost more than they save.
+PARALLEL_ROWS = 2000
+
+
+def fit_projection(embs, dims, method=PCA, seed=0):
+    '''Fits a linear projection to fewer dimensions.
+
+    PCA uses the top right singular vectors of the embeddings, which best
+    preserve the dot products that the store matches with. RANDOM uses a
+    random orthogonal basis, and only needs the embedding width.
+
+    Args:
+      embs: numpy.array, the embeddings as rows.
+      dims: int, the number of dimensions to project to.
+      method: String, PCA or RANDOM.
+      seed: int, the seed for RANDOM.
+
+    Returns:
+      numpy.array, a (width, dims) float32 matrix with orthonormal columns.
+
+    Raises:
+      ValueError: The method is unknown, or PCA has fewer than dims
+        embeddings.'''
+    width = embs.shape[1]
+    if method == RANDOM:
+        rng = np.random.RandomState(seed)
+        matrix, _ = np.linalg.qr(rng.standard_normal((width, dims)))
+    elif method == PCA:
+        if len(embs) < dims:
+            raise ValueError('PCA needs at least {} embeddings'.format(dims))
+        _, _, components = np.linalg.svd(embs, full_matrices=False)
+        matrix = components[:dims].T
+    else:
+        raise ValueError('Unknown projection {}'.format(method))
+    return np.ascontiguousarray(matrix, dtype=np.float32)
+
+
+class LRUEviction(object):
+    '''Evicts the oldest embeddings of the least recently used label.
+
+    A label is used when it is learnt, or when it has the greatest
+    confidence for a query.'''
+
+    tracks_use = True
+    counts_hits = False
+
+    def choose(self, store, count):
+        '''Chooses embeddings to evict.
+
+        Args:
+          store: KNNStore, which is locked.
+          count: int, the number of embeddings to evict.
+
+        Returns:
+          Dict[Any, List[int]], the labels and indexes to evict.'''
+        victims = {}
+        labels = sorted((label for label, embeddings
+                         in store.embedding_map.items() if embeddings),
+                        key=lambda label: store.last_used.get(label, 0))
+        for label in labels:
+            if count <= 0:
+                break
+            taken = min(count, len(store.embedding_map[label]))
+            victims[label] = list(range(taken))
+            count -= taken
+        return victims
+
+
+class FairShareEviction(object):
+    '''Evicts the oldest embeddings of the labels with the most embeddings.
+
+    Labels end up with equal shares of the budget, however often they are
+    used.'''
+
+    tracks_use = False
+    counts_hits = False
+
+    def choose(self, store, count):
+        '''Chooses embeddings to evict, see LRUEviction.choose().'''
+        sizes = {label: len(embeddings)
+                 for label, embeddings in store.embedding_map.items()}
+        evicted = collections.Counter()
+        for _ in range(count):
+            label = max(sizes, key=lambda label: sizes[label])
+            if not sizes[label]:
+                break
+            sizes[label] -= 1
+            evicted[label] += 1
+        return {label: list(range(taken)) for label, taken in evicted.items()}
+
+
+class LeastUsefulEviction(object):
+    '''Evicts the embeddings that were least often among the k nearest
+    neighbors of a query. Ties are broken by evicting older embeddings.
+
+    New embeddings have not been counted yet, so the most recently used
+    label is only evicted from if it is the only label.'''
+
+    tracks_use = True
+    counts_hits = True
+
+    def choose(self, store, count):
+        '''Chooses embeddings to evict, see LRUEviction.choose().'''
+        labels = [label for label, hits in store.hit_map.items() if hits]
+        if len(labels) > 1:
+            labels.remove(max(
+                labels, key=lambda label: store.last_used.get(label, 0)))
+        keys = []
+        scores = []
+        for label in labels:
+            hits = store.hit_map[label]
+            keys.extend((label, index) for index in range(len(hits)))
+            # Adding less than one to the hit counts favors newer embeddings.
+            scores.append(np.asarray(hits) + np.linspace(0, 0.5, len(hits)))
+        if not scores:
+            return {}
+        scores = np.concatenate(scores)
+        count = min(count, len(scores))
+        if count < len(scores):
+            chosen = np.argpartition(scores, count)[:count]
+        else:
+            chosen = np.arange(len(scores))
+        victims = collections.defaultdict(list)
+        for index in chosen:
+            label, row = keys[index]
+            victims[label].append(row)
+        return dict(victims)
+
+
+# The eviction policies, by name.
+EVICTION_POLICIES = {
+    'lru': LRUEviction,
+    'fair': FairShareEviction,
+    'useful': LeastUsefulEviction,
+}
+
+
+def _project(embs, matrix):
+    '''Returns the normalized projections of embeddings.'''
+    projected = np.dot(embs, matrix)
+    norms = np.sqrt((projected**2).sum(axis=-1, keepdims=True))
+    return projected / np.maximum(norms, 1e-12)
+
+
+def _shard(items, count):
+    '''Splits the store into shards with similar numbers of embeddings.
+
+    Labels are kept whole where they fit in a shard, and split by row range
+    where they do not. The shards are views of the arrays, not copies.
+
+    Args:
+      items: List[Tuple[Any, numpy.array]], each label and its embeddings.
+      count: int, the number of shards.
+
+    Returns:
+      List[List[Tuple[Any, int, numpy.array]]], for each shard the label,
+      index of the first row, and rows of each part.'''
+    size = -(-sum(len(embeds) for _, embeds in items) // count)
+    shards = [[]]
+    room = size
+    for label, embeds in items:
+        start = 0
+        while start < len(embeds):
+            if not room:
+                shards.append([])
+                room = size
+            end = min(len(embeds), start + room)
+            shards[-1].append((label, start, embeds[start:end]))
+            room -= end - start
+            start = end
+    return shards
+
+
+def _score_shard(shard, query_emb, knn):
+    '''Finds the nearest neighbors in each part of a shard.
+
+    Args:
+      shard: List[Tuple[Any, int, numpy.array]], see _shard().
+      query_emb: numpy.array, the normalized query.
+      knn: int, the number of neighbors.
+
+    Returns:
+      List[Tuple[Any, numpy.array, numpy.array]], the label, and the
+      confidences and row indexes of up to knn neighbors, for each part.'''
+    results = []
+    for label, start, embeds in shard:
+        dists = np.matmul(embeds, query_emb)
+        if len(dists) <= knn:
+            nearest = np.arange(len(dists))
+        else:
+            nearest = np.argpartition(dists, -knn)[-knn:]
+        results.append((label, dists[nearest], nearest + start))
+    return results
+
+
+class KNNStore(object):
+    '''An in-memory store of embeddings, matched with k nearest neighbors.
+
+    The store does not depend on the inference engine, so embeddings can be
+    matched wherever they were computed.
+
+    Optionally, matching uses a projection of the embeddings to fewer
+    dimensions, which reduces the cost of each query. The projection is fit
+    once the store has enough embeddings, and refit when the number of
+    changes since the last fit reaches refit_fraction of the store's size
+    at that fit. Refits run in a background thread, and queries keep using
+    the previous projection until a refit completes. The full width
+    embeddings are kept, so that refits, snapshots and merges are exact.
+
+    Optionally, the whole store is limited to max_bytes, counting the full
+    width and projected embeddings. When an addition takes the store over
+    its budget, embeddings are evicted by the eviction policy.
+
+    Optionally, queries are scored by a pool of threads once the store has
+    parallel_rows embeddings. Each label's embeddings are then kept packed in
+    an array. With full width matching the packed copies count towards the
+    budget: queries are only scored in parallel while they fit, and they are
+    dropped rather than evicting embeddings for them. The store is split
+    into a shard for each thread, by label or by row range within a label.
+    numpy releases the GIL while scoring, so the threads share the arrays
+    and run on separate cores. The nearest neighbors of each shard are
+    merged into the same confidences as a single threaded query.'''
+
+    def __init__(self, k_nearest_neighbors=3, maxlen=1000, projection=None,
+                 dims=128, refit_fraction=0.5, background=True,
+                 max_bytes=None, eviction='lru', workers=1,
+                 parallel_rows=PARALLEL_ROWS):
+        '''Constructor.
+
+        Args:
+          k_nearest_neighbors: int, the number of neighbors to use for
+            confidences.
+          maxlen: int, the maximum number of embeddings to store per label.
+          projection: Union[String, None], PCA or RANDOM to match with
+            projected embeddings, or None to match with the full width.
+          dims: int, the number of dimensions to project to.
+          refit_fraction: float, the fraction of the store that must change
+            before the projection is refit.
+          background: bool, True to refit in a background thread, False to
+            refit when the store changes.
+          max_bytes: Union[int, None], the memory budget for the whole
+            store, or None for no budget.
+          eviction: Union[String, Any], the name of a policy in
+            EVICTION_POLICIES, or a policy with the LRUEviction interface.
+          workers: Union[int, None], the number of threads to score queries
+            with, including the calling thread, or None for one per CPU.
+          parallel_rows: int, the number of stored embeddings from which
+            queries are scored in parallel.'''
+        self.embedding_map = collections.defaultdict(list)
+        self.knn = k_nearest_neighbors
+        self.maxlen = maxlen
+
+        self.projection = projection
+        self.dims = dims
+        self.refit_fraction = refit_fraction
+        self.background = background
+        # Guards the projection state, which a refit thread also uses.
+        self.lock = threading.RLock()
+        # The (width, dims) projection matrix, or None before the first fit.
+        self.matrix = None
+        # A Map[Any, numpy.array] of labels and their projected embeddings,
+        # projected again when a label changes.
+        self.projected = {}
+        # Counts changes to each label, to find labels changed during a refit.
+        self.versions = collections.Counter()
+        self.changes = 0
+        self.fitted_size = 0
+        # Counts clears, to discard a refit of the embeddings before one.
+        self.clears = 0
+        self.refit_event = threading.Event()
+        self.refit_thread = None
+        self.refitting = False
+
+        self.max_bytes = max_bytes
+        if isinstance(eviction, str):
+            eviction = EVICTION_POLICIES[eviction]()
+        self.eviction = eviction
+        # Use and hits are only tracked if there is a budget, and the
+        # eviction policy uses them.
+        self.tracks_use = max_bytes is not None and eviction.tracks_use
+        self.counts_hits = max_bytes is not None and eviction.counts_hits
+        # A Map[Any, List[int]] of the top-k hits for each stored embedding,
+        # if counts_hits.
+        self.hit_map = collections.defaultdict(list)
+        # The time each label was last used, in ticks, if tracks_use.
+        self.last_used = {}
+        self.ticks = itertools.count(1)
+        self.evicted = 0
+
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_rows = parallel_rows
+        # A Map[Any, numpy.array] of labels and their packed full width
+        # embeddings, packed again when a label changes.
+        self.packed = {}
+        # The scoring threads, started by the first parallel query.
+        self.pool = None
+
+    def clear(self):
+        '''Clear the store: forgets all stored embeddings.'''
+        with self.lock:
+            self.embedding_map = collections.defaultdict(list)
+            self.hit_map = collections.defaultdict(list)
+            self.last_used = {}
+            self.projected = {}
+            self.packed = {}
+            self.versions.clear()
+            # Fit again to the new embeddings, rather than keep matching with
+            # a projection fit to the forgotten ones.
+            self.matrix = None
+            self.changes = 0
+            self.fitted_size = 0
+            self.clears += 1
+
+    def __len__(self):
+        return sum(len(embeddings)
+                   for embeddings in self.embedding_map.values())
+
+    def memory_usage(self):
+        '''Returns the memory used by the store.
+
+        Returns:
+          Dict[String, Any], the bytes used, the budget, the number of
+          embeddings evicted, and the number of embeddings per label.'''
+        with self.lock:
+            labels = {label: len(embeddings)
+                      for label, embeddings in self.embedding_map.items()
+                      if embeddings}
+            return dict(
+                bytes=(sum(labels.values()) * self._row_bytes() +
+                       self._packed_bytes()),
+                max_bytes=self.max_bytes,
+                evicted=self.evicted,
+                labels=labels)
+
+    def add_embedding(self, label, emb):
+        '''Add an embedding vector to the store.'''
+        # Normalize the vector.
+        normal = emb / np.sqrt((emb**2).sum())
+
+        with self.lock:
+            # Add to store, under label.
+            embeddings = self.embedding_map[label]
+            embeddings.append(normal)
+            # The packed copy is out of date, and is not counted.
+            self.packed.pop(label, None)
+            if self.counts_hits:
+                self.hit_map[label].append(0)
+            if self.tracks_use:
+                self.last_used[label] = next(self.ticks)
+
+            # Discard if maxlen is exceeded.
+            if len(embeddings) > self.maxlen:
+                self.embedding_map[label] = embeddings[-self.maxlen:]
+                if self.counts_hits:
+                    self.hit_map[label] = self.hit_map[label][-self.maxlen:]
+            evicted = self._enforce_budget()
+        self._changed(label)
+        for evicted_label, count in evicted.items():
+            if evicted_label != label:
+                self._changed(evicted_label, count)
+
+    def merge(self, label, embs, dedup=0.999):
+        '''Merges embedding vectors into the store.
+
+        Vectors that are near duplicates of a stored vector, or of an earlier
+        vector in embs, are skipped. If the label then has more than maxlen
+        vectors they are subsampled evenly, rather than keeping the newest,
+        so that both the stored and merged vectors are represented.
+
+        Args:
+          label: Any
+          embs: numpy.array, the vectors as rows.
+          dedup: Union[float, None], the cosine similarity at or above which
+            a vector is a duplicate, or None to keep every vector.
+
+        Returns:
+          int, the number of vectors that were not duplicates.'''
+        normals = embs / np.sqrt((embs**2).sum(axis=1, keepdims=True))
+        with self.lock:
+            embeddings = self.embedding_map[label]
+            self.packed.pop(label, None)
+            added = 0
+            for normal in normals:
+                if (dedup is not None and embeddings and
+                        np.max(np.matmul(embeddings, normal)) >= dedup):
+                    continue
+                embeddings.append(normal)
+                added += 1
+            if self.counts_hits:
+                self.hit_map[label].extend([0] * added)
+            if self.tracks_use:
+                self.last_used[label] = next(self.ticks)
+
+            if len(embeddings) > self.maxlen:
+                keep = np.linspace(0, len(embeddings) - 1, self.maxlen)
+                keep = [int(round(index)) for index in keep]
+                self.embedding_map[label] = [embeddings[i] for i in keep]
+                if self.counts_hits:
+                    hits = self.hit_map[label]
+                    self.hit_map[label] = [hits[i] for i in keep]
+            evicted = self._enforce_budget()
+        self._changed(label, added)
+        for evicted_label, count in evicted.items():
+            if evicted_label != label:
+                self._changed(evicted_label, count)
+        return added
+
+    def refit(self, calibration=None):
+        '''Fits the projection and projects the stored embeddings again.
+
+        Runs in the calling thread. Queries use the previous projection until
+        the new one is ready.
+
+        Args:
+          calibration: Union[numpy.array, None], embeddings to fit with, or
+            None to fit with the stored embeddings.'''
+        start_time = time.monotonic()
+        with self.lock:
+            items = [(label, list(embeddings))
+                     for label, embeddings in self.embedding_map.items()
+                     if embeddings]
+            versions = dict(self.versions)
+            changes = self.changes
+            clears = self.clears
+        arrays = {label: np.array(embeddings) for label, embeddings in items}
+        size = sum(len(embeddings) for embeddings in arrays.values())
+        if calibration is None:
+            if not arrays:
+                return
+            calibration = np.concatenate(list(arrays.values()))
+        matrix = fit_projection(calibration, self.dims, self.projection)
+        projected = {label: _project(embeddings, matrix)
+                     for label, embeddings in arrays.items()}
+
+        with self.lock:
+            if self.clears != clears:
+                # The store was cleared during the fit.
+                return
+            self.matrix = matrix
+            # Queries now use the projected embeddings.
+            self.packed = {}
+            # Labels that changed during the fit are projected when they are
+            # next queried.
+            self.projected = {
+                label: embeddings for label, embeddings in projected.items()
+                if self.versions[label] == versions.get(label)}
+            self.changes -= changes
+            self.fitted_size = size
+        log.info('projection to %d dims fit with %d embeddings in %.3fs',
+                 self.dims, len(calibration), time.monotonic() - start_time)
+
+    def _row_bytes(self):
+        '''Returns the bytes used by each embedding.'''
+        for embeddings in self.embedding_map.values():
+            if embeddings:
+                row_bytes = embeddings[0].nbytes
+                if self.projection:
+                    row_bytes += self.dims * np.dtype(np.float32).itemsize
+                return row_bytes
+        return 0
+
+    def _packed_bytes(self):
+        '''Returns the bytes used by the packed copies for parallel queries.'''
+        return sum(packed.nbytes for packed in self.packed.values())
+
+    def _enforce_budget(self):
+        '''Evicts embeddings until the store is within its budget.
+
+        Must be called with the lock held.
+
+        Returns:
+          Dict[Any, int], the number of embeddings evicted for each label.'''
+        evicted = collections.Counter()
+        if self.max_bytes is None:
+            return evicted
+        row_bytes = self._row_bytes()
+        excess = len(self) * row_bytes - self.max_bytes
+        if excess + self._packed_bytes() > 0:
+            # The packed copies can be packed again, so they are dropped
+            # rather than evicting embeddings for them.
+            self.packed = {}
+        if excess <= 0:
+            return evicted
+        count = int(math.ceil(excess / row_bytes))
+        for label, indexes in self.eviction.choose(self, count).items():
+            indexes = set(indexes)
+            self.embedding_map[label] = [
+                emb for i, emb in enumerate(self.embedding_map[label])
+                if i not in indexes]
+            if self.counts_hits:
+                self.hit_map[label] = [
+                    hits for i, hits in enumerate(self.hit_map[label])
+                    if i not in indexes]
+            evicted[label] += len(indexes)
+        self.evicted += sum(evicted.values())
+        return evicted
+
+    def _changed(self, label, count=1):
+        '''Records a change to a label, and starts a refit if needed.'''
+        with self.lock:
+            self.projected.pop(label, None)
+            self.packed.pop(label, None)
+            self.versions[label] += 1
+            if not self.projection:
+                return
+            self.changes += count
+            if self.refitting or not self._needs_refit():
+                return
+            self.refitting = True
+        if not self.background:
+            try:
+                self.refit()
+            finally:
+                self.refitting = False
+            return
+        if self.refit_thread is None:
+            self.refit_thread = threading.Thread(
+                target=self._run_refits, name='KNNStoreRefit', daemon=True)
+            self.refit_thread.start()
+        self.refit_event.set()
+
+    def _needs_refit(self):
+        '''Returns True if the projection should be fit again.'''
+        if self.matrix is None:
+            if self.projection == RANDOM:
+                return True
+            size = sum(len(embeddings)
+                       for embeddings in self.embedding_map.values())
+            return size >= self.dims
+        return self.changes >= self.refit_fraction * max(
+            self.fitted_size, self.dims)
+
+    def _run_refits(self):
+        '''Runs refits in the background thread.'''
+        while True:
+            self.refit_event.wait()
+            self.refit_event.clear()
+            try:
+                self.refit()
+            except Exception:
+                log.exception('projection refit failed')
+            finally:
+                with self.lock:
+                    self.refitting = False
+
+    def _get_projected(self, label, matrix):
+        '''Returns a label's projected embeddings, projecting if needed.'''
+        with self.lock:
+            projected = self.projected.get(label)
+            if projected is None or self.matrix is not matrix:
+                projected = _project(
+                    np.array(self.embedding_map[label]), matrix)
+                if self.matrix is matrix:
+                    self.projected[label] = projected
+        return projected
+
+    def _get_packed(self, label, matrix):
+        '''Returns a label's embeddings as an array, packing if needed.'''
+        if matrix is not None:
+            return self._get_projected(label, matrix)
+        with self.lock:
+            packed = self.packed.get(label)
+            if packed is None:
+                packed = np.array(self.embedding_map[label])
+                self.packed[label] = packed
+        return packed
+
+    def get_confidences(self, query_emb, labels=None):
+        '''Returns the match confidences for a query embedding.
+
+        Args:
+          query_emb: The embedding vector to match against.
+          labels: Union[Iterable[Any], None], the labels to match, or None
+            for all of them.
+
+        Returns:
+          Dict[Any, float], a mapping of labels to match confidences.'''
+        matrix = self.matrix
+        if matrix is None:
+            # Normalize the query embedding.
+            query_emb = query_emb/np.sqrt((query_emb**2).sum())
+        else:
+            query_emb = _project(query_emb, matrix)
+
+        if (self.workers > 1 and len(self) >= self.parallel_rows and
+                self._fits_packed(matrix)):
+            results = self._score_shards(query_emb, labels, matrix)
+        else:
+            results = self._score_labels(query_emb, labels, matrix)
+
+        if results and self.tracks_use:
+            best = max(results, key=results.get)
+            self.last_used[best] = next(self.ticks)
+        return results
+
+    def _score_labels(self, query_emb, labels, matrix):
+        '''Scores a query against each label in the calling thread.'''
+        # Build up a dictionary of results, one for each label.
+        results = {}
+
+        for label, embeds in list(self.embedding_map.items()):
+            if labels is not None and label not in labels:
+                continue
+            if not embeds:
+                continue
+            if matrix is not None:
+                embeds = self._get_projected(label, matrix)
+            # Perform a matrix multiplication to get the cosine distance
+            # from the stored embeddings. This distance is the confidence.
+            dists = np.matmul(embeds, query_emb)
+
+            if len(dists) <= self.knn:
+                # Use all the confidences as the nearest neighbors.
+                k_largest = dists
+                if self.counts_hits:
+                    self._count_hits(label, range(len(dists)))
+            elif self.counts_hits:
+                # Find the indexes of the knn biggest confidences, to count
+                # how often each embedding is a neighbor.
+                nearest = np.argpartition(dists, -self.knn)[-self.knn:]
+                k_largest = dists[nearest]
+                self._count_hits(label, nearest)
+            else:
+                # Use just the knn biggest confidences.
+
+                # Partition performs a partial sort, making sure the index
+                # (-self.knn) is correct and everything after is bigger.
+                # This is cheaper than a full sort.
+                k_largest = np.partition(dists, -self.knn)[-self.knn:]
+
+            # The confidence for this label is the average of k_largest.
+            results[label] = np.average(k_largest)
+        return results
+
+    def _fits_packed(self, matrix):
+        '''Returns True if the arrays for a parallel query fit the budget.'''
+        if matrix is not None or self.max_bytes is None:
+            # Projected embeddings are always kept, and counted.
+            return True
+        with self.lock:
+            return 2 * len(self) * self._row_bytes() <= self.max_bytes
+
+    def _score_shards(self, query_emb, labels, matrix):
+        '''Scores a query against shards of the store in parallel.'''
+        items = [(label, self._get_packed(label, matrix))
+                 for label, embeds in list(self.embedding_map.items())
+                 if embeds and (labels is None or label in labels)]
+        if not items:
+            return {}
+        shards = _shard(items, self.workers)
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                self.workers - 1)
+        futures = [self.pool.submit(_score_shard, shard, query_emb, self.knn)
+                   for shard in shards[1:]]
+        # The calling thread scores the first shard while it waits.
+        parts = _score_shard(shards[0], query_emb, self.knn)
+        for future in futures:
+            parts.extend(future.result())
+
+        # Merge the nearest neighbors of each label's parts.
+        merged = collections.defaultdict(list)
+        for label, dists, indexes in parts:
+            merged[label].append((dists, indexes))
+        results = {}
+        for label, found in merged.items():
+            dists = np.concatenate([dists for dists, _ in found])
+            indexes = np.concatenate([indexes for _, indexes in found])
+            if len(dists) > self.knn:
+                nearest = np.argpartition(dists, -self.knn)[-self.knn:]
+                dists = dists[nearest]
+                indexes = indexes[nearest]
+            if self.counts_hits:
+                self._count_hits(label, indexes)
+            results[label] = np.average(dists)
+        return results
+
+    def _count_hits(self, label, indexes):
+        '''Counts a top-k hit for each of a label's embeddings.'''
+        with self.lock:
+            hits = self.hit_map[label]
+            for index in indexes:
+                if index < len(hits):
+                    hits[index] += 1
@@ -0,0 +1,112 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+
+class MatchFilter(object):
+    '''Filters confidences over time to find a stable match.
+
+    Each label's confidence is passed through an InfiniteImpulseResponseFilter.
+    The label with the greatest output is the match, if that output is at
+    least the confidence threshold.'''
+
+    def __init__(self, weight, confidence):
+        '''Constructor.
+
+        Args:
+          weight: float, the weight (0-1) the filters give new inputs.
+          confidence: float, the minimum output (0-1) to match.'''
+        self.confidence = confidence
+        # Maintain a map of labels to IIR filtered confidences.
+        self.filters = collections.defaultdict(
+            lambda: InfiniteImpulseResponseFilter(weight))
+        # The current match.
+        self.label = None
+
+    def update(self, confidences):
+        '''Updates the filters.
+
+        Args:
+          confidences: Dict[Any, float], a mapping of labels to confidences.
+
+        Returns:
+          bool, True if the match changed.'''
+        for label, confidence in confidences.items():
+            self.filters[label].update(confidence)
+        if not self.filters:
+            return False
+
+        # Find the label with the greatest confidence.
+        match_label, iir = max(
+            self.filters.items(),
+            key=lambda item: item[1].output)
+
+        # If the confidence is not great enough then the match is None.
+        if iir.output < self.confidence:
+            match_label = None
+        if match_label == self.label:
+            return False
+        self.label = match_label
+
+        # Apply some hysteresis after every change, by resetting
+        # the IIR filters either high (for the current label) or low.
+        for label, iir in self.filters.items():
+            iir.reset(1 if label == self.label else 0)
+        return True
+
+    def outputs(self):
+        '''Returns the filtered confidences.
+
+        Returns:
+          List[float]'''
+        return [iir.output for iir in self.filters.values()]
+
+    def confidences(self):
+        '''Returns the filtered confidence of each label.
+
+        Returns:
+          Dict[Any, float]'''
+        return {label: iir.output for label, iir in self.filters.items()}
+
+
+class InfiniteImpulseResponseFilter(object):
+    '''Filters an input over time.
+
+    With every update the output is set to a portion (weight) of the current
+    input value, combined with a portion (1-weight) of the previous output.'''
+
+    def __init__(self, weight, value=0):
+        '''Constructor.
+
+        Args:
+          weight: float, the weight (0-1) to give new inputs.
+          value: float, the initial value.'''
+        self.weight = weight
+        self.output = value
+
+    def update(self, input):
+        '''Updates the output.
+
+        Args:
+          input: float, the current input.'''
+        self.output *= (1 - self.weight)
+        self.output += input * self.weight
+
+    def reset(self, value=0):
+        '''Resets the output.
+
+        Args:
+          value: float, the new output.'''
+        self.output = value
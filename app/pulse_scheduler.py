@@ -0,0 +1,265 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Schedules servo pulses within a current budget.
+
+Each servo is sent a pulse every period, and draws current while its pulse
+is high. A PulseSchedule gives each servo a fixed offset for its pulses
+within the hyperperiod, the least common multiple of the servos' periods, so
+that the total current of the pulses that are high at once never exceeds the
+budget. Offsets are chosen for the longest pulse each servo can be sent, so
+they stay valid however the servos move.
+
+With a budget of one servo's current the pulses run one after another, and
+a larger budget lets more servos share a frame. A schedule for a segment of
+waves is converted to pigpio pulse instructions by to_steps(), and replay()
+converts the instructions back to pulses, as pigpio sends them, to check
+them.
+
+Run this module to check schedules for many servos, and the time taken to
+build them.'''
+
+import argparse
+import collections
+import math
+import random
+import time
+
+
+# The resolution in microseconds of pulse offsets.
+RESOLUTION_US = 10
+
+
+class PulseSchedule(object):
+    '''The offsets of each servo's pulses within the hyperperiod.'''
+
+    def __init__(self, servos, budget, resolution_us=RESOLUTION_US):
+        '''Constructor.
+
+        Args:
+          servos: Sequence[Tuple[int, int, float]], the period and maximum
+            pulse width in microseconds, and the current, of each servo.
+          budget: float, the maximum total current of the pulses that are
+            high at once.
+          resolution_us: int, the resolution of the offsets, which the
+            periods must be multiples of.
+
+        Raises:
+          ValueError: The pulses do not fit within the budget.'''
+        self.periods = [period for period, _, _ in servos]
+        self.budget = budget
+        self.period_us = 1
+        for period in self.periods:
+            if period % resolution_us:
+                raise ValueError('Period {}us is not a multiple of {}us'
+                                 .format(period, resolution_us))
+            self.period_us = (self.period_us * period //
+                              math.gcd(self.period_us, period))
+
+        # The total current in each interval of the hyperperiod.
+        load = [0] * (self.period_us // resolution_us)
+        self.offsets = []
+        for idx, (period, width, current) in enumerate(servos):
+            offset = _fit(load, period // resolution_us,
+                          -(-width // resolution_us), budget - current)
+            if offset is None:
+                raise ValueError(
+                    'Servo {} does not fit within the current budget'
+                    .format(idx))
+            for start in range(offset, len(load), period // resolution_us):
+                for interval in range(
+                        start, start + -(-width // resolution_us)):
+                    load[interval] += current
+            self.offsets.append(offset * resolution_us)
+
+    def starts(self, idx, length_us):
+        '''Returns the times of a servo's pulses.
+
+        Args:
+          idx: int, the servo index.
+          length_us: int, the length in microseconds to send pulses over,
+            a multiple of period_us.
+
+        Returns:
+          Iterable[int], the start times in microseconds.'''
+        return range(self.offsets[idx], length_us, self.periods[idx])
+
+
+def _fit(load, period, width, spare):
+    '''Finds the first offset at which a servo's pulses fit.
+
+    Args:
+      load: List[float], the current in each interval of the hyperperiod.
+      period: int, the servo's period in intervals.
+      width: int, the pulse width in intervals.
+      spare: float, the current the load may reach.
+
+    Returns:
+      Union[int, None], the offset in intervals, or None if there is none.'''
+    # The greatest load at each offset into the period, over all periods.
+    folded = [max(load[offset::period]) for offset in range(period)]
+    # Find the first run of width intervals with enough spare current. As
+    # the run is within the period the pulses end within their period.
+    run = 0
+    for offset in range(period):
+        run = run + 1 if folded[offset] <= spare + 1e-9 else 0
+        if run == width:
+            return offset - width + 1
+    return None
+
+
+def to_steps(pulses, length_us):
+    '''Converts pulses to pigpio pulse instructions.
+
+    Args:
+      pulses: Iterable[Tuple[int, int, int]], the start time and width in
+        microseconds, and the pin, of each pulse.
+      length_us: int, the length of the wave in microseconds, which the
+        pulses must end within.
+
+    Returns:
+      List[Tuple[int, int, int]], the arguments to pigpio.pulse(): the bit
+      masks of the pins to turn on and off, and the time until the next
+      instruction.'''
+    edges = collections.defaultdict(lambda: [0, 0])
+    # The wave starts at 0 even if no pulse does.
+    edges[0]
+    for start, width, pin in pulses:
+        edges[start][0] |= 1 << pin
+        edges[start + width][1] |= 1 << pin
+    times = sorted(edges)
+    steps = []
+    for at, next_at in zip(times, times[1:] + [max(length_us, times[-1])]):
+        on, off = edges[at]
+        steps.append((on, off, next_at - at))
+    return steps
+
+
+def replay(steps):
+    '''Converts pigpio pulse instructions to the pulses sent.
+
+    Args:
+      steps: Iterable[Tuple[int, int, int]], see to_steps().
+
+    Returns:
+      List[Tuple[int, int, int]], the start time and width in microseconds,
+      and the pin, of each pulse, in order.'''
+    at = 0
+    high = {}
+    pulses = []
+    for on, off, delay in steps:
+        for pin in _pins(off):
+            if pin in high:
+                start = high.pop(pin)
+                pulses.append((start, at - start, pin))
+        for pin in _pins(on):
+            high.setdefault(pin, at)
+        at += delay
+    return sorted(pulses)
+
+
+def _pins(mask):
+    '''Returns the pin numbers set in a bit mask.'''
+    return [pin for pin in range(mask.bit_length()) if mask & (1 << pin)]
+
+
+def check(schedule, servos, pulses):
+    '''Checks the pulses sent for a schedule.
+
+    Args:
+      schedule: PulseSchedule
+      servos: Sequence[Tuple[int, int, float]], as given to the schedule,
+        with the pin of each servo being its index.
+      pulses: List[Tuple[int, int, int]], the pulses sent, from replay().
+
+    Returns:
+      Tuple[List[String], float], the errors and the peak current.'''
+    errors = []
+    by_pin = collections.defaultdict(list)
+    for start, width, pin in pulses:
+        by_pin[pin].append((start, width))
+    for idx, (period, max_width, _) in enumerate(servos):
+        starts = [start for start, _ in by_pin[idx]]
+        expected = list(schedule.starts(idx, schedule.period_us))
+        if starts != expected:
+            errors.append('Servo {} pulses at {} not {}'.format(
+                idx, starts, expected))
+        for start, width in by_pin[idx]:
+            if width > max_width:
+                errors.append('Servo {} pulse at {} is {}us'.format(
+                    idx, start, width))
+
+    # Sum the current at each edge, ending pulses before starting others.
+    changes = []
+    for start, width, pin in pulses:
+        changes.append((start, 1, servos[pin][2]))
+        changes.append((start + width, 0, -servos[pin][2]))
+    current = peak = 0
+    for _, _, change in sorted(changes):
+        current += change
+        peak = max(peak, current)
+    if peak > schedule.budget + 1e-9:
+        errors.append('Peak current {} is over the budget'.format(peak))
+    return errors, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='''
+Builds pulse schedules for servos with random pulse widths, replays the pulse
+instructions as pigpio sends them, and checks the timing of each servo's
+pulses and the peak current.''')
+    parser.add_argument('--servos', type=int, nargs='+',
+                        default=[2, 8, 16, 32], help='''
+The numbers of servos to schedule.''')
+    parser.add_argument('--periods', type=int, nargs='+', default=[20000],
+                        help='''
+The servo periods in microseconds, used in turn.''')
+    parser.add_argument('--max-width', type=int, default=1850, help='''
+The maximum pulse width in microseconds.''')
+    parser.add_argument('--current', type=float, default=1, help='''
+The current each servo draws while its pulse is high.''')
+    parser.add_argument('--budget', type=float, nargs='+',
+                        default=[1, 2, 4], help='''
+The current budgets to schedule with.''')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for count in args.servos:
+        servos = [(args.periods[idx % len(args.periods)], args.max_width,
+                   args.current) for idx in range(count)]
+        for budget in args.budget:
+            start_time = time.perf_counter()
+            try:
+                schedule = PulseSchedule(servos, budget)
+            except ValueError as exc:
+                print('{} servos, budget {}: {}'.format(count, budget, exc))
+                continue
+            built = time.perf_counter() - start_time
+            pulses = sorted(
+                (start, rng.randint(500, args.max_width), idx)
+                for idx in range(count)
+                for start in schedule.starts(idx, schedule.period_us))
+            start_time = time.perf_counter()
+            steps = to_steps(pulses, schedule.period_us)
+            converted = time.perf_counter() - start_time
+            sent = replay(steps)
+            errors, peak = check(schedule, servos, sent)
+            if sent != pulses:
+                errors.append('The pulses sent differ')
+            print('{} servos, budget {}: hyperperiod {}us, built in {:.1f}ms,'
+                  ' {} steps in {:.2f}ms, peak current {}, {}'.format(
+                      count, budget, schedule.period_us, built * 1000,
+                      len(steps), converted * 1000, peak,
+                      '; '.join(errors) or 'ok'))
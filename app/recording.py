@@ -0,0 +1,146 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+
+log = logging.getLogger('recording')
+
+# Session kinds
+LEARNING = 'learning'
+CLASSIFYING = 'classifying'
+RESET = 'reset'
+
+# The files in a session directory.
+FRAMES_FILE = 'frames.u8'
+META_FILE = 'meta.json'
+
+# A recorded session. frames is a read only numpy.memmap of the input tensor
+# images, with shape (count, height, width, 3).
+Session = namedtuple('Session', [
+    'name', 'path', 'kind', 'label', 'frames', 'sources', 'times'])
+
+
+class SessionRecorder(object):
+    '''Records the frames given to the engine in each session.
+
+    Each session is a directory named by its start time and kind. The frames
+    are appended to a raw file as they are captured, so that long sessions do
+    not use memory, and the metadata is written when the session stops. A
+    reset is recorded as a session without frames.'''
+
+    def __init__(self, directory):
+        '''Constructor.
+
+        Args:
+          directory: String, the directory to create sessions in.'''
+        self.directory = directory
+        self.path = None
+        self.file = None
+        self.meta = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, kind, label=None):
+        '''Starts a new session, stopping any current one.
+
+        Args:
+          kind: String, LEARNING, CLASSIFYING or RESET.
+          label: Any, the label being learnt, or None.'''
+        self.stop()
+        # Names sort in the order sessions were recorded.
+        now = time.time()
+        name = '{}-{:03d}-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+            int(now % 1 * 1000), kind)
+        self.path = os.path.join(self.directory, name)
+        suffix = 1
+        while os.path.exists(self.path):
+            suffix += 1
+            self.path = os.path.join(
+                self.directory, '{}-{}'.format(name, suffix))
+        os.makedirs(self.path)
+        self.file = open(os.path.join(self.path, FRAMES_FILE), 'wb')
+        self.meta = dict(kind=kind, label=label, shape=None, sources=[],
+                         times=[])
+
+    def add(self, frame, source=0):
+        '''Adds a frame to the current session.
+
+        Args:
+          frame: numpy.array, a uint8 RGB input tensor image.
+          source: int, the index of the frame's source.'''
+        if self.file is None:
+            return
+        if self.meta['shape'] is None:
+            self.meta['shape'] = list(frame.shape)
+        self.file.write(frame.tobytes())
+        self.meta['sources'].append(source)
+        self.meta['times'].append(time.monotonic())
+
+    def stop(self):
+        '''Stops the current session and writes its metadata.'''
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(self.meta, f)
+        log.info('recorded %d frames to %s', len(self.meta['times']),
+                 self.path)
+
+
+def load_session(path):
+    '''Loads a recorded session.
+
+    Args:
+      path: String, the session directory.
+
+    Returns:
+      Session'''
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    count = len(meta['times'])
+    if count:
+        frames = np.memmap(os.path.join(path, FRAMES_FILE), dtype=np.uint8,
+                           mode='r', shape=tuple([count] + meta['shape']))
+    else:
+        frames = np.empty((0, 0, 0, 3), dtype=np.uint8)
+    return Session(os.path.basename(os.path.normpath(path)), path,
+                   meta['kind'], meta['label'], frames,
+                   np.array(meta['sources'], dtype=np.int32),
+                   np.array(meta['times']))
+
+
+def list_sessions(directory):
+    '''Loads the sessions in a directory, in the order they were recorded.
+
+    Sessions that were not stopped, and so have no metadata, are skipped.
+
+    Args:
+      directory: String
+
+    Returns:
+      List[Session]'''
+    sessions = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(os.path.join(path, META_FILE)):
+            sessions.append(load_session(path))
+    return sessions
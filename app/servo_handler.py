@@ -12,69 +12,349 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import math
-import time
+import logging
+import resource
 
 import pigpio
 
+import clock
+import pulse_scheduler
 import task
 
 
+log = logging.getLogger('servo_handler')
+
+
+def _thread_cpu_time():
+    '''Returns the CPU time in seconds used by the calling thread.'''
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
 class Servo(object):
-    '''Keeps information about a servo.'''
+    '''Keeps information about a servo and its motion.
+
+    The motion is a move from one position to another over a period of time,
+    which may be zero. A position of None lets the servo idle.'''
 
-    def __init__(self, pin, offset, scale):
+    def __init__(self, pin, offset, scale, period_us, current):
         '''Constructor.
 
         Args:
           pin: int, the BCM pin number the servo is connected to.
           offset: float, the pulse length in seconds to use at position 0.
-          scale: float, the amount to adjust the pulse length as position 1.'''
+          scale: float, the amount to adjust the pulse length as position 1.
+          period_us: int, the time in microseconds between pulses.
+          current: float, the current the servo draws during a pulse.'''
         self.pin = pin
         self.offset_us = offset * 1000000
         self.scale_us = scale * 1000000
-        self.pulse_us = 0
+        self.period_us = period_us
+        self.current = current
+        self.max_pulse_us = int(max(self.offset_us,
+                                    self.offset_us + self.scale_us))
+        self.start = None
+        self.end = None
+        self.start_time = 0
+        self.end_time = 0
+        # The time the motion was changed, until it is sent.
+        self.changed_at = None
+
+    def move(self, start, end, start_time, end_time):
+        '''Sets the motion.
 
-    def set_position(self, value):
-        '''Sets pulse_us using the given value.
+        Args:
+          start: Union[float, None], the normalised (0-1) start position.
+          end: Union[float, None], the normalised (0-1) end position.
+          start_time: float, the clock.monotonic() time to leave start.
+          end_time: float, the time to reach end.'''
+        if start is None or end is None:
+            start = end = None
+        self.start = start
+        self.end = end
+        self.start_time = start_time
+        self.end_time = end_time
+        if self.changed_at is None:
+            self.changed_at = start_time
+
+    def position(self, at):
+        '''Returns the position at a time.
 
         Args:
-          value: Union[float, None], a normalised (0-1) input value.
+          at: float, the clock.monotonic() time.
+
+        Returns:
+          Union[float, None], the normalised position, or None if idle.'''
+        if self.end is None or at >= self.end_time:
+            return self.end
+        if at <= self.start_time:
+            return self.start
+        progress = (at - self.start_time) / (self.end_time - self.start_time)
+        return self.start + (self.end - self.start) * progress
 
-        If the value is None then pulse_us is set to 0, which lets a
-        servo idle.'''
+    def moving(self, at):
+        '''Returns True if the servo is moving at or after a time.
+
+        Args:
+          at: float, the clock.monotonic() time.'''
+        return self.start != self.end and at < self.end_time
+
+    def pulse_us(self, at):
+        '''Returns the pulse length in microseconds at a time.
+
+        Args:
+          at: float, the clock.monotonic() time.
+
+        Returns:
+          int, the pulse length, or 0 to let the servo idle.'''
+        value = self.position(at)
         if value is None:
-            self.pulse_us = 0
+            return 0
+        value = max(0, min(1, value))
+        return int(self.offset_us + self.scale_us*value)
+
+
+class WaveDriver(object):
+    '''Sends the pulses for all the servos as streamed pigpio waves.
+
+    Pulses are sent in segments of at least SEGMENT_US, and a whole number
+    of the schedule's hyperperiods. Each segment is built from the servos'
+    motions just before the previous one ends, and is queued to start as it
+    ends. So a new position or motion is sent within about one segment of the
+    message arriving, even during a sweep.
+
+    The pulses are placed by a pulse_scheduler.PulseSchedule to keep peak
+    power draw within a budget.'''
+
+    # The minimum time in microseconds of each segment.
+    SEGMENT_US = 40000
+
+    # The time in microseconds before a segment ends to queue the next.
+    LEAD_US = 10000
+
+    def __init__(self, pi, servos, schedule):
+        '''Constructor.
+
+        Args:
+          pi: pigpio.pi, the connection to pigpio.
+          servos: List[Servo], the servos.
+          schedule: pulse_scheduler.PulseSchedule, for the servos.'''
+        self.pi = pi
+        self.servos = servos
+        self.schedule = schedule
+        period_us = schedule.period_us
+        self.segment_us = period_us * -(-self.SEGMENT_US // period_us)
+        # The waves that have been sent, oldest first, and the time the last
+        # one ends. Streaming is True while segments are sent back to back.
+        self.waves = []
+        self.segment_end = 0
+        self.streaming = False
+        # Statistics for ServoHandler.servo_stats().
+        self.segments = 0
+        self.late_segments = 0
+        self.commands = 0
+
+    def send(self, now):
+        '''Sends the pulses that follow those already sent.
+
+        Args:
+          now: float, the clock.monotonic() time.
+
+        Returns:
+          Tuple[Union[List[float], None], Union[float, None]], the time of
+          each servo's first new pulse, or None if none were sent, and the
+          time to call send() again, or None to call it when a servo's motion
+          changes.'''
+        self._delete_waves()
+        start = self.segment_end
+        if start > now:
+            # A sync wave starts when the current one ends.
+            mode = pigpio.WAVE_MODE_ONE_SHOT_SYNC
         else:
-            value = max(0, min(1, value))
-            self.pulse_us = int(self.offset_us + self.scale_us*value)
+            if self.streaming:
+                # The previous segment has ended, leaving a gap.
+                self.late_segments += 1
+            mode = pigpio.WAVE_MODE_ONE_SHOT
+            start = now
+
+        self.pi.wave_add_generic(self._get_pulses(start))
+        wave = self.pi.wave_create()
+        self.pi.wave_send_using_mode(wave, mode)
+        self.commands += 3
+        self.waves.append(wave)
+        self.streaming = True
+        self.segments += 1
+        self.segment_end = start + self.segment_us / 1000000
+
+        starts = [start + offset / 1000000
+                  for offset in self.schedule.offsets]
+        return starts, self.segment_end - self.LEAD_US / 1000000
+
+    def stop(self):
+        '''Stops sending once the pulses already sent have finished.'''
+        self.streaming = False
+        self._delete_waves()
+
+    def _delete_waves(self):
+        '''Deletes the waves that have been sent.
+
+        The wave being sent, and any queued after it, are kept.'''
+        current = self.pi.wave_tx_at()
+        self.commands += 1
+        while self.waves and self.waves[0] != current:
+            self.pi.wave_delete(self.waves.pop(0))
+            self.commands += 1
+
+    def _get_pulses(self, start):
+        '''Gets the list of pulse instructions for a segment.
+
+        Each pulse's width is from the servo's position as the pulse starts.
+
+        Args:
+          start: float, the clock.monotonic() time of the segment.'''
+        pulses = []
+        for idx, servo in enumerate(self.servos):
+            for offset in self.schedule.starts(idx, self.segment_us):
+                pulse_us = servo.pulse_us(start + offset / 1000000)
+                # Skip zero pulse widths, otherwise pigpio sends single
+                # microsecond signals on the pin.
+                if pulse_us:
+                    pulses.append((offset, pulse_us, servo.pin))
+        return [pigpio.pulse(*step)
+                for step in pulse_scheduler.to_steps(pulses, self.segment_us)]
+
+
+class HybridDriver(WaveDriver):
+    '''Streams waves while servos move, and holds still servos with pigpio's
+    servo pulses.
+
+    pigpio times its servo pulses with DMA, as it does waves, and repeats
+    them without further commands. So holding a position costs one command
+    when it changes, rather than a new wave every segment. Waves are still
+    used during motion, where interleaving the pulses matters most.
+
+    pigpio's servo pulses are sent every HOLD_PERIOD_US, are not placed by
+    the schedule, and start within a period of being set. If any servo has
+    another period then all pulses are sent as waves.'''
+
+    # The period of pigpio's servo pulses.
+    HOLD_PERIOD_US = 20000
+
+    def __init__(self, pi, servos, schedule):
+        '''Constructor, see WaveDriver.'''
+        super().__init__(pi, servos, schedule)
+        # A Map[int, int] of pins and the servo pulse widths set.
+        self.widths = {}
+        self.holds = all(servo.period_us == self.HOLD_PERIOD_US
+                         for servo in servos)
+
+    def send(self, now):
+        '''Sends the pulses that follow those already sent, see
+        WaveDriver.send().'''
+        if not self.holds:
+            return super().send(now)
+        changed = any(servo.changed_at is not None for servo in self.servos)
+        if any(servo.moving(now) for servo in self.servos) or (
+                changed and self.segment_end > now):
+            # A change during a wave is streamed, as the wave may not end
+            # until the segment after.
+            self._hold(lambda servo: 0)
+            return super().send(now)
+        if self.segment_end > now:
+            # Wait for the waves to finish.
+            return None, self.segment_end
+        self.stop()
+        self._hold(lambda servo: servo.pulse_us(now))
+        return [now] * len(self.servos), None
+
+    def stop(self):
+        '''Stops sending, see WaveDriver.stop().'''
+        super().stop()
+        self._hold(lambda servo: 0)
+
+    def _hold(self, width):
+        '''Sets the servo pulse widths that have changed.
+
+        Args:
+          width: Callable[[Servo], int], the pulse width for a servo, or 0
+            for no pulses.'''
+        for servo in self.servos:
+            pulse_us = width(servo)
+            if self.widths.get(servo.pin, 0) != pulse_us:
+                self.pi.set_servo_pulsewidth(servo.pin, pulse_us)
+                self.commands += 1
+                self.widths[servo.pin] = pulse_us
+
+
+# The servo drivers, by name.
+SERVO_DRIVERS = {
+    'wave': WaveDriver,
+    'hybrid': HybridDriver,
+}
 
 
 class ServoHandler(task.Task):
     '''Controls a number of servos.
 
     Binds to:
-      Output.set_servo(index: int, value: float)
-      Output.sweep_servos(duration: float, sweps: List([int, float, float]))
+      Output.set_servo(index: int, value: Union[float, None])
+      Output.move_servo(index: int, value: float, duration: float)
+      Output.sweep_servos(duration: float, sweeps: List([int, float, float]))
+      Output.servo_stats() -> Dict[String, Any]
 
-    Avoids power spikes by interleaving servo movements.
+    Avoids power spikes by scheduling pulses within a current budget, see
+    pulse_scheduler.py. Each servo may have its own pulse period.
     Avoids jitter by idling after a configurable period of inactivity.
+
+    The pulses are sent by a driver from SERVO_DRIVERS. WaveDriver streams
+    all pulses as waves, and HybridDriver uses waves only while servos move.
+    Either way a change is sent within about a wave segment of the message
+    arriving, even during a sweep. set_servo() and sweep_servos() replace the
+    current motion, while move_servo() continues from the current position.
+
+    The time from a message being handled to its first pulse is measured,
+    along with the pigpio commands and CPU time used to send pulses, and the
+    time spent driving and idle. These are reported by servo_stats() and
+    when the servos idle.
     '''
 
     # A common servo standard is to send pulses at 50Hz which is every 0.02
-    # seconds.
+    # seconds. This is the default period.
     FRAME_PERIOD_US = 20000
 
-    def __init__(self, task_args, config, drive_time=2):
+    def __init__(self, task_args, config, drive_time=2, driver='wave',
+                 current_budget=1):
         '''Constructor.
 
         Args:
-          config: Tuple[Tuple[int, float, float]], the servos to use.
-          drive_time: float, the time in seconds to drive the servos for.
+          config: Tuple[Dict[String, Any]], the servos to use, as arguments
+            to add().
+          drive_time: float, the time in seconds to drive the servos for
+            after they stop moving.
+          driver: String, the name of a driver in SERVO_DRIVERS.
+          current_budget: float, the maximum total current of the servo
+            pulses that are high at once.
+
+        Raises:
+          ValueError: The servo pulses do not fit within the current budget.
         '''
         super().__init__(task_args)
         self.drive_time = drive_time
-        self.last_change = time.monotonic()
+        # The servos idle when the timer set by _drive() runs.
+        self.idle = False
+        self.idle_timer = None
+        # The total times in seconds spent driving and idle, up to when the
+        # servos last started or stopped driving.
+        self.total_drive = 0
+        self.total_idle = 0
+        self.idle_changed_at = clock.monotonic()
+        self._drive()
+
+        # Statistics for servo_stats().
+        self.updates = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.cpu_time = 0
 
         # Connect to pigpio.
         self.pi = pigpio.pi()
@@ -85,27 +365,39 @@ class ServoHandler(task.Task):
         self.servos = []
         for item in config:
             self.add(**item)
+        schedule = pulse_scheduler.PulseSchedule(
+            [(servo.period_us, servo.max_pulse_us, servo.current)
+             for servo in self.servos], current_budget)
+        self.driver = SERVO_DRIVERS[driver](self.pi, self.servos, schedule)
 
         self.bind('Output.set_servo', self.set_servo)
+        self.bind('Output.move_servo', self.move_servo)
         self.bind('Output.sweep_servos', self.sweep_servos)
+        self.bind('Output.servo_stats', self.servo_stats)
 
     def run(self):
         '''The task's main loop.
 
         Processes messages and sends pulses.'''
-        while self.process_messages(batch=True, block=self._is_idle()):
-            if not self._is_idle():
-                # Send the pulses to the servos.
-                # To reduce CPU usage sends batches of 5 pulses at a time.
-                self._send_pulses(self._get_pulses(), 5)
+        while self.process_messages(batch=True, block=self.idle):
+            if not self.idle and not self._send():
+                break
+        self.driver.stop()
 
-    def add(self, pin, start_pulse=0.001, end_pulse=0.002):
+    def add(self, pin, start_pulse=0.001, end_pulse=0.002, period=None,
+            current=1):
         '''Adds a servo with the supplied config.
 
+        Servos can only be added by the constructor.
+
         Args:
           pin: int, the BCM pin number the servo is connected to.
           start_pulse: float, the pusle length in seconds at position 0.
           end_pulse: float, the pusle length in seconds at position 1.
+          period: Union[float, None], the time in seconds between pulses, or
+            None for FRAME_PERIOD_US.
+          current: float, the current the servo draws during a pulse, in the
+            same units as the current budget.
         '''
         # Set up the pin.
         self.pi.set_mode(pin, pigpio.OUTPUT)
@@ -113,20 +405,41 @@ class ServoHandler(task.Task):
         # Convert (start, end) to and (offset, scale) for easier maths.
         offset = start_pulse
         scale = end_pulse - start_pulse
-        self.servos.append(Servo(pin, offset, scale))
+        if period is None:
+            period_us = self.FRAME_PERIOD_US
+        else:
+            period_us = int(round(period * 1000000))
+        self.servos.append(Servo(pin, offset, scale, period_us, current))
 
     def set_servo(self, idx, value):
         '''Sets a servos position.
 
         Args:
           idx: int, the servo index.
-          value: float, the position between 0 and 1.'''
-        # Update the servo.
-        servo = self.servos[idx]
-        self.servos[idx].set_position(value)
+          value: Union[float, None], the position between 0 and 1, or None to
+            let the servo idle.'''
+        now = clock.monotonic()
+        self.servos[idx].move(value, value, now, now)
 
         # Trigger driving.
-        self.last_change = time.monotonic()
+        self._drive()
+
+    def move_servo(self, idx, value, duration):
+        '''Moves a servo from its current position.
+
+        Args:
+          idx: int, the servo index.
+          value: float, the position between 0 and 1 to move to.
+          duration: float, the time in seconds to move over.
+
+        A servo that is idle jumps to the position.'''
+        now = clock.monotonic()
+        servo = self.servos[idx]
+        start = servo.position(now)
+        if start is None:
+            start = value
+        servo.move(start, value, now, now + duration)
+        self._drive(duration)
 
     def sweep_servos(self, duration, sweeps):
         '''Sweeps any number of servos in parallel.
@@ -142,85 +455,82 @@ class ServoHandler(task.Task):
           start and end are normalised positions (0-1)
           duration is in seconds.
 
-        This message is blocking.
+        The sweeps replace the servos' current motions. This message returns
+        at once.
         '''
-        duration_us = duration * 1000000
-
-        # Round up to the next frame period.
-        frame_us = self.FRAME_PERIOD_US
-        duration_us = int(math.ceil(duration_us/frame_us)*frame_us)
-
-        # Build up a complete set of pulses for the entire duration
-        pulses = []
-        for us in range(0, duration_us, frame_us):
-            norm_pos = us / (duration_us - frame_us)
-            for idx, start, end in sweeps:
-                self.servos[idx].set_position(start + (end-start) * norm_pos)
-            pulses += self._get_pulses()
-
-        # Send the pulses.
-        self._send_pulses(pulses)
-
-        # Trigger the idle logic.
-        self.last_change = time.monotonic()
-
-    def _is_idle(self):
-        '''Returns True if the servos should be idle.'''
-        return time.monotonic() > self.last_change + self.drive_time
-
-    def _get_pulses(self):
-        '''Gets the list of pulse instructions to send to pigpio.
-
-        The instructions are for one pulse per servo.
-        The pulses are interleaved to reduce peak power draw.
-        '''
-        count = len(self.servos)
-        frame_duration = self.FRAME_PERIOD_US // count
-        pulses = []
-        for servo in self.servos:
-            # Handle zero pulse widths specially, otherwise pigpio sends
-            # single microsecond signals on the pin.
-            if servo.pulse_us:
-                # Pulses use a bitwise pin mask rather than a single pin.
-                pin_mask = 1 << servo.pin
-                pulses += [
-                    # Turn on for the pulse time.
-                    pigpio.pulse(pin_mask, 0, servo.pulse_us),
-                    # Turn off for the rest of the frame.
-                    pigpio.pulse(0, pin_mask, frame_duration - servo.pulse_us),
-                ]
-            else:
-                pulses += [
-                    # Do nothing for the entire frame.
-                    pigpio.pulse(0, 0, frame_duration),
-                ]
-        return pulses
-
-    def _send_pulses(self, pulses, repeat=1):
-        '''Sends a list of pulses a number of times.
-
-        Args:
-          pulses: result of _get_pulses().
-          repeat: int, the number of times to send the pulses.'''
-        # Create a pi wave.
-        self.pi.wave_add_generic(pulses)
-        duration = (self.pi.wave_get_micros() / 1000000) * (repeat)
-        wave = self.pi.wave_create()
-
-        try:
-            # Send the pi wave using the programmable chain method.
-            self.pi.wave_chain([
-                255, 0, # Loop start.
-                wave,
-                255, 1, repeat & 0xff, repeat >> 8, # Repeat repeat times.
-            ])
-
-            # Process messages for the entire duration.
-            self.process_messages(duration)
-
-            # Process messages while the wave completes.
-            while self.pi.wave_tx_at() == wave:
-                self.process_messages(self.FRAME_PERIOD_US / 1000000 / 2)
-        finally:
-            # Release the pi wave.
-            self.pi.wave_delete(wave)
+        now = clock.monotonic()
+        for idx, start, end in sweeps:
+            self.servos[idx].move(start, end, now, now + duration)
+
+        # Trigger the idle logic for after the sweep.
+        self._drive(duration)
+
+    def servo_stats(self):
+        '''Returns statistics for the pulses sent.
+
+        Returns:
+          Dict[String, Any], the number of wave segments sent and the number
+          that started late, leaving a gap in the pulses, the number of
+          pigpio commands and the CPU time in seconds used to send pulses,
+          the number of updates and the mean and maximum times in
+          milliseconds from a message to its first pulse, and the total
+          times in seconds that the servos have been driven and idle.'''
+        elapsed = clock.monotonic() - self.idle_changed_at
+        return dict(
+            segments=self.driver.segments,
+            late_segments=self.driver.late_segments,
+            commands=self.driver.commands,
+            cpu_time=self.cpu_time,
+            updates=self.updates,
+            latency_mean_ms=1000 * self.total_latency / max(1, self.updates),
+            latency_max_ms=1000 * self.max_latency,
+            drive_seconds=self.total_drive + (0 if self.idle else elapsed),
+            idle_seconds=self.total_idle + (elapsed if self.idle else 0))
+
+    def _drive(self, duration=0):
+        '''Drives the servos for drive_time after duration, then idles.'''
+        self._set_idle_state(False)
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        self.idle_timer = self.call_later(
+            duration + self.drive_time, self._set_idle)
+
+    def _set_idle(self):
+        '''Called by the idle timer.'''
+        self._set_idle_state(True)
+        self.driver.stop()
+        log.info('servos idle %s', self.servo_stats())
+
+    def _set_idle_state(self, idle):
+        '''Sets whether the servos idle, adding up the time in each state.'''
+        now = clock.monotonic()
+        if self.idle:
+            self.total_idle += now - self.idle_changed_at
+        else:
+            self.total_drive += now - self.idle_changed_at
+        self.idle = idle
+        self.idle_changed_at = now
+
+    def _send(self):
+        '''Sends pulses with the driver, then processes messages until it is
+        next due.
+
+        Returns:
+          False if the task should exit, otherwise True.'''
+        started = _thread_cpu_time()
+        starts, due = self.driver.send(clock.monotonic())
+        self.cpu_time += _thread_cpu_time() - started
+
+        # Record the time from each change to its first pulse.
+        for servo, start in zip(self.servos, starts or ()):
+            if servo.changed_at is not None:
+                latency = max(0, start - servo.changed_at)
+                servo.changed_at = None
+                self.updates += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+        if due is None:
+            # Wait for a message or the idle timer.
+            return self.process_messages(batch=True)
+        return self.process_messages(max(0, due - clock.monotonic()))
@@ -0,0 +1,827 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Runs the whole system against a virtual clock, with stand-in hardware.
+
+The TaskManager and the tasks are started as alto.main() starts them, with
+the same configuration, but every task is hosted as a thread. The threads
+take turns to run and the clock only advances when all of them are waiting,
+so a run is repeatable and hours of interaction take seconds.
+
+The camera and engine are replaced by a StandInEngine, which classifies a
+scripted Scene. pigpio and RPi.GPIO are replaced by stand-in modules, so
+the servo and button code runs as it does on a Raspberry Pi.'''
+
+import argparse
+import collections
+import functools
+import logging
+import random
+import statistics
+import sys
+import threading
+import time
+import types
+
+import clock
+import pulse_scheduler
+from match_filter import MatchFilter
+import task
+
+
+log = logging.getLogger('simulation')
+
+
+class _Waiter(object):
+    '''A thread waiting for its turn to run.'''
+
+    def __init__(self, lock, predicate, deadline):
+        '''Constructor.
+
+        Args:
+          lock: threading.Lock, the VirtualClock's lock.
+          predicate: Callable[[], Any], the thread can run once this is true.
+          deadline: Union[float, None], the thread can run at this time.'''
+        self.condition = threading.Condition(lock)
+        self.predicate = predicate
+        self.deadline = deadline
+        self.ready = False
+
+
+class VirtualClock(clock.Clock):
+    '''A clock whose time only advances when every thread is waiting.
+
+    Threads started with start_thread() run one at a time. A thread runs
+    until it waits, and then the thread that has waited longest of those
+    that can continue runs next. When none can continue, the time jumps to
+    the earliest deadline.
+
+    Threads must only wait using this clock. A thread that blocks in any
+    other way stops the simulation.'''
+
+    def __init__(self, start=0.0):
+        '''Constructor.
+
+        Args:
+          start: float, the initial time in seconds.'''
+        self.now = start
+        self.lock = threading.Lock()
+        # A List[_Waiter] of the waiting threads, in the order they waited.
+        self.waiters = []
+        # The time at which run() returns.
+        self.until = None
+        # Set when no thread can run before until.
+        self.idle = threading.Event()
+        # The number of times a thread has been chosen to run.
+        self.switches = 0
+
+    def monotonic(self):
+        '''Returns the virtual time in seconds.'''
+        return self.now
+
+    def sleep(self, seconds):
+        '''Waits for a virtual time.'''
+        self.wait(lambda: False, seconds)
+
+    def wait_for(self, condition, predicate, timeout=None):
+        '''Waits until a predicate is true, see Clock.wait_for().
+
+        The condition is released while waiting. A thread that does not need
+        to wait carries on running.'''
+        result = predicate()
+        if result or (timeout is not None and timeout <= 0):
+            return result
+        condition.release()
+        try:
+            return self.wait(predicate, timeout)
+        finally:
+            condition.acquire()
+
+    def wait(self, predicate, timeout=None):
+        '''Waits for the thread's turn to run.
+
+        Args:
+          predicate: Callable[[], Any], the thread can run once this is true.
+            It is evaluated by whichever thread is choosing the next to run.
+          timeout: Union[float, None], the virtual time in seconds to wait,
+            or None to wait forever.
+
+        Returns:
+          Any, the result of the predicate.'''
+        deadline = None if timeout is None else self.now + timeout
+        with self.lock:
+            waiter = _Waiter(self.lock, predicate, deadline)
+            self.waiters.append(waiter)
+            self._switch()
+            while not waiter.ready:
+                waiter.condition.wait()
+        return predicate()
+
+    def start_thread(self, target, name):
+        '''Starts a thread that waits for its turn before running target.'''
+        waiter = _Waiter(self.lock, lambda: True, None)
+        with self.lock:
+            self.waiters.append(waiter)
+
+        def run():
+            with self.lock:
+                while not waiter.ready:
+                    waiter.condition.wait()
+            try:
+                target()
+            finally:
+                with self.lock:
+                    self._switch()
+
+        return super().start_thread(run, name)
+
+    def pipe(self):
+        '''Creates an in-memory connection for the results of calls.'''
+        connection = task.LocalConnection({})
+        return connection, connection
+
+    def queue(self):
+        '''Creates an in-memory queue for messages to the TaskManager.'''
+        return task.LocalConnection({})
+
+    def run(self, until=None):
+        '''Runs the threads until none can run.
+
+        Called from a thread that was not started by this clock.
+
+        Args:
+          until: Union[float, None], the virtual time to stop at, or None to
+            run until every thread is waiting forever or stop() is called.'''
+        with self.lock:
+            self.until = until
+            self.idle.clear()
+            self._switch()
+        self.idle.wait()
+
+    def stop(self):
+        '''Stops run() once the threads that can run at this time have.'''
+        with self.lock:
+            self.until = self.now
+
+    def _switch(self):
+        '''Chooses the next thread to run, with the lock held.'''
+        while True:
+            for waiter in self.waiters:
+                if ((waiter.deadline is not None and
+                        waiter.deadline <= self.now) or waiter.predicate()):
+                    self.waiters.remove(waiter)
+                    self.switches += 1
+                    waiter.ready = True
+                    waiter.condition.notify()
+                    return
+            deadlines = [waiter.deadline for waiter in self.waiters
+                         if waiter.deadline is not None]
+            if not deadlines:
+                break
+            deadline = min(deadlines)
+            if self.until is not None and deadline > self.until:
+                break
+            self.now = deadline
+        self.idle.set()
+
+
+class Scene(object):
+    '''What the stand-in camera sees.'''
+
+    def __init__(self):
+        '''Constructor.'''
+        # The object in view, or None.
+        self.view = None
+
+    def show(self, obj):
+        '''Puts an object in view.
+
+        Args:
+          obj: Union[Any, None], the object, or None for the background.'''
+        self.view = obj
+
+
+class StandInEngine(task.Task):
+    '''Stands in for ImprintEngineTask by classifying a Scene.
+
+    Binds to:
+      Engine.idle()
+      Engine.start_learning(label: Any, source: Union[int, None])
+      Engine.start_classifying()
+      Engine.reset()
+      Engine.memory_usage() -> Dict[String, Any]
+
+    Emits:
+      Engine.confidences(confidences: Dict[Any, float], source: int)
+      Engine.matched(label: Union[Any, None], source: int)
+      Engine.ready(timings: Dict[String, float])
+
+    A frame is taken from the scene every 1 / fps seconds while learning or
+    classifying. Learning stores what is in view for the label. Classifying
+    draws the k nearest neighbors from the stored frames, where a frame of
+    the object in view is more likely to be drawn than any other by a factor
+    of 1 / similarity. The votes are passed through a MatchFilter, as the
+    engine does. Draws are made with a seeded random generator.'''
+
+    # States
+    IDLE = 0
+    LEARNING = 1
+    CLASSIFYING = 2
+
+    def __init__(self, task_args, scene, confidence=0.8, responsiveness=0.2,
+                 fps=8, k_nearest_neighbors=3, maxlen=1000, similarity=0.05,
+                 seed=0):
+        '''Constructor.
+
+        Args:
+          scene: Scene, the stand-in camera.
+          confidence: float, the MatchFilter confidence threshold.
+          responsiveness: float, the MatchFilter weight.
+          fps: float, the frame rate.
+          k_nearest_neighbors: int, the votes for each frame.
+          maxlen: int, the maximum frames stored per label.
+          similarity: float, the chance of drawing a frame of another object
+            relative to one of the object in view.
+          seed: int, the random seed.'''
+        super().__init__(task_args)
+        self.scene = scene
+        self.confidence = confidence
+        self.responsiveness = responsiveness
+        self.fps = fps
+        self.k_nearest_neighbors = k_nearest_neighbors
+        self.maxlen = maxlen
+        self.similarity = similarity
+        self.random = random.Random(seed)
+
+        self.state = self.IDLE
+        self.label = None
+        # A Map[Any, Deque[Any]] of labels and the objects they were learnt
+        # from.
+        self.store = {}
+        self.matcher = None
+        self.frame_timer = None
+
+        self.bind('Engine.idle', self.idle)
+        self.bind('Engine.start_learning', self.start_learning)
+        self.bind('Engine.start_classifying', self.start_classifying)
+        self.bind('Engine.reset', self.reset)
+        self.bind('Engine.memory_usage', self.memory_usage)
+
+    def run(self):
+        '''The task's main loop.'''
+        self.emit('Engine.ready', {})
+        super().run()
+
+    def idle(self):
+        '''Stops learning / classifying.'''
+        self._set_state(self.IDLE)
+
+    def start_learning(self, label, source=None):
+        '''Starts learning for the given label.'''
+        self.label = label
+        self._set_state(self.LEARNING)
+
+    def start_classifying(self):
+        '''Starts classifying the scene.'''
+        self._set_state(self.CLASSIFYING)
+
+    def reset(self):
+        '''Stops learning / classifying and resets all learning data.'''
+        self._set_state(self.IDLE)
+        self.store.clear()
+
+    def memory_usage(self):
+        '''Returns the number of frames stored for each label.'''
+        return dict(labels={label: len(objs)
+                            for label, objs in self.store.items()})
+
+    def _set_state(self, state):
+        '''Changes state, starting or stopping the frames.'''
+        if self.state == self.CLASSIFYING and self.matcher.label is not None:
+            self.emit('Engine.matched', None, 0)
+        self.state = state
+        if self.frame_timer:
+            self.frame_timer.cancel()
+            self.frame_timer = None
+        if state != self.IDLE:
+            self.matcher = MatchFilter(self.responsiveness, self.confidence)
+            self.frame_timer = self.call_every(1 / self.fps, self._on_frame)
+
+    def _on_frame(self):
+        '''Handles a frame from the scene.'''
+        view = self.scene.view
+        if self.state == self.LEARNING:
+            self.store.setdefault(
+                self.label, collections.deque(maxlen=self.maxlen)).append(view)
+            return
+        if not self.store:
+            return
+
+        labels = list(self.store)
+        weights = []
+        for label in labels:
+            matching = sum(1 for obj in self.store[label] if obj == view)
+            weights.append(matching + self.similarity *
+                           (len(self.store[label]) - matching))
+        votes = collections.Counter(self.random.choices(
+            labels, weights, k=self.k_nearest_neighbors))
+        confidences = {label: votes[label] / self.k_nearest_neighbors
+                       for label in labels}
+        self.emit('Engine.confidences', confidences, 0)
+        if self.matcher.update(confidences):
+            self.emit('Engine.matched', self.matcher.label, 0)
+
+
+class FakePi(object):
+    '''A stand-in for a pigpio.pi connection.
+
+    Input levels are set with set_input(), which runs the callbacks. Waves are
+    timed with the clock, and the pulse width sent to each output pin is
+    recorded in pulse_log whenever it changes.'''
+
+    connected = True
+
+    def __init__(self, clock):
+        '''Constructor.
+
+        Args:
+          clock: Clock, used to time waves and callbacks.'''
+        self.clock = clock
+        # A Map[int, int] of pins and modes.
+        self.modes = {}
+        # A Map[int, int] of input pins and levels.
+        self.levels = {}
+        # A Map[int, List[Callable]] of pins and callbacks.
+        self.callbacks = collections.defaultdict(list)
+        # A Map[int, List[pulse]] of wave IDs and pulses.
+        self.waves = {}
+        self.pulses = []
+        # A List[Tuple[float, float, int]] of the start and end times of the
+        # waves being sent and queued, and their IDs.
+        self.schedule = []
+        # A List[Tuple[float, int, int]] of times, pins and pulse widths in
+        # microseconds.
+        self.pulse_log = []
+        self.widths = {}
+        # A Counter of the wave and servo commands sent, by name.
+        self.commands = collections.Counter()
+
+    def set_mode(self, pin, mode):
+        self.modes[pin] = mode
+
+    def set_pull_up_down(self, pin, pud):
+        self.levels[pin] = 1 if pud == _PUD_UP else 0
+
+    def set_glitch_filter(self, pin, steady):
+        pass
+
+    def callback(self, pin, edge, func):
+        self.callbacks[pin].append(func)
+
+    def set_input(self, pin, level):
+        '''Sets an input pin's level, running the callbacks if it changes.
+
+        Args:
+          pin: int
+          level: int, 0 or 1.'''
+        if self.levels.get(pin) == level:
+            return
+        self.levels[pin] = level
+        tick = int(self.clock.monotonic() * 1000000) & 0xffffffff
+        for func in self.callbacks[pin]:
+            func(pin, level, tick)
+
+    def wave_add_generic(self, pulses):
+        self.commands['wave_add_generic'] += 1
+        self.pulses += pulses
+        return len(self.pulses)
+
+    def wave_get_micros(self):
+        return sum(pulse.delay for pulse in self.pulses)
+
+    def wave_create(self):
+        self.commands['wave_create'] += 1
+        # pigpio reuses the IDs of deleted waves.
+        wave = 0
+        while wave in self.waves:
+            wave += 1
+        self.waves[wave] = self.pulses
+        self.pulses = []
+        return wave
+
+    def wave_delete(self, wave):
+        self.commands['wave_delete'] += 1
+        del self.waves[wave]
+
+    def wave_chain(self, data):
+        '''Sends a chain, which must be a single wave in a loop.'''
+        wave = data[2]
+        repeat = data[5] | data[6] << 8
+        self.commands['wave_chain'] += 1
+        now = self.clock.monotonic()
+        self._stop(now)
+        self._send(wave, now, repeat)
+
+    def wave_send_using_mode(self, wave, mode):
+        '''Sends a wave once, now or after the waves already sent.'''
+        self.commands['wave_send_using_mode'] += 1
+        now = self.clock.monotonic()
+        if mode == _WAVE_MODE_ONE_SHOT_SYNC:
+            start = max([now] + [end for _, end, _ in self.schedule])
+        else:
+            self._stop(now)
+            start = now
+        self._send(wave, start)
+
+    def wave_tx_at(self):
+        self.commands['wave_tx_at'] += 1
+        now = self.clock.monotonic()
+        for start, end, wave in self.schedule:
+            if start <= now < end:
+                return wave
+        return _NO_TX_WAVE
+
+    def set_servo_pulsewidth(self, pin, width):
+        '''Sends servo pulses, which repeat until changed.'''
+        self.commands['set_servo_pulsewidth'] += 1
+        self._log_width(self.clock.monotonic(), pin, width)
+
+    def _send(self, wave, start, repeat=1):
+        '''Schedules a wave and records the widths of its first repeat.'''
+        pulses = self.waves[wave]
+        now = self.clock.monotonic()
+        self.schedule = [item for item in self.schedule if item[1] > now]
+        self.schedule.append((start, start + (
+            sum(pulse.delay for pulse in pulses) * repeat / 1000000), wave))
+
+        outputs = [pin for pin, mode in self.modes.items()
+                   if mode == _OUTPUT]
+        sent = set()
+        for offset, width, pin in pulse_scheduler.replay(pulses):
+            if pin in outputs:
+                sent.add(pin)
+                self._log_width(start + offset / 1000000, pin, width)
+        for pin in outputs:
+            if pin not in sent:
+                self._log_width(start, pin, 0)
+
+    def _stop(self, now):
+        '''Stops sending, forgetting the widths recorded after now.'''
+        self.schedule = []
+        while self.pulse_log and self.pulse_log[-1][0] > now:
+            _, pin, _ = self.pulse_log.pop()
+            self.widths[pin] = next(
+                (width for _, other, width in reversed(self.pulse_log)
+                 if other == pin), None)
+
+    def _log_width(self, at, pin, width):
+        '''Records a pulse width if it has changed.'''
+        if self.widths.get(pin) != width:
+            self.widths[pin] = width
+            self.pulse_log.append((at, pin, width))
+
+
+# pigpio constants used by the stand-in.
+_INPUT = 0
+_OUTPUT = 1
+_PUD_UP = 2
+_EITHER_EDGE = 2
+_NO_TX_WAVE = 9999
+_WAVE_MODE_ONE_SHOT = 0
+_WAVE_MODE_REPEAT = 1
+_WAVE_MODE_ONE_SHOT_SYNC = 2
+_WAVE_MODE_REPEAT_SYNC = 3
+
+# The Simulation that the stand-in modules belong to.
+_current = None
+
+
+def _install_stand_ins():
+    '''Installs stand-in pigpio and RPi.GPIO modules for _current.'''
+    if getattr(sys.modules.get('pigpio'), 'stand_in', False):
+        return
+    pigpio = types.ModuleType('pigpio')
+    pigpio.stand_in = True
+    pigpio.pi = lambda: _current.pi
+    pigpio.pulse = collections.namedtuple(
+        'pulse', ['gpio_on', 'gpio_off', 'delay'])
+    pigpio.INPUT = _INPUT
+    pigpio.OUTPUT = _OUTPUT
+    pigpio.PUD_UP = _PUD_UP
+    pigpio.EITHER_EDGE = _EITHER_EDGE
+    pigpio.NO_TX_WAVE = _NO_TX_WAVE
+    pigpio.WAVE_MODE_ONE_SHOT = _WAVE_MODE_ONE_SHOT
+    pigpio.WAVE_MODE_REPEAT = _WAVE_MODE_REPEAT
+    pigpio.WAVE_MODE_ONE_SHOT_SYNC = _WAVE_MODE_ONE_SHOT_SYNC
+    pigpio.WAVE_MODE_REPEAT_SYNC = _WAVE_MODE_REPEAT_SYNC
+    sys.modules['pigpio'] = pigpio
+
+    gpio = types.ModuleType('RPi.GPIO')
+    gpio.BCM = 11
+    gpio.OUT = 0
+    gpio.setmode = lambda mode: None
+    gpio.setup = lambda pin, mode: None
+    gpio.output = lambda pin, value: None
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    sys.modules['RPi'] = rpi
+    sys.modules['RPi.GPIO'] = gpio
+
+
+class Simulation(object):
+    '''Runs the system against a VirtualClock.
+
+    A script drives the simulation. It is a function that is passed the
+    Simulation, and uses show(), press() and sleep() to act out an
+    interaction. It runs once the system has started, and the simulation
+    stops when it returns.
+
+    The messages in RECORDED are recorded in events as they are dispatched,
+    and the servo pulse widths are recorded in pi.pulse_log and the pigpio
+    commands counted in pi.commands.'''
+
+    # The messages recorded in events.
+    RECORDED = (
+        'ButtonHandler.single_button_pressed',
+        'ButtonHandler.both_buttons_pressed',
+        'ButtonHandler.chord_pressed',
+        'ButtonHandler.double_pressed',
+        'Engine.idle',
+        'Engine.start_learning',
+        'Engine.start_classifying',
+        'Engine.reset',
+        'Engine.matched',
+        'Output.set_servo',
+        'Output.move_servo',
+        'Output.sweep_servos',
+    )
+
+    def __init__(self, confidence=None, responsiveness=None, fps=8,
+                 similarity=0.05, seed=0, servo_driver=None):
+        '''Constructor.
+
+        Args:
+          confidence: Union[float, None], overrides the confidence in
+            alto.py.
+          responsiveness: Union[float, None], overrides the responsiveness in
+            alto.py.
+          fps: float, the StandInEngine frame rate.
+          similarity: float, see StandInEngine.
+          seed: int, the StandInEngine random seed.
+          servo_driver: Union[String, None], overrides the servo driver in
+            alto.py.'''
+        self.confidence = confidence
+        self.responsiveness = responsiveness
+        self.fps = fps
+        self.similarity = similarity
+        self.seed = seed
+        self.servo_driver = servo_driver
+        self.clock = VirtualClock()
+        self.scene = Scene()
+        self.pi = FakePi(self.clock)
+        # A List[Tuple[float, String, Tuple]] of times, message names and
+        # arguments.
+        self.events = []
+        # A List[Tuple[float, Union[Any, None]]] of times and objects shown.
+        self.shows = []
+        self.started = False
+        self.error = None
+
+    @property
+    def now(self):
+        '''The virtual time in seconds.'''
+        return self.clock.now
+
+    def run(self, script, until=None):
+        '''Runs the system and the script.
+
+        Args:
+          script: Callable[[Simulation], None], acts out the interaction.
+          until: Union[float, None], the virtual time to stop at, or None to
+            stop when the script returns.
+
+        Raises:
+          Exception: The system stopped with an error.'''
+        global _current
+        _current = self
+        _install_stand_ins()
+        previous = clock.set_clock(self.clock)
+        try:
+            self.clock.start_thread(self._run_manager, 'manager')
+            self.clock.start_thread(lambda: self._run_script(script),
+                                    'script')
+            self.clock.run(until)
+        finally:
+            clock.set_clock(previous)
+        if self.error:
+            raise self.error
+
+    def sleep(self, seconds):
+        '''Waits, from the script.
+
+        Args:
+          seconds: float, the virtual time to wait.'''
+        self.clock.sleep(seconds)
+
+    def show(self, obj):
+        '''Puts an object in front of the camera, from the script.
+
+        Args:
+          obj: Union[Any, None], the object, or None for the background.'''
+        self.scene.show(obj)
+        self.shows.append((self.clock.now, obj))
+
+    def press(self, idx, duration=0.1):
+        '''Presses and releases a button, from the script.
+
+        Args:
+          idx: int, the button index.
+          duration: float, the time in seconds to hold the button.'''
+        import alto
+
+        pin = alto.BUTTON_PINS[idx]
+        self.pi.set_input(pin, 0)
+        self.sleep(duration)
+        self.pi.set_input(pin, 1)
+
+    def press_all(self, duration=1):
+        '''Presses and releases all the buttons together, from the script.
+
+        Args:
+          duration: float, the time in seconds to hold the buttons.'''
+        import alto
+
+        for pin in alto.BUTTON_PINS:
+            self.pi.set_input(pin, 0)
+        self.sleep(duration)
+        for pin in alto.BUTTON_PINS:
+            self.pi.set_input(pin, 1)
+
+    def matches(self):
+        '''Returns the matches.
+
+        Returns:
+          List[Tuple[float, Union[Any, None]]], the times and labels.'''
+        return [(at, args[0]) for at, name, args in self.events
+                if name == 'Engine.matched']
+
+    def _record(self, name, *args):
+        '''Records a message.'''
+        self.events.append((self.clock.now, name, args))
+
+    def _run_manager(self):
+        '''Starts the tasks as alto.main() does and runs the TaskManager.'''
+        import alto
+
+        try:
+            manager = task.TaskManager(placement={
+                name: task.THREAD for name in [
+                    'StandInEngine', 'ServoHandler', 'AltoUI',
+                    'ButtonHandler']})
+            for name in self.RECORDED:
+                manager.bind(name, functools.partial(self._record, name))
+            confidence = self.confidence
+            if confidence is None:
+                confidence = alto.CONFIDENCE
+            responsiveness = self.responsiveness
+            if responsiveness is None:
+                responsiveness = alto.RESPONSIVENESS
+            manager.start(StandInEngine, self.scene, confidence,
+                          responsiveness, self.fps, 3, 1000, self.similarity,
+                          self.seed)
+            manager.start('servo_handler.ServoHandler', alto.SERVO_CFG,
+                          alto.SERVO_DRIVE_TIME,
+                          self.servo_driver or alto.SERVO_DRIVER,
+                          alto.SERVO_CURRENT_BUDGET)
+            manager.start('ui.AltoUI')
+            manager.start('button_handler.ButtonHandler',
+                          len(alto.BUTTON_PINS), alto.BUTTON_HOLD_TIME,
+                          alto.BUTTON_DOUBLE_PRESS_TIME)
+            alto.set_up_buttons(manager, alto.BUTTON_PINS)
+            manager.emit('System.started')
+            self.started = True
+            manager.process_messages()
+        except Exception as exc:
+            log.exception('the system stopped')
+            self.error = exc
+            self.clock.stop()
+
+    def _run_script(self, script):
+        '''Runs the script once the system has started.'''
+        self.clock.wait(lambda: self.started or self.error)
+        try:
+            if not self.error:
+                script(self)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.clock.stop()
+
+
+def run_sessions(sim, hours, objects=('cup', 'pen'), seed=0):
+    '''A script that trains a label for each object and then shows them.
+
+    Each object is trained with a press of its button. Then for the given
+    number of hours, an object or nothing is shown at random for between 5
+    seconds and a minute. Each label is retrained on average once an hour.
+
+    Args:
+      sim: Simulation
+      hours: float, the time to show objects for.
+      objects: Sequence[String], the objects, one for each button.
+      seed: int, the random seed.'''
+    rng = random.Random(seed)
+    for idx, obj in enumerate(objects):
+        sim.show(obj)
+        sim.press(idx)
+        # Training takes about 6 seconds.
+        sim.sleep(8)
+    sim.show(None)
+    sim.sleep(2)
+
+    end = sim.now + hours * 3600
+    while sim.now < end:
+        shown = rng.choice(list(objects) + [None])
+        sim.show(shown)
+        if shown is not None and rng.random() < 1 / 120:
+            sim.press(objects.index(shown))
+        sim.sleep(rng.uniform(5, 60))
+
+
+def summarize(sim, objects=('cup', 'pen')):
+    '''Returns the time taken to match each object after it is shown.
+
+    Args:
+      sim: Simulation, which has run run_sessions().
+      objects: Sequence[String], the objects, one for each button.
+
+    Returns:
+      Dict[String, Any], the number of objects shown and matched, and the
+      mean and maximum times in seconds to match them.'''
+    # The label of each object is its button index.
+    shows = sim.shows
+    matches = sim.matches()
+    delays = []
+    missed = 0
+    for (at, obj), (end, _) in zip(shows, shows[1:] + [(sim.now, None)]):
+        if obj is None:
+            continue
+        label = objects.index(obj)
+        matched = [match_at for match_at, match in matches
+                   if at <= match_at < end and match == label]
+        # The object may still be matched from the previous showing.
+        current = [match for match_at, match in matches if match_at < at]
+        if current and current[-1] == label:
+            delays.append(0)
+        elif matched:
+            delays.append(matched[0] - at)
+        else:
+            missed += 1
+    return dict(
+        shown=len(delays) + missed, missed=missed,
+        delay_mean=statistics.mean(delays) if delays else 0,
+        delay_max=max(delays) if delays else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='''
+Simulates training and using Alto against a virtual clock, and reports how
+quickly shown objects are matched.''')
+    parser.add_argument('--hours', type=float, default=1, help='''
+The virtual time to show objects for.''')
+    parser.add_argument('--seed', type=int, default=0, help='''
+The random seed for the script and the stand-in engine.''')
+    parser.add_argument('--confidence', type=float)
+    parser.add_argument('--responsiveness', type=float)
+    parser.add_argument('--fps', type=float, default=8, help='''
+The stand-in engine's frame rate.''')
+    parser.add_argument('--servo-driver', choices=['wave', 'hybrid'], help='''
+The servo driver, overriding SERVO_DRIVER in alto.py.''')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+
+    sim = Simulation(args.confidence, args.responsiveness, args.fps,
+                     seed=args.seed, servo_driver=args.servo_driver)
+    start_time = time.monotonic()
+    sim.run(lambda sim: run_sessions(sim, args.hours, seed=args.seed))
+    elapsed = time.monotonic() - start_time
+    print('{:.0f}s simulated in {:.1f}s, {} thread switches'.format(
+        sim.now, elapsed, sim.clock.switches))
+    print('{} messages recorded'.format(len(sim.events)))
+    print('{} pigpio commands, {:.0f} per hour'.format(
+        sum(sim.pi.commands.values()),
+        sum(sim.pi.commands.values()) * 3600 / sim.now))
+    print(summarize(sim))
@@ -0,0 +1,291 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Snapshots of the embedding store, for copying learning between units.
+
+A snapshot file is a header followed by blocks of embeddings. The header
+holds the format version, the key of the model the embeddings came from,
+the block data type and the embedding size. Each block holds up to
+block_rows embeddings for one label, compressed with zlib.
+
+Blocks are either float16, or int8 with a float32 scale per row. Files are
+written and read a block at a time, so writing does not copy the store.
+Importing reads the whole file before changing the store, so that an
+invalid file leaves the store as it was.
+
+Labels are stored as JSON. Lists are read back as tuples, so that the
+labels of a store that is not shared between sources survive.'''
+
+import argparse
+import collections
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from knn_store import KNNStore
+
+
+MAGIC = b'ALTOSNAP'
+VERSION = 1
+
+# Block data types.
+FLOAT16 = 'float16'
+INT8 = 'int8'
+DTYPES = {FLOAT16: 1, INT8: 2}
+
+# Magic, version, data type, embedding size and model key length.
+HEADER = struct.Struct('<8sHBIH')
+# Block type, label length, rows and compressed data length.
+BLOCK = struct.Struct('<BIII')
+
+# Block types.
+END = 0
+EMBEDDINGS = 1
+
+# A snapshot header.
+SnapshotInfo = collections.namedtuple('SnapshotInfo', [
+    'version', 'model_key', 'dtype', 'output_size'])
+
+
+def _encode_label(label):
+    return json.dumps(label).encode('utf-8')
+
+
+def _decode_label(data):
+    def to_tuple(value):
+        if isinstance(value, list):
+            return tuple(to_tuple(item) for item in value)
+        return value
+    return to_tuple(json.loads(data.decode('utf-8')))
+
+
+def iter_store(store, block_rows=256):
+    '''Yields the embeddings in a store a block at a time.
+
+    Args:
+      store: KNNStore
+      block_rows: int, the maximum rows in a block.
+
+    Returns:
+      Iterator[Tuple[Any, numpy.array]], the labels and embedding rows.'''
+    for label, embeddings in list(store.embedding_map.items()):
+        for start in range(0, len(embeddings), block_rows):
+            yield label, np.array(embeddings[start:start+block_rows])
+
+
+def write_snapshot(f, model_key, output_size, blocks, dtype=FLOAT16):
+    '''Writes a snapshot.
+
+    Args:
+      f: a binary file.
+      model_key: String, identifies the model, see inference_pool.
+      output_size: int, the embedding size.
+      blocks: Iterable[Tuple[Any, numpy.array]], the labels and embedding
+        rows, such as from iter_store().
+      dtype: String, FLOAT16 or INT8.
+
+    Returns:
+      int, the number of embeddings written.
+
+    Raises:
+      ValueError: The dtype is unknown, or a block has the wrong size.'''
+    if dtype not in DTYPES:
+        raise ValueError('Unknown dtype {}'.format(dtype))
+    key = model_key.encode('utf-8')
+    f.write(HEADER.pack(MAGIC, VERSION, DTYPES[dtype], output_size, len(key)))
+    f.write(key)
+
+    count = 0
+    for label, rows in blocks:
+        rows = np.asarray(rows, dtype=np.float32)
+        if rows.ndim != 2 or rows.shape[1] != output_size:
+            raise ValueError('Block for {} has shape {}'.format(
+                label, rows.shape))
+        if dtype == FLOAT16:
+            data = rows.astype('<f2').tobytes()
+        else:
+            scales = np.abs(rows).max(axis=1) / 127
+            scales[scales == 0] = 1
+            quantized = np.round(rows / scales[:, None]).astype(np.int8)
+            data = scales.astype('<f4').tobytes() + quantized.tobytes()
+        data = zlib.compress(data)
+        encoded_label = _encode_label(label)
+        f.write(BLOCK.pack(EMBEDDINGS, len(encoded_label), len(rows),
+                           len(data)))
+        f.write(encoded_label)
+        f.write(data)
+        count += len(rows)
+    f.write(BLOCK.pack(END, 0, 0, 0))
+    return count
+
+
+class SnapshotReader(object):
+    '''Reads a snapshot a block at a time.
+
+    Iterating yields Tuple[Any, numpy.array], the labels and float32
+    embedding rows.'''
+
+    def __init__(self, f):
+        '''Constructor.
+
+        Reads the header.
+
+        Args:
+          f: a binary file.
+
+        Raises:
+          ValueError: The file is not a snapshot, or has a newer version.'''
+        self.file = f
+        magic, version, dtype, output_size, key_length = HEADER.unpack(
+            self._read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('Not a snapshot')
+        if version > VERSION:
+            raise ValueError('Snapshot version {} is not supported'.format(
+                version))
+        dtypes = {code: name for name, code in DTYPES.items()}
+        if dtype not in dtypes:
+            raise ValueError('Unknown dtype {}'.format(dtype))
+        self.info = SnapshotInfo(
+            version, self._read(key_length).decode('utf-8'), dtypes[dtype],
+            output_size)
+
+    def __iter__(self):
+        output_size = self.info.output_size
+        while True:
+            kind, label_length, rows, length = BLOCK.unpack(
+                self._read(BLOCK.size))
+            if kind == END:
+                return
+            label = _decode_label(self._read(label_length))
+            data = zlib.decompress(self._read(length))
+            if self.info.dtype == FLOAT16:
+                embs = np.frombuffer(data, dtype='<f2').astype(np.float32)
+            else:
+                scales = np.frombuffer(data, dtype='<f4', count=rows)
+                embs = np.frombuffer(
+                    data, dtype=np.int8, offset=4 * rows).astype(np.float32)
+                embs = embs.reshape(rows, output_size) * scales[:, None]
+            yield label, embs.reshape(rows, output_size)
+
+    def _read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ValueError('Snapshot is truncated')
+        return data
+
+
+def export_store(path, store, model_key, output_size, dtype=FLOAT16):
+    '''Writes a store to a snapshot file.
+
+    The file is replaced once it has been written, so an existing snapshot
+    is never left half written.
+
+    Args:
+      path: String
+      store: KNNStore
+      model_key: String, identifies the model.
+      output_size: int, the embedding size.
+      dtype: String, FLOAT16 or INT8.
+
+    Returns:
+      int, the number of embeddings written.'''
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        count = write_snapshot(f, model_key, output_size, iter_store(store),
+                               dtype)
+    os.replace(temp_path, path)
+    return count
+
+
+def import_store(path, store, model_key=None, merge=True, dedup=0.999):
+    '''Reads a snapshot file into a store.
+
+    Each label's blocks are merged at once, so that a label over maxlen is
+    subsampled once across its stored and imported embeddings.
+
+    Args:
+      path: String
+      store: KNNStore
+      model_key: Union[String, None], the model the store is used with, or
+        None to skip the check.
+      merge: bool, True to merge into the store, False to replace it.
+      dedup: Union[float, None], see KNNStore.merge().
+
+    Returns:
+      Dict[Any, int], the number of embeddings added for each label.
+
+    Raises:
+      ValueError: The snapshot is invalid or is for a different model. The
+        store is not changed.'''
+    with open(path, 'rb') as f:
+        reader = SnapshotReader(f)
+        if model_key is not None and reader.info.model_key != model_key:
+            raise ValueError('Snapshot is for model {}, not {}'.format(
+                reader.info.model_key, model_key))
+        blocks = collections.OrderedDict()
+        for label, embs in reader:
+            blocks.setdefault(label, []).append(embs)
+    if not merge:
+        store.clear()
+    return {label: store.merge(label, np.concatenate(embs), dedup)
+            for label, embs in blocks.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='''
+Shows, merges and converts snapshots of the embedding store.''')
+    subparsers = parser.add_subparsers(dest='command')
+    info_parser = subparsers.add_parser('info', help='''
+Shows a snapshot's header and the number of embeddings for each label.''')
+    info_parser.add_argument('snapshot')
+    merge_parser = subparsers.add_parser('merge', help='''
+Merges snapshots for the same model into one, which can also be used to
+convert a single snapshot.''')
+    merge_parser.add_argument('output')
+    merge_parser.add_argument('snapshots', nargs='+')
+    merge_parser.add_argument('--dtype', choices=sorted(DTYPES),
+                              default=FLOAT16)
+    merge_parser.add_argument('--maxlen', type=int, default=1000,
+            help='''
+The maximum number of embeddings for each label.''')
+    merge_parser.add_argument('--dedup', type=float, default=0.999,
+            help='''
+The cosine similarity at or above which embeddings are duplicates.''')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        with open(args.snapshot, 'rb') as f:
+            reader = SnapshotReader(f)
+            counts = collections.Counter()
+            for label, embs in reader:
+                counts[label] += len(embs)
+        print('version {} model {} dtype {} size {}'.format(*reader.info))
+        for label, count in sorted(counts.items(), key=str):
+            print('{}: {}'.format(label, count))
+    elif args.command == 'merge':
+        store = KNNStore(maxlen=args.maxlen)
+        info = None
+        for path in args.snapshots:
+            with open(path, 'rb') as f:
+                info = info or SnapshotReader(f).info
+            import_store(path, store, info.model_key, dedup=args.dedup)
+        count = export_store(args.output, store, info.model_key,
+                             info.output_size, args.dtype)
+        print('{} embeddings written'.format(count))
+    else:
+        parser.print_help()
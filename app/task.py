@@ -13,17 +13,202 @@
 # limitations under the License.
 
 import collections
+import contextlib
 import ctypes
+import heapq
+import importlib
+import itertools
 import logging
 import multiprocessing
 import os
+import pickle
 import queue
 import threading
 import time
 
+import bus_trace
+import clock
+import codec
 
-Message = collections.namedtuple('Message', ['name', 'args', 'results'])
-TaskInfo = collections.namedtuple('TaskInfo', ['cls', 'process'])
+
+# The trace field holds the sender's task ID and sequence number when
+# tracing. The TaskManager's ID is its pid.
+Message = collections.namedtuple(
+    'Message', ['name', 'args', 'results', 'trace'])
+Message.__new__.__defaults__ = (None,)
+# The process is a threading.Thread for a task hosted in the TaskManager,
+# and the worker's multiprocessing.Process for a task hosted in the worker.
+TaskInfo = collections.namedtuple('TaskInfo', ['name', 'process', 'task_id'])
+# The communication points passed to a Task's constructor.
+TaskArgs = collections.namedtuple(
+    'TaskArgs', ['sender', 'receiver', 'encode', 'tracer', 'task_id',
+                 'placement'])
+TaskArgs.__new__.__defaults__ = (None, None)
+
+# Task placements.
+PROCESS = 'process'
+THREAD = 'thread'
+WORKER = 'worker'
+
+# The kinds of item sent to the worker subprocess.
+_START = 0
+_SEND = 1
+_SEND_BYTES = 2
+
+
+def _construct(task_cls, args, task_args):
+    '''Constructs a task, importing its class if task_cls is a name.
+
+    Args:
+      task_cls: Union[Task, String], the subclass of Task, or its name in the
+        form 'module.Class'.
+      args: Tuple[Any], the arguments to be passed to the constructor.
+      task_args: TaskArgs
+
+    Returns:
+      Task'''
+    if isinstance(task_cls, str):
+        module_name, name = task_cls.rsplit('.', 1)
+        task_cls = getattr(importlib.import_module(module_name), name)
+    return task_cls(task_args, *args)
+
+
+class _Constructed(object):
+    '''Sent by a subprocess after the messages sent by a task's constructor,
+    when tasks are hosted in the TaskManager.'''
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
+class _Inbox(object):
+    '''An in-memory queue of messages between threads.
+
+    Has the poll() and recv() methods of a Connection, so that it can be read
+    in place of one. Used for the messages passed on by a Task's listener
+    thread, and for the messages sent to the TaskManager when tasks are
+    hosted in its process.'''
+
+    def __init__(self):
+        self.messages = collections.deque()
+        self.condition = threading.Condition()
+
+    def put(self, msg):
+        '''Adds a message and wakes the reader.
+
+        Args:
+          msg: Union[Message, List[Message], None, Exception, object], a
+            message, a batch, None to shut down, an error to raise, or
+            WAKE.'''
+        with self.condition:
+            self.messages.append(msg)
+            self.condition.notify()
+
+    def poll(self, timeout=0.0):
+        '''Waits for a message.
+
+        Args:
+          timeout: Union[float, None], the time in seconds to wait, or None to
+            wait forever.
+
+        Returns:
+          bool, True if there is a message.'''
+        with self.condition:
+            return clock.wait_for(
+                self.condition, lambda: self.messages, timeout)
+
+    def recv(self):
+        '''Returns the next message, waiting for one if needed.'''
+        with self.condition:
+            clock.wait_for(self.condition, lambda: self.messages)
+            return self.messages.popleft()
+
+    def get(self, timeout=None):
+        '''Returns the next message, as Queue.get().
+
+        Raises:
+          queue.Empty: There was no message within the timeout.'''
+        with self.condition:
+            if not clock.wait_for(
+                    self.condition, lambda: self.messages, timeout):
+                raise queue.Empty
+            return self.messages.popleft()
+
+    def qsize(self):
+        '''Returns the number of messages waiting.'''
+        return len(self.messages)
+
+
+# Put in the inbox to wake process_messages() without a message.
+WAKE = object()
+
+
+class LocalConnection(_Inbox):
+    '''An in-memory connection to a task hosted in the TaskManager.
+
+    Messages are passed by reference rather than being copied. Encoded
+    messages are decoded as they are sent, and a batch is passed on as a
+    list of messages.'''
+
+    def __init__(self, names):
+        '''Constructor.
+
+        Args:
+          names: Dict[int, String], the TaskManager's interned message
+            names, used to decode messages.'''
+        super().__init__()
+        self.names = names
+
+    def send(self, msg):
+        '''Sends a message to the task.
+
+        Args:
+          msg: Union[Message, List[Union[Message, bytes]], None], the
+            message, a batch of messages, or None to shut down.'''
+        if isinstance(msg, list):
+            msg = [self._decode(item) if isinstance(item, bytes) else item
+                   for item in msg]
+        self.put(msg)
+
+    def send_bytes(self, data):
+        '''Sends an encoded message or batch to the task.
+
+        Args:
+          data: bytes, from codec.encode() or codec.encode_batch().'''
+        if codec.is_batch(data):
+            self.put([self._decode(item)
+                      for item in codec.decode_batch(data)])
+        else:
+            self.put(self._decode(data))
+
+    def _decode(self, data):
+        '''Decodes an encoded message.'''
+        name, args, trace = codec.decode(data, self.names)
+        return Message(name, args, None, trace)
+
+
+class _WorkerConnection(object):
+    '''A connection to a task hosted in the worker subprocess.
+
+    The messages for all of the worker's tasks are sent on one pipe, tagged
+    with the task ID.'''
+
+    def __init__(self, connection, task_id):
+        '''Constructor.
+
+        Args:
+          connection: Connection, the pipe to the worker.
+          task_id: int, the task's ID.'''
+        self.connection = connection
+        self.task_id = task_id
+
+    def send(self, msg):
+        '''Sends a message, batch or None to shut down to the task.'''
+        self.connection.send((self.task_id, _SEND, msg))
+
+    def send_bytes(self, data):
+        '''Sends an encoded message or batch to the task.'''
+        self.connection.send((self.task_id, _SEND_BYTES, data))
 
 
 class TaskManager(object):
@@ -35,33 +220,163 @@ class TaskManager(object):
     supply arguments.
 
     Tasks may also 'call' a message which will block and return a list of
-    results, one from each active binding to that message.'''
+    results, one from each active binding to that message.
 
-    def __init__(self):
-        '''Constructor.'''
+    If encode is True then emitted messages are sent using the compact
+    binary encoding in the codec module. Encoded messages are forwarded to
+    tasks as they are, without being decoded and re-encoded by the
+    TaskManager. Calls are always pickled.
+
+    If a bus_trace.TraceBuffer is supplied then every message is traced as it
+    is emitted, dispatched and handled.
+
+    A task may send a batch of messages at once, see Task.batching(). The
+    messages of a batch are dispatched in order, and those for the same task
+    are forwarded to it as one batch.
+
+    The number of times each message name is dispatched is reported by
+    stats(), which tasks can call as TaskManager.stats.
+
+    Each task is run in its own subprocess by default. A task can instead be
+    hosted as a thread in the TaskManager's process, by setting its
+    placement to THREAD. This saves the memory of a Python interpreter per
+    task. Messages to and from hosted tasks are passed in memory, without
+    pickling or pipes, and are not encoded. Hosted tasks share the GIL with
+    the TaskManager, so it suits tasks that do little work, such as handling
+    buttons. AsyncTasks must run in their own subprocess.
+
+    Tasks can also be hosted as threads in one worker subprocess that is
+    shared by all the tasks with the WORKER placement. This saves the memory
+    of an interpreter per task while keeping their work off the TaskManager's
+    GIL. The TaskManager sends the messages for all of the worker's tasks on
+    one pipe, and they send messages to it as subprocesses do.
+
+    Hosted tasks and the TaskManager read the time and wait using the clock
+    module, so that they can be run against a virtual clock, see
+    simulation.py.'''
+
+    def __init__(self, encode=False, tracer=None, placement=None):
+        '''Constructor.
+
+        Args:
+          encode: bool, True to use the binary message encoding.
+          tracer: Union[bus_trace.TraceBuffer, None], used for tracing.
+          placement: Union[Dict[String, String], None], the task class
+            names and their placements, PROCESS, THREAD or WORKER. Tasks that
+            are not listed run in their own subprocess.'''
+        self.encode = encode
+        self.tracer = tracer
+        self.trace_seq = itertools.count()
+        self.placement = placement or {}
         # A List[TaskInfo] of all the started tasks.
         self.tasks = []
         # A single shared Queue for receiving messages from tasks.
-        self.message_queue = multiprocessing.Queue()
+        self.message_queue = clock.queue()
+        # The IDs of hosted tasks are negative so as not to clash with pids.
+        self.thread_ids = itertools.count(-1, -1)
+        # When tasks are hosted, all messages are read from an in-memory
+        # queue. Hosted tasks and the TaskManager put messages in it
+        # directly, and a thread moves the messages from the subprocesses.
+        self.local_queue = None
+        if THREAD in self.placement.values():
+            self.local_queue = _Inbox()
+            # The IDs of the tasks whose constructors' messages have been
+            # moved to the local queue.
+            self.pumped = set()
+            self.pumped_condition = threading.Condition()
+            clock.start_thread(self._pump_messages, 'pump')
+        # The subprocess hosting WORKER tasks, and the pipes used to send to
+        # it and receive its replies, set by the first WORKER task.
+        self.worker = None
+        self.worker_sender = None
+        self.worker_replies = None
         # A Map[String, Callable] of message names and thier bindings.
         self.bindings = collections.defaultdict(list)
-        # A Map[pid, Connection] of process IDs and the connection used
-        # to send messages to that task.
+        # A Map[int, Connection] of task IDs and the connection used to
+        # send messages to that task.
         self.senders = {}
+        # A Map[int, String] of interned message IDs and their names.
+        self.names = {}
+        # The number of times each message name has been dispatched.
+        self.counts = collections.Counter()
+        self.started_at = clock.monotonic()
+        self.start_time = time.time()
 
         self.bind('TaskManager.bind', self.bind)
         self.bind('TaskManager.bind_task', self.bind_task)
         self.bind('TaskManager.start', self.start)
+        self.bind('TaskManager.stats', self.stats)
 
     def start(self, task_cls, *args):
         '''Starts a task.
 
-        The task_cls is constructed in a subprocess, using args if provided.
-        Its run method is then invoked.
+        The task_cls is constructed in a subprocess, or a thread if it is
+        hosted, using args if provided. Its run method is then invoked.
+
+        Args:
+          task_cls: Union[Task, String], the subclass of Task to run, or its
+            name in the form 'module.Class'.
+          args: Any, the arguments to be passed to the constructor.
+
+        Returns:
+          int, the task ID, which is the process ID for a subprocess.
+
+        If the task_cls is a name then its module is only imported in the
+        subprocess. This keeps modules that are slow to import, or use a lot
+        of memory, out of the TaskManager and the other tasks.'''
+        if isinstance(task_cls, str):
+            name = task_cls.rsplit('.', 1)[1]
+        else:
+            name = task_cls.__name__
+        start_time = clock.monotonic()
+
+        def construct(task_args):
+            '''Constructs the task instance.'''
+            return _construct(task_cls, args, task_args)
+
+        placement = self.placement.get(name, PROCESS)
+        if placement == THREAD:
+            task_id, process, sender = self._start_thread(name, construct)
+        elif placement == PROCESS:
+            task_id, process, sender = self._start_process(name, construct)
+        elif placement == WORKER:
+            task_id, process, sender = self._start_in_worker(
+                name, task_cls, args)
+        else:
+            raise ValueError('Unknown placement {} for {}'.format(
+                placement, name))
+        logging.info('Task %s constructed in %.3fs', name,
+                     clock.monotonic() - start_time)
+
+        # Store the task details.
+        self.senders[task_id] = sender
+        self.tasks.append(TaskInfo(name, process, task_id))
+
+        return task_id
+
+    def stats(self):
+        '''Returns statistics for the bus.
+
+        Returns:
+          Dict[String, Any], the Unix time the TaskManager started and the
+          time in seconds since, the number of times each message name has
+          been dispatched, and the name and ID of each task.'''
+        return dict(
+            start_time=self.start_time,
+            uptime=clock.monotonic() - self.started_at,
+            messages=dict(self.counts),
+            tasks=[(info.name, info.task_id) for info in self.tasks])
+
+    def _start_process(self, name, construct):
+        '''Starts a task in a subprocess.
 
         Args:
-          task_cls: Task, the subclass of Task to run.
-          args: Any, the arguments to be passed to the constructor.'''
+          name: String, the task class name.
+          construct: Callable[[TaskArgs], Task], constructs the task.
+
+        Returns:
+          Tuple[int, multiprocessing.Process, Connection], the task ID,
+          process and connection used for sending messages to the task.'''
         # Create a Pipe used for sending messages to this task.
         receiver, sender = multiprocessing.Pipe(False)
 
@@ -75,8 +390,11 @@ class TaskManager(object):
             '''Subprocess function.'''
             try:
                 try:
-                    # Construct the task instance.
-                    task = task_cls((self.message_queue, receiver), *args)
+                    task = construct(TaskArgs(
+                        self.message_queue, receiver, self.encode,
+                        self.tracer, os.getpid(), PROCESS))
+                    if self.local_queue is not None:
+                        self.message_queue.put(_Constructed(os.getpid()))
                 finally:
                     # Ensure that constructed is set before continuing.
                     with constructed_condition:
@@ -93,9 +411,9 @@ class TaskManager(object):
 
         # Create the new process.
         process = multiprocessing.Process(
-                target=run_task, name=task_cls.__name__)
+                target=run_task, name=name)
         process.start()
-        logging.info('Task %s has pid %d', task_cls.__name__, process.pid)
+        logging.info('Task %s has pid %d', name, process.pid)
 
         # Wait for construction to complete.
         with constructed_condition:
@@ -104,13 +422,188 @@ class TaskManager(object):
 
         if not process.is_alive():
             process.join()
-            raise RuntimeError('Task {} stopped'.format(task_cls.__name__))
+            raise RuntimeError('Task {} stopped'.format(name))
+        self._wait_pumped(name, process.pid, process)
+        return process.pid, process, sender
 
-        # Store the task details.
-        self.senders[process.pid] = sender
-        self.tasks.append(TaskInfo(task_cls, process))
+    def _start_thread(self, name, construct):
+        '''Starts a task hosted in a thread.
+
+        Args:
+          name: String, the task class name.
+          construct: Callable[[TaskArgs], Task], constructs the task.
+
+        Returns:
+          Tuple[int, threading.Thread, LocalConnection], the task ID, thread
+          and connection used for sending messages to the task.'''
+        task_id = next(self.thread_ids)
+        connection = LocalConnection(self.names)
+        # Holds the task once it has been constructed.
+        constructed = []
+        constructed_condition = threading.Condition()
+
+        def run_task():
+            '''Thread function.'''
+            try:
+                try:
+                    constructed.append(construct(TaskArgs(
+                        self.local_queue, connection, False, self.tracer,
+                        task_id, THREAD)))
+                finally:
+                    with constructed_condition:
+                        constructed.append(None)
+                        constructed_condition.notify()
+                constructed[0].run()
+            except Exception as exc:
+                # Log any errors and also send them to the TaskManager.
+                logging.exception(exc)
+                self.local_queue.put(exc)
+
+        thread = clock.start_thread(run_task, name)
+        logging.info('Task %s has id %d', name, task_id)
+        with constructed_condition:
+            clock.wait_for(constructed_condition, lambda: constructed)
+
+        if constructed[0] is None:
+            raise RuntimeError('Task {} stopped'.format(name))
+        return task_id, thread, connection
+
+    def _start_in_worker(self, name, task_cls, args):
+        '''Starts a task hosted in a thread of the worker subprocess.
+
+        The worker is started by the first task placed in it.
+
+        Args:
+          name: String, the task class name.
+          task_cls: Union[Task, String], as passed to start().
+          args: Tuple[Any], the arguments to be passed to the constructor.
+
+        Returns:
+          Tuple[int, multiprocessing.Process, _WorkerConnection], the task
+          ID, worker process and connection used for sending messages to the
+          task.'''
+        if self.worker is None:
+            receiver, self.worker_sender = multiprocessing.Pipe(False)
+            self.worker_replies, replies = multiprocessing.Pipe(False)
+            self.worker = multiprocessing.Process(
+                target=self._run_worker, args=(receiver, replies),
+                name='worker')
+            self.worker.start()
+            logging.info('Worker has pid %d', self.worker.pid)
+
+        task_id = next(self.thread_ids)
+        self.worker_sender.send((task_id, _START, (name, task_cls, args)))
+        logging.info('Task %s has id %d in the worker', name, task_id)
+
+        # Wait for construction to complete.
+        while self.worker.is_alive() and not self.worker_replies.poll(2):
+            pass
+        if not self.worker.is_alive() or not self.worker_replies.recv():
+            raise RuntimeError('Task {} stopped'.format(name))
+        self._wait_pumped(name, task_id, self.worker)
+        return (task_id, self.worker,
+                _WorkerConnection(self.worker_sender, task_id))
+
+    def _run_worker(self, receiver, replies):
+        '''The worker subprocess function.
+
+        Starts tasks in threads, and passes on the messages sent to them.
+
+        Args:
+          receiver: Connection, receives the items sent to the worker.
+          replies: Connection, used to reply whether each task started.'''
+        try:
+            import setproctitle
+            setproctitle.setproctitle('alto worker')
+        except:
+            pass
+        # A Map[int, LocalConnection] of task IDs and their connections.
+        connections = {}
+        try:
+            while True:
+                task_id, kind, item = receiver.recv()
+                if kind == _START:
+                    connections[task_id] = LocalConnection({})
+                    self._start_worker_thread(
+                        task_id, item, connections[task_id], replies)
+                elif kind == _SEND:
+                    connections[task_id].send(item)
+                else:
+                    connections[task_id].send_bytes(item)
+        except (KeyboardInterrupt, EOFError):
+            pass
 
-        return process.pid
+    def _start_worker_thread(self, task_id, start_args, connection, replies):
+        '''Starts a thread running a task in the worker subprocess.
+
+        Args:
+          task_id: int, the task ID.
+          start_args: Tuple[String, Union[Task, String], Tuple[Any]], the
+            task class name, and the task_cls and args passed to start().
+          connection: LocalConnection, receives the messages for the task.
+          replies: Connection, used to reply whether the task started.'''
+        name, task_cls, args = start_args
+
+        def run_task():
+            '''Thread function.'''
+            try:
+                try:
+                    task = _construct(task_cls, args, TaskArgs(
+                        self.message_queue, connection, False, self.tracer,
+                        task_id, WORKER))
+                except Exception:
+                    replies.send(False)
+                    raise
+                # Encoded messages are decoded using the task's bindings.
+                connection.names = task.names
+                if self.local_queue is not None:
+                    self.message_queue.put(_Constructed(task_id))
+                replies.send(True)
+                task.run()
+                raise RuntimeError('Task {} stopped'.format(name))
+            except Exception as exc:
+                # Log any errors and also send them to the TaskManager.
+                logging.exception(exc)
+                self.message_queue.put(exc)
+
+        clock.start_thread(run_task, name)
+
+    def _wait_pumped(self, name, task_id, process):
+        '''Waits for the messages sent by a task's constructor to be moved
+        to the local queue, if tasks are hosted in the TaskManager.
+
+        The TaskManager's own messages are put in the local queue directly,
+        so this ensures that they do not overtake the task's bindings.
+
+        Args:
+          name: String, the task class name.
+          task_id: int, the task ID.
+          process: multiprocessing.Process, the subprocess running the task.
+
+        Raises:
+          RuntimeError: The subprocess stopped.'''
+        if self.local_queue is None:
+            return
+        with self.pumped_condition:
+            while not clock.wait_for(self.pumped_condition,
+                                     lambda: task_id in self.pumped, 2):
+                if not process.is_alive():
+                    raise RuntimeError('Task {} stopped'.format(name))
+            self.pumped.remove(task_id)
+
+    def intern(self, name):
+        '''Registers a message name so that encoded messages can be routed.
+
+        Args:
+          name: String, the message name.
+
+        Raises:
+          ValueError: The name's ID collides with another name.'''
+        msg_id = codec.message_id(name)
+        existing = self.names.setdefault(msg_id, name)
+        if existing != name:
+            raise ValueError('Message {} has the same ID as {}'.format(
+                name, existing))
 
     def bind(self, name, callback):
         '''Binds the named message to a callback.
@@ -123,24 +616,45 @@ class TaskManager(object):
         # This handler manages the sending of results if a results Connection
         # is specified.
         def handle_message(msg):
+            if isinstance(msg, bytes):
+                # Encoded messages are never calls.
+                _, args, trace = codec.decode(msg, self.names)
+                msg = Message(name, args, None, trace)
+            if self.tracer and msg.trace:
+                self.tracer.record(bus_trace.RECEIVE, codec.message_id(name),
+                                   *msg.trace)
             result = callback(*msg.args)
             if msg.results:
                 msg.results.send(result)
+            if self.tracer and msg.trace:
+                self.tracer.record(bus_trace.DONE, codec.message_id(name),
+                                   *msg.trace)
+        self.intern(name)
         self.bindings[name].append(handle_message)
 
-    def bind_task(self, name, pid):
-        '''Binds the named message to a task specified by process ID.
+    def bind_task(self, name, task_id):
+        '''Binds the named message to a task specified by task ID.
 
         Args:
           name: String, the message name.
-          pid: int, the process ID of the task.
+          task_id: int, the task ID, as returned by start().
 
         When the message is emitted or called it will be forwarded to that
         task.
 
         This is used internally by Task.bind().'''
-        send = self.senders[pid].send
-        self.bindings[name].append(send)
+        connection = self.senders[task_id]
+
+        # Encoded messages are forwarded as they are.
+        def forward(msg):
+            if isinstance(msg, bytes):
+                connection.send_bytes(msg)
+            else:
+                connection.send(msg)
+        # Batches are sent using the connection directly.
+        forward.connection = connection
+        self.intern(name)
+        self.bindings[name].append(forward)
 
     def emit(self, message_name, *args):
         '''Broadcasts a message to the bus.
@@ -148,7 +662,16 @@ class TaskManager(object):
         Args:
           name: String, the message name.
           args: Any, the arguments to be passed to the listeners.'''
-        self.message_queue.put(Message(message_name, args, None))
+        trace = None
+        if self.tracer:
+            trace = (os.getpid(), next(self.trace_seq))
+            self.tracer.record(bus_trace.EMIT, codec.message_id(message_name),
+                               *trace)
+        sender = self.local_queue or self.message_queue
+        if self.encode:
+            sender.put(codec.encode(message_name, args, trace))
+        else:
+            sender.put(Message(message_name, args, None, trace))
 
     def process_messages(self):
         '''The main loop for a TaskManager.
@@ -157,49 +680,191 @@ class TaskManager(object):
         according to any bindings.'''
         # Check that all the subprocesses are still alive at regular
         # intervals.
-        alive_check_at = time.monotonic()
+        alive_check_at = clock.monotonic()
         while True:
             try:
-                message = self.message_queue.get(timeout=5)
+                message = self._get_message(5)
             except queue.Empty:
                 pass
             else:
-                logging.debug(message)
-                if isinstance(message, Message):
-                    # Dispatch the incoming message to any bound callbacks.
-                    if message.name in self.bindings:
-                        bindings = self.bindings[message.name]
-
-                        # When a 'call' is made the message specifies a
-                        # results Connection. The first item sent is the number
-                        # of bindings, which is the number of results that will
-                        # be sent as subsequent items.
-                        if message.results:
-                            message.results.send(len(bindings))
-
-                        for sender in bindings:
-                            sender(message)
+                if isinstance(message, list):
+                    self._dispatch(message)
+                elif isinstance(message, bytes) and codec.is_batch(message):
+                    self._dispatch(codec.decode_batch(message))
                 else:
-                    # The message was an Exception, so raise it in this
-                    # proceess.
-                    raise message
+                    self._dispatch([message])
 
             # The regular aliveness check.
-            if time.monotonic() >= alive_check_at:
-                for task_cls, process in self.tasks:
+            if clock.monotonic() >= alive_check_at:
+                for name, process, _ in self.tasks:
                     if not process.is_alive():
                         # The process exited / died, so join it and raise the
                         # issue.
                         process.join()
-                        raise RuntimeError('Task {} stopped'.format(
-                            task_cls.__name__))
-                alive_check_at = time.monotonic() + 5
+                        raise RuntimeError('Task {} stopped'.format(name))
+                alive_check_at = clock.monotonic() + 5
+
+    def _dispatch(self, messages):
+        '''Dispatches messages in order according to any bindings.
+
+        Args:
+          messages: List[Union[Message, bytes, Exception]], a batch of
+            messages, or a single message.
+
+        The messages for each task are forwarded to it as one batch.'''
+        # A Map[Connection, List[Union[Message, bytes]]] of the messages
+        # to forward to each task.
+        batches = collections.OrderedDict()
+        for message in messages:
+            logging.debug(message)
+            if self.tracer:
+                self._trace_dispatch(message)
+
+            results = None
+            if isinstance(message, bytes):
+                # Dispatch an encoded message using its interned name.
+                # Names that are not interned have no bindings.
+                name = self.names.get(codec.peek_id(message))
+                bindings = self.bindings.get(name, ())
+            elif isinstance(message, Message):
+                # Dispatch the incoming message to any bound callbacks.
+                name = message.name
+                bindings = self.bindings.get(name, ())
+                results = message.results
+            else:
+                # The message was an Exception, so raise it in this
+                # proceess.
+                raise message
+            self.counts[name] += 1
+
+            if results:
+                # When a 'call' is made the message specifies a results
+                # Connection. The first item sent is the number of bindings,
+                # which is the number of results that will be sent as
+                # subsequent items. Calls are not batched, so the earlier
+                # messages are sent first.
+                self._forward(batches)
+                batches.clear()
+                results.send(len(bindings))
+
+            for sender in bindings:
+                connection = getattr(sender, 'connection', None)
+                if connection is None or results:
+                    sender(message)
+                else:
+                    batches.setdefault(connection, []).append(message)
+        self._forward(batches)
+
+    def _forward(self, batches):
+        '''Forwards batches of messages to tasks.
+
+        Args:
+          batches: Dict[Connection, List[Union[Message, bytes]]], the
+            messages for each task.'''
+        for connection, batch in batches.items():
+            if len(batch) == 1:
+                if isinstance(batch[0], bytes):
+                    connection.send_bytes(batch[0])
+                else:
+                    connection.send(batch[0])
+            elif all(isinstance(message, bytes) for message in batch):
+                connection.send_bytes(codec.encode_batch(batch))
+            else:
+                connection.send(batch)
+
+    def _get_message(self, timeout):
+        '''Returns the next message sent to the TaskManager.
+
+        Args:
+          timeout: float, the time in seconds to wait.
+
+        Raises:
+          queue.Empty: No message arrived in time.'''
+        if self.local_queue is None:
+            return self.message_queue.get(timeout=timeout)
+        if not self.local_queue.poll(timeout):
+            raise queue.Empty
+        return self.local_queue.recv()
+
+    def _pump_messages(self):
+        '''Moves messages from the subprocesses to the local queue.'''
+        while True:
+            msg = self.message_queue.get()
+            if isinstance(msg, _Constructed):
+                with self.pumped_condition:
+                    self.pumped.add(msg.task_id)
+                    self.pumped_condition.notify_all()
+            else:
+                self.local_queue.put(msg)
+
+    def _trace_dispatch(self, message):
+        '''Records the dispatch of a message, if it is being traced.'''
+        if isinstance(message, bytes):
+            msg_id = codec.peek_id(message)
+            trace = codec.peek_trace(message)
+        elif isinstance(message, Message):
+            # Bound names are interned, others are found in the trace by ID.
+            msg_id = codec.message_id(message.name)
+            trace = message.trace
+        else:
+            return
+        if trace:
+            try:
+                depth = self.message_queue.qsize()
+                if self.local_queue:
+                    depth += len(self.local_queue.messages)
+            except NotImplementedError:
+                # Not available on all platforms.
+                depth = 0
+            self.tracer.record(bus_trace.DISPATCH, msg_id, *trace, depth)
+
+    def write_trace(self, path):
+        '''Writes the trace to a file and logs a summary.
+
+        Args:
+          path: String, the file to write in the Chrome trace event format.'''
+        records = self.tracer.records()
+        process_names = {os.getpid(): 'TaskManager'}
+        for name, _, task_id in self.tasks:
+            process_names[task_id] = name
+        bus_trace.export_chrome(records, self.names, process_names, path)
+        logging.info('Message summary:\n%s', bus_trace.format_summary(
+            bus_trace.summarize(records, self.names)))
 
     def terminate(self):
-        '''Terminates all the running tasks.'''
-        for _, process in self.tasks:
-            process.terminate()
-            process.join()
+        '''Terminates all the running tasks.
+
+        Hosted tasks are sent a shutdown message, and stop with the
+        TaskManager's process if they do not stop before. Tasks in the worker
+        stop with the worker.'''
+        for _, process, task_id in self.tasks:
+            if isinstance(process, threading.Thread):
+                self.senders[task_id].send(None)
+            else:
+                process.terminate()
+                process.join()
+
+
+class Timer(object):
+    '''A callback scheduled to run in a Task's process_messages().'''
+
+    def __init__(self, when, interval, callback, args):
+        '''Constructor.
+
+        Args:
+          when: float, the clock.monotonic() time to run at.
+          interval: Union[float, None], the period of a repeating timer.
+          callback: Callable, the function to run.
+          args: Tuple[Any], the arguments for the callback.'''
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        '''Stops the timer from running.'''
+        self.cancelled = True
 
 
 class Task(object):
@@ -208,21 +873,56 @@ class Task(object):
     A Task will often bind to messages on the bus. Because it is important
     to ensure all bindings are in place before other tasks invoke them, they
     must be set up in the constructor. The TaskManager waits for the
-    constructor to finish before resuming its execution.'''
+    constructor to finish before resuming its execution.
+
+    A Task may also schedule timers with call_at(), call_later() and
+    call_every(). Timers run while the task is processing messages, so a
+    task can wait for a deadline without sleeping or polling.
+
+    A task that is busy between calls to process_messages() can start a
+    listener thread with start_listener(). The listener handles the messages
+    that must not wait, such as requests to stop, as soon as they arrive and
+    passes the rest on to process_messages().
+
+    The messages emitted in a batching() block are sent to the TaskManager
+    together, which saves a write and a wakeup per message. A subclass can
+    set BATCH_HANDLERS to True to batch the messages emitted by each binding
+    or timer run by process_messages(). A batch is sent before the task blocks,
+    in call() or process_messages(), so batching never delays a message past
+    the handler that emitted it.'''
+
+    # True to batch the messages emitted by each handler.
+    BATCH_HANDLERS = False
 
     def __init__(self, task_args):
         # The communication points are passed in a tuple for convenience.
-        self.sender, self.receiver = task_args
+        (self.sender, self.receiver, self.encode, self.tracer, self.task_id,
+         self.placement) = task_args
+        if self.task_id is None:
+            self.task_id = os.getpid()
+        self.trace_seq = itertools.count()
         # A Map[String, Callable] of message names and thier bindings.
         self.bindings = {}
+        # A Map[int, String] of message IDs and names, for decoding.
+        self.names = {}
+        # A heap of (when, sequence, Timer) for the scheduled timers.
+        self.timers = []
+        self.timer_seq = itertools.count()
+        # Set by start_listener().
+        self.inbox = None
+        self.listener = None
+        # Holds the batch of messages being emitted by each thread.
+        self.local = threading.local()
 
         # If setproctitle has been installed then this helps identify
-        # which process is which task.
-        try:
-            import setproctitle
-            setproctitle.setproctitle('alto ' + type(self).__name__)
-        except:
-            pass
+        # which process is which task. Hosted tasks share the TaskManager's
+        # process or the worker.
+        if self.placement not in (THREAD, WORKER):
+            try:
+                import setproctitle
+                setproctitle.setproctitle('alto ' + type(self).__name__)
+            except:
+                pass
 
     def bind(self, message_name, callback):
         '''Binds the named message to a callback.
@@ -233,8 +933,9 @@ class Task(object):
 
         The callback will be invoked when the message is emitted or called.'''
         self.bindings[message_name] = callback
+        self.names[codec.message_id(message_name)] = message_name
         # Instruct the TaskManager to forward messages to this task.
-        self.emit('TaskManager.bind_task', message_name, os.getpid())
+        self.emit('TaskManager.bind_task', message_name, self.task_id)
 
     def emit(self, message_name, *args):
         '''Broadcasts a message to the bus.
@@ -243,7 +944,40 @@ class Task(object):
           name: String, the message name.
           args: Any, the arguments to be passed to the listeners.'''
         # Send the message to the TaskManager, it will dispatch it.
-        self.sender.put(Message(message_name, args, None))
+        trace = self._start_trace(message_name)
+        if self.encode:
+            msg = codec.encode(message_name, args, trace)
+        else:
+            msg = Message(message_name, args, None, trace)
+        batch = getattr(self.local, 'batch', None)
+        if batch is None:
+            self.sender.put(msg)
+        else:
+            batch.append(msg)
+
+    @contextlib.contextmanager
+    def batching(self):
+        '''Batches the messages emitted in a with block.
+
+        The messages emitted by this thread are sent to the TaskManager as one
+        batch when the block ends, or flush() is called. Blocks may be nested,
+        in which case the outermost block sends the batch.'''
+        if getattr(self.local, 'batch', None) is not None:
+            yield
+            return
+        self.local.batch = []
+        try:
+            yield
+        finally:
+            batch, self.local.batch = self.local.batch, None
+            self._send_batch(batch)
+
+    def flush(self):
+        '''Sends the messages batched by this thread so far.'''
+        batch = getattr(self.local, 'batch', None)
+        if batch:
+            self.local.batch = []
+            self._send_batch(batch)
 
     def call(self, message_name, *args):
         '''Broadcasts a message to the bus and return the results.
@@ -254,14 +988,86 @@ class Task(object):
 
         Returns:
           List[Any], a result from every listener bound to the message.'''
+        # Send any batched messages first, so they arrive first.
+        self.flush()
         # Create a Pipe for receiving replies.
-        receiver, sender = multiprocessing.Pipe(False)
-        self.sender.put(Message(message_name, args, sender))
+        receiver, sender = clock.pipe()
+        trace = self._start_trace(message_name)
+        self.sender.put(Message(message_name, args, sender, trace))
         # The TaskManager sends the number of bindings first.
         count = receiver.recv()
         # The rest of the items are the replies.
         return [receiver.recv() for _ in range(count)]
 
+    def call_at(self, when, callback, *args):
+        '''Schedules a callback to run at a given time.
+
+        Args:
+          when: float, the clock.monotonic() time to run at.
+          callback: Callable, the function to run.
+          args: Any, the arguments to be passed to the callback.
+
+        Returns:
+          Timer, which can be used to cancel the callback.'''
+        timer = Timer(when, None, callback, args)
+        self._schedule(timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        '''Schedules a callback to run after a delay.
+
+        Args:
+          delay: float, the time in seconds to wait.
+          callback: Callable, the function to run.
+          args: Any, the arguments to be passed to the callback.
+
+        Returns:
+          Timer, which can be used to cancel the callback.'''
+        return self.call_at(clock.monotonic() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        '''Schedules a callback to run periodically.
+
+        Args:
+          interval: float, the time in seconds between each run.
+          callback: Callable, the function to run.
+          args: Any, the arguments to be passed to the callback.
+
+        Returns:
+          Timer, which can be used to cancel the callback.
+
+        The first run is after one interval.'''
+        timer = Timer(clock.monotonic() + interval, interval, callback, args)
+        self._schedule(timer)
+        return timer
+
+    def start_listener(self, names):
+        '''Starts a thread that handles some messages as they arrive.
+
+        Args:
+          names: Iterable[String], the names of the messages to handle on the
+            listener thread.
+
+        The bindings for the named messages are run on the listener thread,
+        so they must be thread safe and quick. They are typically used to
+        request work that the task's main loop then does. After each one,
+        process_messages() is woken so that the main loop can see the
+        request.
+
+        Other messages are handled by process_messages() as usual. This must
+        be called before process_messages() is first called.'''
+        self.inbox = _Inbox()
+        names = frozenset(names)
+        self.listener = clock.start_thread(
+            lambda: self._listen(names), 'listener')
+
+    def wake(self):
+        '''Wakes process_messages() as if a message had been processed.
+
+        May be called from any thread, once start_listener() has been
+        called.'''
+        self.inbox.put(WAKE)
+
     def process_messages(self, duration=None, block=True, batch=False):
         '''Process messages sent by the TaskManager.
 
@@ -281,33 +1087,61 @@ class Task(object):
 
         If batch is False then this call will process at least one message
         (subject to duration and block) and then return after all pending
-        messages have been processed.'''
+        messages have been processed.
+
+        Any timers that are due are run, and running a timer counts as
+        processing a message for batch. So does being woken with wake().'''
+        # Read the listener's messages if it is running.
+        receiver = self.inbox or self.receiver
         # Keep track of the end time.
-        end_at = None if duration is None else duration + time.monotonic()
+        end_at = None if duration is None else duration + clock.monotonic()
         while True:
+            # Run any timers that are due.
+            if self._run_timers() and batch:
+                block = False
+
+            if block:
+                # Send any batched messages before waiting.
+                self.flush()
+
             if not block:
                 # Use a non blocking poll.
-                have_message = self.receiver.poll()
-            elif end_at is None:
-                # Use an infinite poll.
-                have_message = self.receiver.poll(None)
+                have_message = receiver.poll()
             else:
-                # Use a poll with a timeout.
-                have_message = self.receiver.poll(end_at-time.monotonic())
+                # Wake for the end time or the next timer, whichever is first.
+                wake_at = self._next_timer()
+                if end_at is not None:
+                    wake_at = end_at if wake_at is None else min(
+                        wake_at, end_at)
+
+                if wake_at is None:
+                    # Use an infinite poll.
+                    have_message = receiver.poll(None)
+                else:
+                    # Use a poll with a timeout.
+                    have_message = receiver.poll(
+                        max(0, wake_at - clock.monotonic()))
 
             if not have_message:
+                if block and (end_at is None or clock.monotonic() < end_at):
+                    # Woken to run a timer.
+                    continue
                 break
 
-            msg = self.receiver.recv()
+            msg = self._recv()
 
             # The TaskManager can send a None message to indicate shutdown.
             if msg is None:
                 return False
 
-            # Process this message, sending back results if requested.
-            result = self.bindings[msg.name](*msg.args)
-            if msg.results:
-                msg.results.send(result)
+            if isinstance(msg, list):
+                # Handle a batch as one.
+                with self._handler_batching():
+                    for item in msg:
+                        self._handle(item)
+            elif msg is not WAKE:
+                with self._handler_batching():
+                    self._handle(msg)
 
             # At least one message has been processed, so stop blocking.
             if batch:
@@ -315,6 +1149,149 @@ class Task(object):
 
         return True
 
+    def _schedule(self, timer):
+        '''Adds a timer to the heap.'''
+        heapq.heappush(self.timers, (timer.when, next(self.timer_seq), timer))
+
+    def _next_timer(self):
+        '''Returns the time of the next timer, or None.'''
+        # Discard cancelled timers.
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        return self.timers[0][0] if self.timers else None
+
+    def _run_timers(self):
+        '''Runs the timers that are due.
+
+        Returns:
+          int, the number of timers run.'''
+        count = 0
+        now = clock.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                # Reschedule from the deadline to avoid drift, skipping any
+                # runs that have been missed.
+                timer.when += timer.interval
+                if timer.when <= now:
+                    timer.when = now + timer.interval
+                self._schedule(timer)
+            with self._handler_batching():
+                timer.callback(*timer.args)
+            count += 1
+        return count
+
+    def _handler_batching(self):
+        '''Returns a context that batches a handler's messages, if
+        BATCH_HANDLERS is set.'''
+        if self.BATCH_HANDLERS:
+            return self.batching()
+        # A context that does nothing.
+        return contextlib.ExitStack()
+
+    def _send_batch(self, batch):
+        '''Sends a batch of messages to the TaskManager.
+
+        Args:
+          batch: List[Union[Message, bytes]], the messages.'''
+        if not batch:
+            return
+        if len(batch) == 1:
+            self.sender.put(batch[0])
+        elif self.encode:
+            self.sender.put(codec.encode_batch(batch))
+        else:
+            self.sender.put(batch)
+
+    def _start_trace(self, message_name):
+        '''Records the emitting of a message if tracing.
+
+        Returns:
+          Union[Tuple[int, int], None], the trace details for the message.'''
+        if not self.tracer:
+            return None
+        trace = (self.task_id, next(self.trace_seq))
+        self.tracer.record(bus_trace.EMIT, codec.message_id(message_name),
+                           *trace, pid=self.task_id)
+        return trace
+
+    def _handle(self, msg):
+        '''Processes a message, sending back results if requested.'''
+        if self.tracer and msg.trace:
+            msg_id = codec.message_id(msg.name)
+            self.tracer.record(bus_trace.RECEIVE, msg_id, *msg.trace,
+                               pid=self.task_id)
+        result = self.bindings[msg.name](*msg.args)
+        if msg.results:
+            msg.results.send(result)
+        if self.tracer and msg.trace:
+            self.tracer.record(bus_trace.DONE, msg_id, *msg.trace,
+                               pid=self.task_id)
+
+    def _listen(self, names):
+        '''The listener thread, see start_listener().
+
+        Args:
+          names: FrozenSet[String], the messages to handle on this thread.'''
+        try:
+            while True:
+                msg = self._read()
+                for item in msg if isinstance(msg, list) else [msg]:
+                    if item is not None and item.name in names:
+                        self._handle(item)
+                        self.inbox.put(WAKE)
+                        continue
+                    self.inbox.put(item)
+                    if item is None:
+                        return
+        except Exception as exc:
+            logging.exception(exc)
+            # Raise the error in the main loop.
+            self.inbox.put(exc)
+
+    def _recv(self):
+        '''Receives a message sent by the TaskManager.
+
+        Returns:
+          Union[Message, List[Message], None], the message or batch.
+
+        Raises:
+          Exception: The listener thread failed.'''
+        if self.inbox is None:
+            return self._read()
+        msg = self.inbox.recv()
+        if isinstance(msg, Exception):
+            raise msg
+        return msg
+
+    def _read(self):
+        '''Reads a message from the connection to the TaskManager.
+
+        Returns:
+          Union[Message, List[Message], None], the message or batch.'''
+        if not self.encode:
+            return self.receiver.recv()
+
+        # Encoded and pickled messages share the Connection.
+        data = self.receiver.recv_bytes()
+        if codec.is_batch(data):
+            return [self._decode(item) for item in codec.decode_batch(data)]
+        if codec.is_encoded(data):
+            return self._decode(data)
+        msg = pickle.loads(data)
+        if isinstance(msg, list):
+            # A batch of encoded and pickled messages.
+            return [self._decode(item) if isinstance(item, bytes) else item
+                    for item in msg]
+        return msg
+
+    def _decode(self, data):
+        '''Decodes an encoded message.'''
+        name, args, trace = codec.decode(data, self.names)
+        return Message(name, args, None, trace)
+
     def run(self):
         '''The task's main loop.
 
@@ -0,0 +1,273 @@
+# Copyright 2021 Google LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Serves metrics for monitoring in the Prometheus text format.
+
+The TelemetryExporter task listens on a local TCP port or a Unix socket.
+Each time the page is requested it calls the other tasks for their
+statistics and formats them, so nothing is sent on the bus unless the page
+is scraped.'''
+
+import asyncio
+import logging
+
+import async_task
+
+
+log = logging.getLogger('telemetry')
+
+# The time in seconds to wait for each task's statistics.
+CALL_TIMEOUT = 2
+
+# The time in seconds to wait for a request.
+REQUEST_TIMEOUT = 5
+
+# The content type of the Prometheus text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The messages called for statistics on each scrape.
+STATS_CALLS = ['TaskManager.stats', 'Engine.stats', 'Output.servo_stats',
+               'ButtonHandler.button_stats']
+
+
+class TelemetryExporter(async_task.AsyncTask):
+    '''Serves metrics from the other tasks when scraped.
+
+    Calls:
+      TaskManager.stats() -> Dict[String, Any]
+      Engine.stats() -> Dict[String, Any]
+      Output.servo_stats() -> Dict[String, Any]
+      ButtonHandler.button_stats() -> Dict[String, Any]
+
+    The page has the number of times each message has been dispatched, not
+    counting the STATS_CALLS made by scrapes. Rates are left to the
+    monitoring, as rate() of alto_messages_total. Restarts of the service
+    are seen as changes of alto_start_time_seconds. The engine's metrics are
+    the frame rate and filtered confidence of each label for each source
+    while classifying, and the number of embeddings stored for each label.
+    The servo metrics include the total times driving and idle.
+
+    Tasks that are not running are left out of the page. A task that does
+    not reply within CALL_TIMEOUT, such as the engine while its model loads,
+    is also left out and counted in alto_scrape_errors.'''
+
+    def __init__(self, task_args, port=None, path=None, host='127.0.0.1'):
+        '''Constructor.
+
+        Args:
+          port: Union[int, None], the TCP port to listen on, or None.
+          path: Union[String, None], the Unix socket to listen on, used if
+            port is None.
+          host: String, the address to listen on with a TCP port.
+
+        Raises:
+          ValueError: Neither port nor path is set.'''
+        super().__init__(task_args)
+        if port is None and path is None:
+            raise ValueError('A port or a path is needed')
+        self.port = port
+        self.path = path
+        self.host = host
+        self.scrapes = 0
+        # The number of calls that failed, by message name.
+        self.errors = {}
+
+    async def main(self):
+        '''Listens for requests.'''
+        if self.port is not None:
+            server = await asyncio.start_server(
+                self._serve, self.host, self.port)
+            log.info('serving metrics on %s:%d', self.host, self.port)
+        else:
+            server = await asyncio.start_unix_server(self._serve, self.path)
+            log.info('serving metrics on %s', self.path)
+        try:
+            # The server runs until the task stops.
+            await self.loop.create_future()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        '''Handles a connection, answering a single HTTP request.'''
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            method, target = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', ''
+            elif target.split(b'?')[0] not in (b'/', b'/metrics'):
+                status, body = '404 Not Found', ''
+            else:
+                status, body = '200 OK', await self.scrape()
+            data = body.encode()
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(
+                             status, CONTENT_TYPE, len(data)).encode())
+            writer.write(data)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def scrape(self):
+        '''Gathers the statistics and formats the page.
+
+        Returns:
+          String, the metrics in the Prometheus text format.'''
+        replies = await asyncio.gather(
+            *[self._call(name) for name in STATS_CALLS])
+        bus, engine, servos, buttons = replies
+        self.scrapes += 1
+
+        page = MetricPage()
+        page.add('alto_scrapes', 'counter', 'Scrapes of this page.',
+                 self.scrapes)
+        if bus:
+            self._add_bus(page, bus)
+        if engine:
+            self._add_engine(page, engine)
+        if servos:
+            self._add_servos(page, servos)
+        if buttons:
+            page.add('alto_button_events', 'counter',
+                     'Events emitted by the buttons.', buttons['events'])
+            page.add('alto_button_latency_max_ms', 'gauge',
+                     'The greatest latency from a button edge to its event.',
+                     buttons['latency_max_ms'])
+        page.add('alto_scrape_errors', 'counter',
+                 'Calls for statistics that failed or timed out.',
+                 [({'call': name}, count)
+                  for name, count in sorted(self.errors.items())])
+        return page.format()
+
+    async def _call(self, name):
+        '''Calls for a task's statistics.
+
+        Returns:
+          Union[Dict[String, Any], None], the first reply, or None if the
+          task is not running or did not reply in time.'''
+        try:
+            replies = await self.call(name, timeout=CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        return replies[0] if replies else None
+
+    def _add_bus(self, page, bus):
+        '''Adds the TaskManager's statistics.'''
+        counts = {name: count for name, count in bus['messages'].items()
+                  if name is not None and name not in STATS_CALLS}
+        page.add('alto_start_time_seconds', 'gauge',
+                 'The Unix time the service started.', bus['start_time'])
+        page.add('alto_uptime_seconds', 'gauge',
+                 'The time since the service started.', bus['uptime'])
+        page.add('alto_tasks', 'gauge', 'The tasks that were started.',
+                 [({'task': name, 'id': task_id}, 1)
+                  for name, task_id in bus['tasks']])
+        page.add('alto_messages', 'counter',
+                 'Messages dispatched by the TaskManager.',
+                 [({'name': name}, count)
+                  for name, count in sorted(counts.items())])
+
+    def _add_engine(self, page, engine):
+        '''Adds the engine's statistics.'''
+        store = engine['store']
+        page.add('alto_engine_state', 'gauge',
+                 'The engine state: 0 idle, 1 learning, 2 classifying.',
+                 engine['state'])
+        page.add('alto_classify_fps', 'gauge',
+                 'Frames classified per second in the current session.',
+                 [({'source': source['index']}, source['fps'])
+                  for source in engine['sources']])
+        page.add('alto_label_confidence', 'gauge',
+                 'The filtered confidence of each label while classifying.',
+                 [({'source': source['index'], 'label': label}, confidence)
+                  for source in engine['sources']
+                  for label, confidence in source['confidences'].items()])
+        page.add('alto_store_embeddings', 'gauge',
+                 'The embeddings stored for each label.',
+                 [({'label': label}, count)
+                  for label, count in store['labels'].items()])
+        page.add('alto_store_bytes', 'gauge',
+                 'The memory used by the stored embeddings.', store['bytes'])
+        if store['max_bytes'] is not None:
+            page.add('alto_store_max_bytes', 'gauge',
+                     'The memory budget for the stored embeddings.',
+                     store['max_bytes'])
+        page.add('alto_store_evicted', 'counter',
+                 'Embeddings evicted to keep within the memory budget.',
+                 store['evicted'])
+
+    def _add_servos(self, page, servos):
+        '''Adds the servo statistics.'''
+        page.add('alto_servo_drive_seconds', 'counter',
+                 'The time the servos have been driven.',
+                 servos['drive_seconds'])
+        page.add('alto_servo_idle_seconds', 'counter',
+                 'The time the servos have been idle.',
+                 servos['idle_seconds'])
+        page.add('alto_servo_updates', 'counter',
+                 'Servo updates handled.', servos['updates'])
+        page.add('alto_servo_late_segments', 'counter',
+                 'Wave segments that started late.',
+                 servos['late_segments'])
+        page.add('alto_servo_commands', 'counter',
+                 'pigpio commands sent.', servos['commands'])
+        page.add('alto_servo_latency_max_ms', 'gauge',
+                 'The greatest time from a servo message to its first pulse.',
+                 servos['latency_max_ms'])
+
+
+class MetricPage(object):
+    '''Builds a page in the Prometheus text format.'''
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, description, samples):
+        '''Adds a metric.
+
+        Args:
+          name: String, the metric name. Counters have _total appended.
+          kind: String, 'counter' or 'gauge'.
+          description: String, the help text.
+          samples: Union[float, List[Tuple[Dict[String, Any], float]]], the
+            value, or the labels and value of each sample.'''
+        if kind == 'counter':
+            name += '_total'
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        self.lines.append('# HELP {} {}'.format(name, description))
+        self.lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            if labels:
+                name_labels = '{}{{{}}}'.format(name, ','.join(
+                    '{}="{}"'.format(key, _escape(label))
+                    for key, label in labels.items()))
+            else:
+                name_labels = name
+            self.lines.append('{} {}'.format(name_labels, float(value)))
+
+    def format(self):
+        '''Returns the page.'''
+        return '\n'.join(self.lines) + '\n'
+
+
+def _escape(value):
+    '''Escapes a label value.'''
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import logging
-import time
 
 import task
 
@@ -27,8 +26,11 @@ class BaseUI(task.Task):
     Binds to:
       ButtonHandler.single_button_pressed(index: int)
       ButtonHandler.both_buttons_pressed(pressed: bool)
-      Engine.matched(label: Union[Any, None])
-      System.started()'''
+      Engine.matched(label: Union[Any, None], source: int)
+      System.started()
+
+    With more than one source, the match shown is the one from the lowest
+    numbered source that has a match.'''
 
     IDLE = 0
     TRAINING = 1
@@ -40,6 +42,8 @@ class BaseUI(task.Task):
 
         self.state = self.IDLE
         self.reset_released = True
+        # A Map[int, Any] of sources and their current matches.
+        self.matches = {}
 
         self.bind('ButtonHandler.single_button_pressed', self.on_training_event)
         self.bind('ButtonHandler.both_buttons_pressed', self.on_reset_event)
@@ -54,21 +58,23 @@ class BaseUI(task.Task):
         Args:
           label: int, the button index to use as the label.'''
         if self.state == self.IDLE:
-            # Run training.
+            # Run training, which calls finish_training() when it is done.
             self.state = self.TRAINING
             self.run_training(label)
 
-            # Ensure the engine is idle after training so no new match results
-            # are emitted.
-            self.call('Engine.idle')
+    def finish_training(self):
+        '''Called when training has finished.'''
+        # Ensure the engine is idle after training so no new match results
+        # are emitted.
+        self.call('Engine.idle')
 
-            # Process messages while state is TRAINING to discard any queued
-            # match results.
-            self.process_messages(block=False)
+        # Process messages while state is TRAINING to discard any queued
+        # match results.
+        self.process_messages(block=False)
 
-            # Start classifiying.
-            self.state = self.IDLE
-            self.emit('Engine.start_classifying')
+        # Start classifiying.
+        self.state = self.IDLE
+        self.emit('Engine.start_classifying')
 
     def on_reset_event(self, pressed):
         '''Called when a reset has been requested or released.
@@ -86,13 +92,19 @@ class BaseUI(task.Task):
             self.reset_released = True
             self.state = self.IDLE
 
-    def on_match_event(self, label):
+    def on_match_event(self, label, source=0):
         '''Called when the engine has detected a new match or loss of match.
 
         Args:
-          label: Union[Any, None], the matched label, or None.'''
+          label: Union[Any, None], the matched label, or None.
+          source: int, the index of the source that matched.'''
+        if label is None:
+            self.matches.pop(source, None)
+        else:
+            self.matches[source] = label
         if self.state == self.IDLE:
-            self.show_match_result(label)
+            self.show_match_result(
+                self.matches[min(self.matches)] if self.matches else None)
 
     # Methods to be overloaded.
 
@@ -111,8 +123,11 @@ class BaseUI(task.Task):
         '''Called when training has been requested.
 
         Args:
-          label: int, the button index to use as the label.'''
-        pass
+          label: int, the button index to use as the label.
+
+        Training may continue after this returns, using timers, and ends when
+        finish_training() is called.'''
+        self.finish_training()
 
     def run_reset(self):
         '''Called when a reset has been requested.'''
@@ -127,8 +142,9 @@ class AltoUI(BaseUI):
     def show_starting(self):
         '''Called at startup.'''
         logging.info('starting')
-        self.emit('Output.set_servo', 0, 0)
-        self.emit('Output.set_servo', 1, 0)
+        with self.batching():
+            self.emit('Output.set_servo', 0, 0)
+            self.emit('Output.set_servo', 1, 0)
 
     def show_match_result(self, label):
         '''Called when the match result changes.
@@ -136,8 +152,9 @@ class AltoUI(BaseUI):
         Args:
           label: Union[Any, None], the matched label, or None.'''
         logging.info('show_match_result %s', label)
-        self.emit('Output.set_servo', 0, 1 if label == 0 else 0)
-        self.emit('Output.set_servo', 1, 1 if label == 1 else 0)
+        with self.batching():
+            self.emit('Output.set_servo', 0, 1 if label == 0 else 0)
+            self.emit('Output.set_servo', 1, 1 if label == 1 else 0)
 
     def run_training(self, label):
         '''Called when training has been requested.
@@ -148,24 +165,28 @@ class AltoUI(BaseUI):
 
         # Reset to the idle state.
         self.call('Engine.idle') # Block to ensure state sync.
-        self.emit('Output.set_servo', 0, 0)
-        self.emit('Output.set_servo', 1, 0)
-        time.sleep(0.5)
+        with self.batching():
+            self.emit('Output.set_servo', 0, 0)
+            self.emit('Output.set_servo', 1, 0)
+        self.call_later(0.5, self._start_learning, label)
 
-        # Start learning and perform an animation.
+    def _start_learning(self, label):
+        '''Starts learning and performs an animation.'''
         duration = 5
         self.call('Engine.start_learning', label) # Block to ensure state sync.
         self.emit('Output.sweep_servos', duration, [(label, 0, 1)])
-        self.process_messages(duration)
+        self.call_later(duration, self._stop_learning, label)
 
-        # Reset back to the idle state.
+    def _stop_learning(self, label):
+        '''Resets back to the idle state.'''
         self.call('Engine.idle') # Block to ensure state sync.
         self.emit('Output.set_servo', label, 0)
-        time.sleep(0.5)
+        self.call_later(0.5, self.finish_training)
 
     def run_reset(self):
         '''Called when a reset has been requested.'''
         logging.info('run_reset')
         self.call('Engine.reset') # Block to ensure state sync.
-        self.emit('Output.set_servo', 0, 0)
-        self.emit('Output.set_servo', 1, 0)
+        with self.batching():
+            self.emit('Output.set_servo', 0, 0)
+            self.emit('Output.set_servo', 1, 0)